@@ -0,0 +1,81 @@
+"""
+Throughput of the SimpleMetabolismModel entry points for risk analysis sweeps.
+
+Run from the repo root:
+
+    PYTHONPATH=. python benchmarks/benchmark_simple_metabolism_model.py
+"""
+import time
+
+import numpy as np
+
+from tidepool_data_science_models.models.simple_metabolism_model import (
+    SimpleMetabolismModel,
+)
+
+
+def get_sweep_scenarios(num_scenarios, random_seed=0):
+    """Random (carbs, insulin, isf, cir) scenarios, half using the bolus wizard"""
+    rng = np.random.RandomState(random_seed)
+    carb_amounts = rng.uniform(0, 100, num_scenarios)
+    insulin_amounts = np.where(
+        rng.uniform(size=num_scenarios) < 0.5, np.nan, rng.uniform(0, 10, num_scenarios)
+    )
+    isfs = rng.uniform(20, 150, num_scenarios)
+    cirs = rng.uniform(5, 25, num_scenarios)
+    return carb_amounts, insulin_amounts, isfs, cirs
+
+
+def benchmark_run_loop(carb_amounts, insulin_amounts, isfs, cirs, num_hours=8):
+    """One model and one run() per scenario, as the risk analysis does today"""
+    start_time = time.perf_counter()
+    for carb_amount, insulin_amount, isf, cir in zip(
+        carb_amounts, insulin_amounts, isfs, cirs
+    ):
+        smm = SimpleMetabolismModel(
+            insulin_sensitivity_factor=isf, carb_insulin_ratio=cir
+        )
+        smm.run(carb_amount, insulin_amount, num_hours=num_hours)
+    return time.perf_counter() - start_time
+
+
+def benchmark_run_batch(
+    carb_amounts, insulin_amounts, isfs, cirs, num_hours=8, batch_size=10000
+):
+    """All scenarios through run_batch() in batches"""
+    smm = SimpleMetabolismModel(
+        insulin_sensitivity_factor=isfs[0], carb_insulin_ratio=cirs[0]
+    )
+
+    start_time = time.perf_counter()
+    for batch_start in range(0, len(carb_amounts), batch_size):
+        batch = slice(batch_start, batch_start + batch_size)
+        smm.run_batch(
+            carb_amounts[batch],
+            insulin_amounts[batch],
+            isfs=isfs[batch],
+            cirs=cirs[batch],
+            num_hours=num_hours,
+        )
+    return time.perf_counter() - start_time
+
+
+def print_throughput(name, num_scenarios, seconds):
+    print(
+        "{:<12} {:>9} scenarios {:>8.3f} s {:>12.0f} scenarios/s".format(
+            name, num_scenarios, seconds, num_scenarios / seconds
+        )
+    )
+
+
+if __name__ == "__main__":
+
+    num_scenarios = 20000
+    scenarios = get_sweep_scenarios(num_scenarios)
+
+    loop_seconds = benchmark_run_loop(*scenarios)
+    batch_seconds = benchmark_run_batch(*scenarios)
+
+    print_throughput("run loop", num_scenarios, loop_seconds)
+    print_throughput("run_batch", num_scenarios, batch_seconds)
+    print("speedup: {:.1f}x".format(loop_seconds / batch_seconds))
@@ -7,9 +7,16 @@ import pandas as pd
 import numpy as np
 import datetime
 import copy
+from concurrent.futures import ThreadPoolExecutor
 import pytest
 from tidepool_data_science_models.models.icgm_sensor_generator_OLD import icgm_simulator_old
-from tidepool_data_science_models.models.icgm_sensor import iCGMSensor
+from tidepool_data_science_models.models.icgm_sensor import (
+    iCGMSensor,
+    iCGMSensorFleet,
+    ReadingDelayBuffer,
+    SensorNoiseStream,
+    SensorExpiredError,
+)
 from tidepool_data_science_models.models.icgm_sensor_generator import iCGMSensorGenerator
 import tidepool_data_science_models.models.icgm_sensor_generator_functions as sf
 
@@ -65,7 +72,7 @@ def test_generator_fails_without_fit():
     assert expected_exception_message == received_exception_message
 
 
-def create_sample_sensor(sensor_life_days=10, time_index=0, sensor_datetime=None):
+def create_sample_sensor(sensor_life_days=10, time_index=0, sensor_datetime=None, delay=10):
 
     sample_sensor_properties = pd.DataFrame(index=[0])
     sample_sensor_properties["initial_bias"] = 1.992889
@@ -75,7 +82,7 @@ def create_sample_sensor(sensor_life_days=10, time_index=0, sensor_datetime=None
     sample_sensor_properties["bias_drift_oscillations"] = 1.041129
     sample_sensor_properties["bias_norm_factor"] = 55.000000
     sample_sensor_properties["noise_coefficient"] = 7.195753
-    sample_sensor_properties["delay"] = 10
+    sample_sensor_properties["delay"] = delay
     sample_sensor_properties["random_seed"] = 0
     sample_sensor_properties["bias_drift_type"] = "random"
 
@@ -112,7 +119,7 @@ def test_sample_sensor_creation():
     assert isinstance(sample_sensor, iCGMSensor)
     check_sensor_properties(sample_sensor, sample_sensor_properties)
     assert sample_sensor.time_index == 0
-    assert sample_sensor.sensor_bg_history == []
+    assert len(sample_sensor.sensor_bg_history) == 0
     assert sample_sensor.sensor_life_days == 10
 
     sample_sensor, sample_sensor_properties = create_sample_sensor(
@@ -171,8 +178,8 @@ def test_correct_sensor_prefill():
     sample_sensor.prefill_sensor_history(prefill_true_bg_history)
     assert sample_sensor.time_index == 5
 
-    expected_sensor_bg_history = [np.nan, np.nan, 93.6647980483592, 103.61317563648004, 101.79296809857229]
-    assert str(sample_sensor.sensor_bg_history) == str(expected_sensor_bg_history)
+    expected_sensor_bg_history = [np.nan, np.nan, 96.16729311661226, 96.15777035664263, 88.0731014346279]
+    np.testing.assert_array_equal(sample_sensor.sensor_bg_history, expected_sensor_bg_history)
 
 
 def test_sensor_expiration():
@@ -194,7 +201,7 @@ def test_sensor_expiration():
     assert sample_sensor.time_index == 2880
     assert sample_sensor.current_datetime == datetime.datetime(2020, 1, 11)
     assert len(sample_sensor.datetime_history) == 10 * 288
-    assert sample_sensor.datetime_history == expected_datetime_history
+    assert np.array_equal(sample_sensor.datetime_history, np.array(expected_datetime_history, dtype="datetime64[m]"))
 
     with pytest.raises(Exception) as e:
         sample_sensor.update(None)
@@ -223,11 +230,15 @@ def test_get_loop_format():
         datetime.datetime(2020, 1, 1, 0, 20)
 
     ]
-    expected_glucose_values = [400, 400, 94.0, 104.0, 102.0]  # NaNs are currently returned as 400s
+    expected_glucose_values = [400, 400, 96.0, 96.0, 88.0]  # NaNs are currently returned as 400s
     glucose_dates, glucose_values = sample_sensor.get_loop_inputs()
 
-    assert glucose_dates == expected_glucose_dates
-    assert glucose_values == expected_glucose_values
+    assert np.array_equal(glucose_dates, np.array(expected_glucose_dates, dtype="datetime64[m]"))
+    assert glucose_dates.tolist() == expected_glucose_dates
+    assert np.array_equal(glucose_values, expected_glucose_values)
+
+    # The inputs are views of the history, not copies
+    assert np.shares_memory(glucose_values, sample_sensor._loop_bg_history)
 
 
 def test_prefill_calculations():
@@ -247,3 +258,242 @@ def test_prefill_calculations():
     prefilled_sensor.prefill_sensor_history(true_bg_trace)
 
     assert str(normal_sensor.__dict__) == str(prefilled_sensor.__dict__)
+    assert_sensor_states_equal(normal_sensor, prefilled_sensor)
+
+
+def assert_sensor_states_equal(sensor, other_sensor):
+    """
+    Compare the sensors' state, including every entry of the preallocated histories that the
+    summarized numpy reprs in str(sensor.__dict__) leave out
+    """
+    assert sensor.time_index == other_sensor.time_index
+    assert sensor.history_size == other_sensor.history_size
+    assert str(sensor.current_sensor_bg) == str(other_sensor.current_sensor_bg)
+    np.testing.assert_array_equal(sensor._sensor_bg_history, other_sensor._sensor_bg_history)
+    np.testing.assert_array_equal(sensor._loop_bg_history, other_sensor._loop_bg_history)
+    np.testing.assert_array_equal(sensor._datetime_history, other_sensor._datetime_history)
+    np.testing.assert_array_equal(sensor.reading_delay_buffer.values, other_sensor.reading_delay_buffer.values)
+    np.testing.assert_array_equal(
+        sensor.reading_delay_buffer.get_values(), other_sensor.reading_delay_buffer.get_values()
+    )
+
+
+def test_generate_icgm_sensors_float32():
+    """Are float32 traces the float64 traces rounded, with the same random draws?"""
+
+    true_bg_trace = np.linspace(40, 400, 288 * 10)
+
+    for bias_drift_type in ["none", "random"]:
+        traces_64, properties_64 = sf.generate_icgm_sensors(
+            true_bg_trace, [0, 1, 0, 2], n_sensors=20, bias_drift_type=bias_drift_type, noise_coefficient=2.5
+        )
+        traces_32, properties_32 = sf.generate_icgm_sensors(
+            true_bg_trace,
+            [0, 1, 0, 2],
+            n_sensors=20,
+            bias_drift_type=bias_drift_type,
+            noise_coefficient=2.5,
+            dtype=np.float32,
+        )
+
+        assert traces_32.dtype == np.float32
+        assert traces_32.nbytes == traces_64.nbytes // 2
+        assert np.max(np.abs(traces_64 - traces_32) / np.abs(traces_64)) < 1e-6
+        pd.testing.assert_frame_equal(properties_64, properties_32)
+
+
+def test_get_bg_trace_matches_get_bg():
+    """Is the vectorized trace the same as stepping get_bg() through it, without changing the sensor?"""
+
+    true_bg_trace = np.linspace(80, 250, 48)
+
+    for delay in [0, 5, 10, 15]:
+        for num_updates in [0, 1, 2, 5]:
+            sample_sensor, _ = create_sample_sensor(sensor_datetime=TEST_DATETIME, delay=delay)
+            sample_sensor.prefill_sensor_history(np.arange(num_updates) + 100.0)
+            sensor_state = str(sample_sensor.__dict__)
+            original_sensor = copy.deepcopy(sample_sensor)
+
+            stepped_sensor = copy.deepcopy(sample_sensor)
+            expected_trace = []
+            for true_bg_value in true_bg_trace:
+                expected_trace.append(stepped_sensor.get_bg(true_bg_value))
+                stepped_sensor.time_index += 1
+
+            sensor_bg_trace = sample_sensor.get_bg_trace(true_bg_trace)
+
+            assert isinstance(sensor_bg_trace, np.ndarray)
+            assert str(sensor_bg_trace.tolist()) == str(expected_trace)
+            assert str(sample_sensor.__dict__) == sensor_state
+            assert_sensor_states_equal(sample_sensor, original_sensor)
+
+    # Shorter than the delay of a new sensor, all nan
+    sample_sensor, _ = create_sample_sensor(sensor_datetime=TEST_DATETIME)
+    assert np.all(np.isnan(sample_sensor.get_bg_trace([100.0, 101.0])))
+    assert len(sample_sensor.get_bg_trace([])) == 0
+
+
+def test_reading_delay_buffer():
+
+    delay_buffer = ReadingDelayBuffer(delay_steps=3)
+
+    delayed_values = [delay_buffer.push(value) for value in [1.0, 2.0, 3.0, 4.0, 5.0]]
+    assert str(delayed_values) == str([np.nan, np.nan, np.nan, 1.0, 2.0])
+    assert len(delay_buffer) == 3
+    assert repr(delay_buffer) == "ReadingDelayBuffer([3.0, 4.0, 5.0])"
+
+    snapshot = delay_buffer.snapshot()
+    assert delay_buffer.push(6.0) == 3.0
+    assert delay_buffer.push(7.0) == 4.0
+
+    delay_buffer.restore(snapshot)
+    assert np.array_equal(delay_buffer.get_values(), [3.0, 4.0, 5.0])
+    assert delay_buffer.push(6.0) == 3.0
+
+    # No delay passes readings straight through
+    assert ReadingDelayBuffer(delay_steps=0).push(100.0) == 100.0
+
+    sample_sensor, _ = create_sample_sensor(sensor_datetime=TEST_DATETIME, delay=15)
+    sample_sensor.prefill_sensor_history([100.0, 101.0, 102.0, 103.0, 104.0])
+    assert np.array_equal(sample_sensor.reading_delay_buffer.get_values(), [102.0, 103.0, 104.0])
+
+
+def test_sensor_fleet_matches_sensors():
+
+    sensor_properties = pd.concat(
+        [create_sample_sensor(sensor_datetime=TEST_DATETIME, delay=delay)[1] for delay in [0, 5, 10, 15]],
+        ignore_index=True,
+    )
+    sensor_properties["random_seed"] = np.arange(len(sensor_properties))
+
+    sensors = [
+        iCGMSensor(current_datetime=TEST_DATETIME, sensor_properties=sensor_properties.loc[[sensor_num]])
+        for sensor_num in range(len(sensor_properties))
+    ]
+    sensor_fleet = iCGMSensorFleet(current_datetime=TEST_DATETIME, sensor_properties=sensor_properties)
+
+    np.random.seed(1)
+    true_bgs = 100 + np.cumsum(np.random.normal(size=(len(sensors), 12)), axis=1)
+
+    for time_step in range(true_bgs.shape[1]):
+        next_datetime = TEST_DATETIME + datetime.timedelta(minutes=5 * (time_step + 1))
+        true_bg_prediction = true_bgs[:, time_step:] + 10
+
+        for sensor, true_bg, sensor_true_bg_prediction in zip(sensors, true_bgs[:, time_step], true_bg_prediction):
+            sensor.update(
+                next_datetime, patient_true_bg=true_bg, patient_true_bg_prediction=sensor_true_bg_prediction
+            )
+        sensor_fleet.update(
+            next_datetime, patient_true_bg=true_bgs[:, time_step], patient_true_bg_prediction=true_bg_prediction
+        )
+
+        expected_sensor_bgs = [sensor.current_sensor_bg for sensor in sensors]
+        expected_predictions = np.array([sensor.current_sensor_bg_prediction for sensor in sensors])
+        assert str(sensor_fleet.current_sensor_bg.tolist()) == str(expected_sensor_bgs)
+        assert str(sensor_fleet.current_sensor_bg_prediction.tolist()) == str(expected_predictions.tolist())
+
+    assert sensor_fleet.time_index == sensors[0].time_index
+    np.testing.assert_array_equal(
+        sensor_fleet.sensor_bg_history, [sensor.sensor_bg_history for sensor in sensors]
+    )
+    assert sorted(sensor_fleet.noise_chunks) == [0]
+    fleet_datetimes, fleet_loop_bgs = sensor_fleet.get_loop_inputs()
+    for sensor, sensor_loop_bgs in zip(sensors, fleet_loop_bgs):
+        sensor_datetimes, expected_loop_bgs = sensor.get_loop_inputs()
+        np.testing.assert_array_equal(fleet_datetimes, sensor_datetimes)
+        np.testing.assert_array_equal(sensor_loop_bgs, expected_loop_bgs)
+
+
+def test_generate_sensor_fleet():
+
+    test_bg_trace = sf.generate_test_bg_trace(days_of_data=2)
+
+    icgm_sensor_generator = iCGMSensorGenerator(batch_training_size=3, true_dataset_name="48hours-sinusoid")
+    icgm_sensor_generator.fit(true_bg_trace=test_bg_trace)
+    sensors = icgm_sensor_generator.generate_sensors(sensor_start_datetime=TEST_DATETIME, n_sensors=3)
+    sensor_fleet = icgm_sensor_generator.generate_sensor_fleet(sensor_start_datetime=TEST_DATETIME, n_sensors=3)
+
+    assert sensor_fleet.n_sensors == 3
+    assert icgm_sensor_generator.sensor_fleet is sensor_fleet
+
+    true_bg_trace = np.linspace(90, 180, 24)
+    expected_traces = [sensor.get_bg_trace(true_bg_trace) for sensor in sensors]
+    np.testing.assert_array_equal(sensor_fleet.get_bg_trace(true_bg_trace), expected_traces)
+
+
+def test_sensor_noise_stream_chunks():
+
+    def create_noise_stream(chunk_size=288):
+        return SensorNoiseStream(
+            random_seed=0,
+            noise_coefficient=7.195753,
+            bias_drift_type="random",
+            bias_drift_oscillations=1.041129,
+            phi_drift=2.158842,
+            bias_drift_range_start=0.835931,
+            num_values=2880,
+            chunk_size=chunk_size,
+        )
+
+    # Chunks are the same no matter when they are requested
+    noise_stream = create_noise_stream()
+    later_chunk_first = [noise_stream.get_chunk(chunk_index) for chunk_index in [3, 0, 3]]
+    assert np.array_equal(later_chunk_first[0][0], later_chunk_first[2][0])
+    assert not np.array_equal(later_chunk_first[0][0], later_chunk_first[1][0])
+
+    noise, drift_multiplier = create_noise_stream().get_values(0, 4 * 288)
+    assert np.array_equal(noise[3 * 288 :], later_chunk_first[0][0])
+    assert np.array_equal(drift_multiplier[3 * 288 :], later_chunk_first[0][1])
+
+    # Each chunk is its own Philox stream
+    expected_noise = np.random.Generator(np.random.Philox(key=0, counter=[0, 3, 0, 0])).normal(0, 7.195753, 288)
+    assert np.array_equal(later_chunk_first[2][0], expected_noise)
+
+    # Chunks generated from several threads at once are the same as one at a time
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        threaded_chunks = list(executor.map(noise_stream.get_chunk, [3, 0, 3] * 20))
+    for (chunk_noise, chunk_drift_multiplier), expected_chunk in zip(threaded_chunks, later_chunk_first * 20):
+        assert np.array_equal(chunk_noise, expected_chunk[0])
+        assert np.array_equal(chunk_drift_multiplier, expected_chunk[1])
+
+    # Only the chunks covering the readings are kept
+    noise_stream = create_noise_stream()
+    noise_stream.get_values(0, 10)
+    assert sorted(noise_stream.chunks) == [0]
+    noise_stream.get_values(280, 300)
+    assert sorted(noise_stream.chunks) == [0, 1]
+    noise_stream.get_values(600, 610)
+    assert sorted(noise_stream.chunks) == [2]
+
+    with pytest.raises(SensorExpiredError):
+        noise_stream.get_values(2870, 2881)
+
+    sample_sensor, _ = create_sample_sensor(sensor_datetime=TEST_DATETIME)
+    assert len(sample_sensor.noise_stream.chunks) == 0
+    sample_sensor.prefill_sensor_history([100.0] * 300)
+    assert sorted(sample_sensor.noise_stream.chunks) == [1]
+
+    # A sensor started late in its life generates only the chunks it reaches
+    late_sensor, _ = create_sample_sensor(time_index=2000, sensor_datetime=TEST_DATETIME)
+    late_sensor.update(TEST_DATETIME, patient_true_bg=100.0)
+    assert sorted(late_sensor.noise_stream.chunks) == [2000 // 288]
+
+
+def test_short_sensor_life_noise_stream():
+    """
+    Does a sensor with less than 10 days of life keep the 10 day noise and drift, so predictions can run
+    past its end of life?
+    """
+    short_sensor, _ = create_sample_sensor(sensor_life_days=1, sensor_datetime=TEST_DATETIME)
+    ten_day_sensor, _ = create_sample_sensor(sensor_life_days=10, sensor_datetime=TEST_DATETIME)
+
+    true_bg_prediction = np.linspace(100, 150, 72)
+    for sensor in [short_sensor, ten_day_sensor]:
+        sensor.prefill_sensor_history([100.0] * 287)
+        sensor.update(TEST_DATETIME, patient_true_bg=100.0, patient_true_bg_prediction=true_bg_prediction)
+
+    assert short_sensor.is_sensor_expired()
+    np.testing.assert_array_equal(short_sensor.sensor_bg_history, ten_day_sensor.sensor_bg_history)
+    np.testing.assert_array_equal(
+        short_sensor.current_sensor_bg_prediction, ten_day_sensor.current_sensor_bg_prediction
+    )
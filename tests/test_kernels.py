@@ -0,0 +1,110 @@
+"""
+Testing the kernel backends behind the treatment models. Every test runs against each available backend.
+"""
+import numpy as np
+import pytest
+
+from tidepool_data_science_models.models import kernels
+from tidepool_data_science_models.models.kernels import get_kernel_backend, get_available_kernel_backends
+from tidepool_data_science_models.models.treatment_models import PalermInsulinModel, CesconCarbModel
+from tidepool_data_science_models.utils import EPSILON_TEST
+
+KERNEL_BACKEND_NAMES = [
+    pytest.param(name, marks=pytest.mark.skipif(name not in get_available_kernel_backends(), reason="not installed"))
+    for name in kernels.KERNEL_BACKENDS
+]
+
+
+def get_palerm_reference(insulin_amount, isf, tau1, tau2, kcl, minutes_per_step, num_steps):
+    """The Palerm curve computed directly from its definition"""
+    t_min = np.arange((num_steps - 1) * minutes_per_step + 1)
+    activity = insulin_amount / (kcl * (tau2 - tau1)) * (np.exp(-t_min / tau2) - np.exp(-t_min / tau1))
+    insulin_cleared = np.cumsum(activity)
+    bg = -isf * insulin_cleared[::minutes_per_step]
+    return bg, insulin_amount - insulin_cleared[::minutes_per_step], np.append(0, np.diff(bg))
+
+
+def get_cescon_reference(carb_amount, isf, cir, tau, theta, minutes_per_step, num_steps):
+    """The Cescon curve computed directly from its definition"""
+    t_min = np.arange(num_steps) * minutes_per_step
+    bg = isf / cir * carb_amount * np.where(t_min >= theta, 1 - np.exp((theta - t_min) / tau), 0.0)
+    return bg, np.append(0, np.diff(bg))
+
+
+@pytest.mark.parametrize("backend_name", KERNEL_BACKEND_NAMES)
+@pytest.mark.parametrize("minutes_per_step", [1, 5])
+def test_palerm_kernel_fills_buffers(backend_name, minutes_per_step):
+
+    backend = get_kernel_backend(backend_name)
+    num_steps = 8 * 60 // minutes_per_step
+
+    bg, iob, bg_delta = np.full(num_steps, np.nan), np.full(num_steps, np.nan), np.full(num_steps, np.nan)
+    buffers = [bg, iob, bg_delta]
+    backend.palerm_insulin(2.5, 80, 50, 75, 1.2, minutes_per_step, bg, iob, bg_delta)
+
+    for output, expected in zip(buffers, get_palerm_reference(2.5, 80, 50, 75, 1.2, minutes_per_step, num_steps)):
+        assert np.max(np.abs(output - expected)) < EPSILON_TEST
+
+
+@pytest.mark.parametrize("backend_name", KERNEL_BACKEND_NAMES)
+@pytest.mark.parametrize("minutes_per_step", [1, 5])
+def test_cescon_kernel_fills_buffers(backend_name, minutes_per_step):
+
+    backend = get_kernel_backend(backend_name)
+    num_steps = 8 * 60 // minutes_per_step
+
+    for theta in [0, 17, 20]:
+        bg, bg_delta = np.full(num_steps, np.nan), np.full(num_steps, np.nan)
+        backend.cescon_carb(30.0, 80, 10, 40, theta, minutes_per_step, bg, bg_delta)
+
+        expected_bg, expected_bg_delta = get_cescon_reference(30.0, 80, 10, 40, theta, minutes_per_step, num_steps)
+        assert np.max(np.abs(bg - expected_bg)) < EPSILON_TEST
+        assert np.max(np.abs(bg_delta - expected_bg_delta)) < EPSILON_TEST
+
+
+@pytest.mark.parametrize("backend_name", KERNEL_BACKEND_NAMES)
+def test_models_agree_across_backends(backend_name):
+
+    for five_min in [True, False]:
+        insulin_outputs = PalermInsulinModel(isf=80, cir=10, kernel_backend=backend_name).run(8, 3.0, five_min=five_min)
+        numpy_insulin_outputs = PalermInsulinModel(isf=80, cir=10).run(8, 3.0, five_min=five_min)
+        carb_outputs = CesconCarbModel(isf=80, cir=10, kernel_backend=backend_name).run(8, 45.0, five_min=five_min)
+        numpy_carb_outputs = CesconCarbModel(isf=80, cir=10).run(8, 45.0, five_min=five_min)
+
+        for output, numpy_output in zip(insulin_outputs + carb_outputs, numpy_insulin_outputs + numpy_carb_outputs):
+            assert output.shape == numpy_output.shape
+            assert np.max(np.abs(output - numpy_output)) < EPSILON_TEST
+
+
+def test_fused_loops_match_numpy_backend():
+    """
+    The loops the numba backend compiles are plain Python, so check them even without numba installed.
+    """
+    num_steps = 4 * 12
+    bg, iob, bg_delta = np.zeros(num_steps), np.zeros(num_steps), np.zeros(num_steps)
+    kernels._palerm_insulin_loop(2.5, 80.0, 50.0, 75.0, 1.2, 5, bg, iob, bg_delta)
+
+    expected = [np.zeros(num_steps) for _ in range(3)]
+    get_kernel_backend("numpy").palerm_insulin(2.5, 80, 50, 75, 1.2, 5, *expected)
+    for output, expected_output in zip([bg, iob, bg_delta], expected):
+        assert np.max(np.abs(output - expected_output)) < EPSILON_TEST
+
+    bg, bg_delta = np.zeros(num_steps), np.zeros(num_steps)
+    kernels._cescon_carb_loop(30.0, 80.0, 10.0, 40.0, 17.0, 5, bg, bg_delta)
+
+    expected = [np.zeros(num_steps) for _ in range(2)]
+    get_kernel_backend("numpy").cescon_carb(30.0, 80, 10, 40, 17, 5, *expected)
+    for output, expected_output in zip([bg, bg_delta], expected):
+        assert np.max(np.abs(output - expected_output)) < EPSILON_TEST
+
+
+def test_unknown_kernel_backend():
+
+    with pytest.raises(ValueError):
+        get_kernel_backend("fortran")
+
+    assert "numpy" in get_available_kernel_backends()
+
+    if "numba" not in get_available_kernel_backends():
+        with pytest.raises(ValueError):
+            PalermInsulinModel(isf=80, cir=10, kernel_backend="numba")
@@ -0,0 +1,106 @@
+"""
+Testing the batched fitting of treatment model parameters.
+"""
+import numpy as np
+import pytest
+
+from tidepool_data_science_models.models.model_fitting import (
+    fit_palerm_insulin_curves,
+    fit_cescon_carb_curves,
+    fit_least_squares,
+)
+from tidepool_data_science_models.models.treatment_models import get_palerm_bg_jacobian, get_cescon_bg_jacobian
+from tidepool_data_science_models.utils import EPSILON_TEST
+
+
+def test_fit_palerm_insulin_curves_recovers_parameters():
+    """
+    Do the fitted parameters match the ones that generated each patient's curve?
+    """
+    rng = np.random.RandomState(0)
+    num_patients = 200
+
+    t = np.arange(0, 8 * 60, 5)
+    isfs = rng.uniform(20, 150, num_patients)
+    tau1s = rng.uniform(40, 65, num_patients)
+    tau2s = rng.uniform(75, 100, num_patients)
+    insulin_amounts = rng.uniform(0.5, 5, num_patients)
+
+    observed_bg, _ = get_palerm_bg_jacobian(
+        t, insulin_amounts[:, np.newaxis], isfs[:, np.newaxis], tau1s[:, np.newaxis], tau2s[:, np.newaxis], 1.0
+    )
+
+    parameters, residual_sum_of_squares, converged, stalled = fit_palerm_insulin_curves(
+        t, observed_bg, insulin_amounts
+    )
+
+    assert np.all(converged)
+    assert not np.any(stalled)
+    assert np.max(residual_sum_of_squares) < EPSILON_TEST
+    assert np.max(np.abs(parameters["isf"] - isfs)) < EPSILON_TEST
+    assert np.max(np.abs(parameters["tau1"] - tau1s)) < EPSILON_TEST
+    assert np.max(np.abs(parameters["tau2"] - tau2s)) < EPSILON_TEST
+    assert np.array_equal(parameters["kcl"], np.ones(num_patients))
+
+
+def test_fit_cescon_carb_curves_with_missing_readings():
+
+    rng = np.random.RandomState(1)
+    num_patients = 200
+
+    t = np.arange(0, 8 * 60, 5)
+    isfs = rng.uniform(20, 150, num_patients)
+    taus = rng.uniform(25, 60, num_patients)
+    thetas = rng.uniform(5, 35, num_patients)
+    carb_amounts = rng.uniform(10, 80, num_patients)
+
+    observed_bg, _ = get_cescon_bg_jacobian(
+        t, carb_amounts[:, np.newaxis], isfs[:, np.newaxis], 10, taus[:, np.newaxis], thetas[:, np.newaxis]
+    )
+    observed_bg[:, ::7] = np.nan
+
+    parameters, _, converged, stalled = fit_cescon_carb_curves(t, observed_bg, carb_amounts, cirs=10)
+
+    assert np.all(converged)
+    assert not np.any(stalled)
+    assert np.max(np.abs(parameters["isf"] - isfs)) < EPSILON_TEST
+    assert np.max(np.abs(parameters["tau"] - taus)) < EPSILON_TEST
+    assert np.max(np.abs(parameters["theta"] - thetas)) < EPSILON_TEST
+
+
+def test_fit_holds_other_parameters_fixed():
+
+    t = np.arange(0, 8 * 60, 5)
+    observed_bg, _ = get_palerm_bg_jacobian(t, 2.0, 60.0, 55.0, 85.0, 1.0)
+
+    parameters, _, _, _ = fit_palerm_insulin_curves(
+        t, observed_bg[np.newaxis, :], 2.0, initial_parameters={"isf": 50.0}, fit_parameters=("tau2",)
+    )
+    assert parameters["isf"][0] == 50.0
+    assert parameters["tau1"][0] == 55.0
+
+    with pytest.raises(ValueError):
+        fit_palerm_insulin_curves(t, observed_bg[np.newaxis, :], 2.0, fit_parameters=("theta",))
+
+
+def test_fit_reports_stalled_patients():
+    """
+    Is a patient that no step can improve reported as stalled rather than converged?
+    """
+    t = np.arange(0, 60, 5.0)
+
+    def get_bg_jacobian(parameters):
+        bg = parameters[:, [0]] * t
+        # The first patient's jacobian points the wrong way, so every step makes its fit worse
+        jacobian = np.where(np.arange(len(parameters))[:, np.newaxis] == 0, -t, t)
+        return bg, jacobian[..., np.newaxis]
+
+    observed_bg = np.array([2.0 * t, 3.0 * t])
+    parameters, residual_sum_of_squares, converged, stalled = fit_least_squares(
+        get_bg_jacobian, observed_bg, np.ones((2, 1)), [0], np.array([-np.inf])
+    )
+
+    assert np.array_equal(converged, [False, True])
+    assert np.array_equal(stalled, [True, False])
+    assert parameters[0, 0] == 1.0 and residual_sum_of_squares[0] > 0
+    assert abs(parameters[1, 0] - 3.0) < EPSILON_TEST
@@ -0,0 +1,100 @@
+"""
+Testing the precomputed response surface tables.
+"""
+import numpy as np
+import pytest
+
+from tidepool_data_science_models.models.response_surface import ResponseSurfaceTable
+from tidepool_data_science_models.models.simple_metabolism_model import SimpleMetabolismModel
+from tidepool_data_science_models.models.treatment_models import PalermInsulinModel, CesconCarbModel
+from tidepool_data_science_models.utils import EPSILON_TEST
+
+
+def test_response_surface_matches_run_batch():
+    """
+    Does a table at the default kinetics match SimpleMetabolismModel.run_batch?
+    """
+    table = ResponseSurfaceTable.build(num_hours=8)
+
+    carb_amounts = np.array([0.0, 10.0, 30.0, 45.0])
+    insulin_amounts = np.array([1.0, np.nan, 0.0, -0.5])
+    isfs = np.array([100, 50, 75, 20])
+    cirs = np.array([10, 12, 8, 5])
+
+    delta_bg, t, insulin, iob = table.query(carb_amounts, insulin_amounts, isfs=isfs, cirs=cirs)
+
+    smm = SimpleMetabolismModel(insulin_sensitivity_factor=100, carb_insulin_ratio=10)
+    delta_bg_batch, t_batch, insulin_batch, iob_batch = smm.run_batch(
+        carb_amounts, insulin_amounts, isfs=isfs, cirs=cirs, num_hours=8
+    )
+
+    assert np.array_equal(t, t_batch)
+    assert np.array_equal(insulin, insulin_batch)
+    assert np.max(np.abs(delta_bg - delta_bg_batch)) < EPSILON_TEST
+    assert np.max(np.abs(iob - iob_batch)) < EPSILON_TEST
+
+
+def test_response_surface_interpolation_within_tolerance():
+
+    tolerance = 1e-4
+    table = ResponseSurfaceTable.build(
+        tau1_range=(40, 65), tau2_range=(70, 100), tau_range=(30, 60), theta_range=(12.5, 31), tolerance=tolerance
+    )
+
+    rng = np.random.RandomState(0)
+    num_scenarios = 50
+    tau1s = rng.uniform(40, 65, num_scenarios)
+    tau2s = rng.uniform(70, 100, num_scenarios)
+    taus = rng.uniform(30, 60, num_scenarios)
+    thetas = rng.uniform(12.5, 31, num_scenarios)
+    carb_amounts = rng.uniform(0, 80, num_scenarios)
+    insulin_amounts = rng.uniform(0, 8, num_scenarios)
+
+    delta_bg, _, _, iob = table.query(
+        carb_amounts, insulin_amounts, isfs=50, cirs=10, tau1=tau1s, tau2=tau2s, tau=taus, theta=thetas
+    )
+
+    insulin_model = PalermInsulinModel(isf=50, cir=10)
+    _, bg_delta_insulin, _, iob_exact = insulin_model.run_batch(8, insulin_amounts, tau1s=tau1s, tau2s=tau2s)
+    carb_model = CesconCarbModel(isf=50, cir=10)
+    _, bg_delta_carb, _ = carb_model.run_batch(8, carb_amounts, taus=taus, thetas=thetas)
+
+    max_bg_error = 2 * tolerance * (50 * insulin_amounts + 50 / 10 * carb_amounts)
+    bg_error = np.abs(np.cumsum(delta_bg - bg_delta_insulin - bg_delta_carb, axis=1))
+    assert np.all(bg_error <= max_bg_error[:, np.newaxis])
+    assert np.all(np.abs(iob - iob_exact) <= 2 * tolerance * insulin_amounts[:, np.newaxis])
+
+    # A single scenario gets the same curve as in a batch
+    delta_bg_single, _, _, iob_single = table.query(
+        carb_amounts[0],
+        insulin_amounts[0],
+        isfs=50,
+        cirs=10,
+        tau1=tau1s[0],
+        tau2=tau2s[0],
+        tau=taus[0],
+        theta=thetas[0],
+    )
+    assert np.max(np.abs(delta_bg_single[0] - delta_bg[0])) < EPSILON_TEST
+    assert np.max(np.abs(iob_single[0] - iob[0])) < EPSILON_TEST
+
+    with pytest.raises(ValueError):
+        table.query(30.0, tau1=30)
+
+    with pytest.raises(ValueError):
+        ResponseSurfaceTable.build(tau1_range=(50, 80), tau2_range=(70, 100))
+
+
+def test_response_surface_save_and_memory_map(tmp_path):
+
+    table = ResponseSurfaceTable.build(tau_range=(30, 60))
+    table.save(str(tmp_path))
+
+    loaded_table = ResponseSurfaceTable.load(str(tmp_path))
+    assert isinstance(loaded_table.unit_carb_absorbed, np.memmap)
+    assert not loaded_table.unit_carb_absorbed.flags.writeable
+
+    for saved_output, loaded_output in zip(
+        table.query([10.0, 40.0], tau=37.3), loaded_table.query([10.0, 40.0], tau=37.3)
+    ):
+        assert np.array_equal(saved_output, loaded_output)
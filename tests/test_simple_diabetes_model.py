@@ -1,7 +1,18 @@
 """
 Testing the functionality of the simple diabetes model.
 """
-from tidepool_data_science_models.models.simple_metabolism_model import SimpleMetabolismModel
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from tidepool_data_science_models.models.curve_cache import LRUArrayCache
+from tidepool_data_science_models.models.run_workspace import RunWorkspace
+from tidepool_data_science_models.models.simple_metabolism_model import (
+    SimpleMetabolismModel,
+)
+from tidepool_data_science_models.models.simple_metabolism_OLD import get_iob_from_sbr
+from tidepool_data_science_models.models.treatment_schedule import TreatmentSchedule
 
 from tidepool_data_science_models.utils import (
     EPSILON_TEST,
@@ -65,3 +76,450 @@ def test_insulin_onboard_from_scheduled_basal_rate():
 
         # Insulin should be mostly gone after 8 hours
         assert iob_t[-1] < INSULIN_DECAY_8HR_EPSILON
+
+        # Same as the original per pulse matrix algorithm
+        assert (
+            np.max(np.abs(iob_t - get_iob_from_sbr(scheduled_basal_rate)))
+            < EPSILON_TEST
+        )
+
+
+def test_simple_metabolism_model_run_batch():
+    """
+    Does each row of the batch output match run() for a model with that row's isf and
+    cir?
+    """
+    carb_amounts = np.array([0.0, 10.0, 10.0, 20.0, 45.0, 5.0])
+    insulin_amounts = np.array([1.0, 0.0, np.nan, 2.0, np.nan, -0.5])
+    isfs = np.array([100, 50, 75, 100, 20, 40])
+    cirs = np.array([10, 12, 8, 15, 5, 10])
+
+    smm = SimpleMetabolismModel(insulin_sensitivity_factor=100, carb_insulin_ratio=10)
+
+    for five_min in [True, False]:
+        delta_bg_batch, t_batch, insulin_batch, iob_batch = smm.run_batch(
+            carb_amounts,
+            insulin_amounts,
+            isfs=isfs,
+            cirs=cirs,
+            num_hours=8,
+            five_min=five_min,
+        )
+
+        for i in range(len(carb_amounts)):
+            scenario_smm = SimpleMetabolismModel(
+                insulin_sensitivity_factor=isfs[i], carb_insulin_ratio=cirs[i]
+            )
+            delta_bg, t, insulin_amount, iob = scenario_smm.run(
+                carb_amounts[i], insulin_amounts[i], num_hours=8, five_min=five_min
+            )
+
+            assert np.array_equal(t, t_batch)
+            assert np.max(np.abs(delta_bg - delta_bg_batch[i])) < EPSILON_TEST
+            assert insulin_amount == insulin_batch[i]
+            assert np.max(np.abs(iob - iob_batch[i])) < EPSILON_TEST
+
+    with pytest.raises(ValueError):
+        smm.run_batch([10.0, -1.0])
+
+
+def test_simple_metabolism_model_multi_day():
+    """
+    Does a 10 day run, the iCGM sensor life, match the 24 hour run and stay settled
+    afterwards?
+    """
+    smm = SimpleMetabolismModel(insulin_sensitivity_factor=100, carb_insulin_ratio=10)
+
+    num_hours = 10 * 24
+    for five_min in [True, False]:
+        delta_bg_day, _, _, iob_day = smm.run(
+            carb_amount=30.0, insulin_amount=2.0, num_hours=24, five_min=five_min
+        )
+        delta_bg, t, insulin_amount, iob = smm.run(
+            carb_amount=30.0, insulin_amount=2.0, num_hours=num_hours, five_min=five_min
+        )
+
+        steps_per_hour = 12 if five_min else 60
+        assert len(t) == len(delta_bg) == len(iob) == num_hours * steps_per_hour
+        assert np.array_equal(t[-2:] - t[-1], [-60 // steps_per_hour, 0])
+
+        assert np.array_equal(delta_bg[: len(delta_bg_day)], delta_bg_day)
+        assert np.array_equal(iob[: len(iob_day)], iob_day)
+        assert np.max(np.abs(iob[len(iob_day) :])) < EPSILON_TEST
+        assert np.max(np.abs(delta_bg[len(delta_bg_day) :])) < EPSILON_TEST
+
+        delta_bg_batch, t_batch, _, iob_batch = smm.run_batch(
+            [30.0], [2.0], num_hours=num_hours, five_min=five_min
+        )
+        assert np.array_equal(t_batch, t)
+        assert np.max(np.abs(delta_bg_batch[0] - delta_bg)) < EPSILON_TEST
+        assert np.max(np.abs(iob_batch[0] - iob)) < EPSILON_TEST
+
+    # No treatment is a flat response rather than an error
+    delta_bg, t, _, iob = smm.run(
+        carb_amount=0.0, insulin_amount=0.0, num_hours=num_hours
+    )
+    assert len(t) == num_hours * 12
+    assert not np.any(delta_bg) and not np.any(iob)
+
+
+def test_simple_metabolism_model_run_summary():
+    """
+    Do chunked summaries match reducing the full run_batch output?
+    """
+    rng = np.random.RandomState(0)
+    num_scenarios = 53
+    carb_amounts = rng.uniform(0, 80, num_scenarios)
+    insulin_amounts = np.where(
+        rng.uniform(size=num_scenarios) < 0.5, np.nan, rng.uniform(0, 8, num_scenarios)
+    )
+    isfs = rng.uniform(20, 150, num_scenarios)
+    bg_thresholds = rng.uniform(-100, -10, num_scenarios)
+
+    smm = SimpleMetabolismModel(insulin_sensitivity_factor=100, carb_insulin_ratio=10)
+
+    summaries = smm.run_summary(
+        carb_amounts,
+        insulin_amounts,
+        isfs=isfs,
+        cirs=12,
+        bg_threshold=bg_thresholds,
+        chunk_size=10,
+    )
+
+    delta_bg, t, _, iob = smm.run_batch(
+        carb_amounts, insulin_amounts, isfs=isfs, cirs=12
+    )
+    bg = np.cumsum(delta_bg, axis=1)
+
+    assert np.max(np.abs(summaries["min_bg"] - np.min(bg, axis=1))) < EPSILON_TEST
+    assert np.max(np.abs(summaries["max_bg"] - np.max(bg, axis=1))) < EPSILON_TEST
+    assert np.array_equal(summaries["time_to_nadir"], t[np.argmin(bg, axis=1)])
+    assert np.array_equal(
+        summaries["time_below_threshold"],
+        5 * np.sum(bg < bg_thresholds[:, np.newaxis], axis=1),
+    )
+    assert np.max(np.abs(summaries["final_iob"] - iob[:, -1])) < EPSILON_TEST
+
+    # Custom summaries
+    def get_bg_at_4_hours(bg, iob, t_min, bg_threshold):
+        return bg[:, t_min == 240][:, 0]
+
+    custom_summaries = smm.run_summary(
+        carb_amounts, summaries={"bg_at_4_hours": get_bg_at_4_hours}
+    )
+    assert list(custom_summaries) == ["bg_at_4_hours"]
+    assert custom_summaries["bg_at_4_hours"].shape == (num_scenarios,)
+
+
+def test_simple_metabolism_model_run_summary_memory_is_flat():
+
+    smm = SimpleMetabolismModel(insulin_sensitivity_factor=100, carb_insulin_ratio=10)
+    chunk_size = 1000
+
+    peak_memory = []
+    for num_scenarios in [10 * chunk_size, 100 * chunk_size]:
+        carb_amounts = np.full(num_scenarios, 30.0)
+        tracemalloc.start()
+        smm.run_summary(carb_amounts, summaries=("min_bg",), chunk_size=chunk_size)
+        peak_memory.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    # Only the (n_scenarios,) inputs and outputs grow with the sweep
+    assert peak_memory[1] - peak_memory[0] < 90 * chunk_size * 8 * 4
+
+
+def test_simple_metabolism_model_run_with_workspace():
+
+    smm = SimpleMetabolismModel(insulin_sensitivity_factor=100, carb_insulin_ratio=10)
+    workspace = RunWorkspace(num_hours=48, five_min=False)
+
+    for carb_amount, insulin_amount, num_hours in [
+        (30.0, 3.0, 48),
+        (0.0, 1.0, 8),
+        (45.0, 0.0, 24),
+        (0.0, 0.0, 2),
+    ]:
+        expected = smm.run(
+            carb_amount, insulin_amount, num_hours=num_hours, five_min=False
+        )
+        results = smm.run(
+            carb_amount,
+            insulin_amount,
+            num_hours=num_hours,
+            five_min=False,
+            workspace=workspace,
+        )
+        assert all(
+            np.array_equal(result, value) for result, value in zip(results, expected)
+        )
+
+        out = (np.empty(num_hours * 60), np.empty(num_hours * 60))
+        results = smm.run(
+            carb_amount, insulin_amount, num_hours=num_hours, five_min=False, out=out
+        )
+        assert results[0] is out[0] and results[3] is out[1]
+        assert all(
+            np.array_equal(result, value) for result, value in zip(results, expected)
+        )
+
+    # Cached results are copied into the buffers
+    smm.run_cache = LRUArrayCache(max_bytes=2 ** 20)
+    results = smm.run(30.0, 3.0, num_hours=8, five_min=False, workspace=workspace)
+    expected = smm.run(30.0, 3.0, num_hours=8, five_min=False)
+    assert results[0].base is workspace.combined_delta_bg
+    assert all(
+        np.array_equal(result, value) for result, value in zip(results, expected)
+    )
+
+
+def test_simple_metabolism_model_run_with_workspace_does_not_allocate():
+
+    smm = SimpleMetabolismModel(insulin_sensitivity_factor=100, carb_insulin_ratio=10)
+    num_steps = 24 * 60
+
+    peak_memory = []
+    for workspace in [RunWorkspace(num_hours=24, five_min=False), None]:
+        smm.run(30.0, 3.0, num_hours=24, five_min=False, workspace=workspace)
+        tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        for _ in range(10):
+            smm.run(30.0, 3.0, num_hours=24, five_min=False, workspace=workspace)
+        peak_memory.append(tracemalloc.get_traced_memory()[1] - memory_before)
+        tracemalloc.stop()
+
+    # Only interpreter overhead with the workspace, each allocated run makes several
+    # arrays
+    assert peak_memory[0] < num_steps * 8
+    assert peak_memory[1] > num_steps * 8 * 4
+
+
+def test_simple_metabolism_model_float32():
+
+    smm_64 = SimpleMetabolismModel(
+        insulin_sensitivity_factor=100, carb_insulin_ratio=10
+    )
+    smm_32 = SimpleMetabolismModel(
+        insulin_sensitivity_factor=100, carb_insulin_ratio=10, dtype=np.float32
+    )
+
+    rng = np.random.default_rng(0)
+    num_scenarios = 1000
+    carb_amounts = rng.uniform(0, 100, num_scenarios)
+    isfs = rng.uniform(20, 150, num_scenarios)
+    cirs = rng.uniform(5, 20, num_scenarios)
+
+    delta_bg_64, _, _, iob_64 = smm_64.run_batch(
+        carb_amounts, isfs=isfs, cirs=cirs, num_hours=24
+    )
+    delta_bg_32, _, _, iob_32 = smm_32.run_batch(
+        carb_amounts, isfs=isfs, cirs=cirs, num_hours=24
+    )
+
+    assert delta_bg_32.dtype == iob_32.dtype == np.float32
+    assert delta_bg_32.nbytes == delta_bg_64.nbytes // 2
+
+    # bg summed in float32 stays within 1e-5 of the bg range, i.e. hundredths of a mg/dL
+    bg_64 = np.cumsum(delta_bg_64, axis=1)
+    assert np.max(np.abs(bg_64 - np.cumsum(delta_bg_32, axis=1))) < 1e-5 * np.max(
+        np.abs(bg_64)
+    )
+    assert np.max(np.abs(iob_64 - iob_32)) < 1e-5 * np.max(iob_64)
+
+    summaries_64 = smm_64.run_summary(
+        carb_amounts, isfs=isfs, cirs=cirs, chunk_size=300
+    )
+    summaries_32 = smm_32.run_summary(
+        carb_amounts, isfs=isfs, cirs=cirs, chunk_size=300
+    )
+    assert (
+        np.max(np.abs(summaries_64["min_bg"] - summaries_32["min_bg"]))
+        < EPSILON_TEST * 100
+    )
+    assert np.array_equal(summaries_64["time_to_nadir"], summaries_32["time_to_nadir"])
+
+    for results_64, results_32 in [
+        (smm_64.run(30.0, 3.0, num_hours=48), smm_32.run(30.0, 3.0, num_hours=48)),
+        (
+            smm_64.run(30.0, 3.0, workspace=RunWorkspace()),
+            smm_32.run(30.0, 3.0, workspace=RunWorkspace(dtype=np.float32)),
+        ),
+    ]:
+        assert results_32[0].dtype == results_32[3].dtype == np.float32
+        assert np.max(np.abs(results_64[0] - results_32[0])) < EPSILON_TEST * 10
+        assert np.max(np.abs(results_64[3] - results_32[3])) < EPSILON_TEST
+
+
+def test_solve_bolus_reaches_target():
+    """
+    Does running the model with the solved bolus bring each patient's bg to the target?
+    """
+    starting_bgs = np.array([150.0, 120.0, 100.0, 250.0])
+    target_bgs = np.array([110.0, 110.0, 110.0, 100.0])
+    carb_amounts = np.array([30.0, 0.0, 0.0, 60.0])
+    isfs = np.array([50, 100, 80, 40])
+    cirs = np.array([10, 12, 8, 15])
+
+    smm = SimpleMetabolismModel(insulin_sensitivity_factor=100, carb_insulin_ratio=10)
+
+    for five_min, target_time in [(True, None), (True, 180), (False, 121)]:
+        boluses = smm.solve_bolus(
+            starting_bgs,
+            target_bgs,
+            carb_amounts,
+            isfs=isfs,
+            cirs=cirs,
+            target_time=target_time,
+            five_min=five_min,
+        )
+
+        for i in range(len(boluses)):
+            patient_smm = SimpleMetabolismModel(
+                insulin_sensitivity_factor=isfs[i], carb_insulin_ratio=cirs[i]
+            )
+            delta_bg, t, _, _ = patient_smm.run(
+                carb_amounts[i], boluses[i], five_min=five_min
+            )
+            target_index = -1 if target_time is None else list(t).index(target_time)
+            assert (
+                abs(starting_bgs[i] + np.cumsum(delta_bg)[target_index] - target_bgs[i])
+                < EPSILON_TEST
+            )
+
+    with pytest.raises(ValueError):
+        smm.solve_bolus(150, 110, 30, target_time=12)
+
+
+def test_solve_bolus_with_temp_basal():
+
+    smm = SimpleMetabolismModel(insulin_sensitivity_factor=100, carb_insulin_ratio=10)
+
+    starting_bgs = np.array([100.0, 180.0, 60.0])
+    boluses, temp_basal_adjustments = smm.solve_bolus(
+        starting_bgs,
+        110,
+        0,
+        target_time=240,
+        temp_basal_duration=120,
+        basal_rates=[1.0, 1.0, 0.1],
+    )
+
+    # Too much insulin is corrected with a temp basal reduction, limited by the
+    # scheduled basal
+    assert boluses[0] == 0 and temp_basal_adjustments[0] < 0
+    assert boluses[1] > 0 and temp_basal_adjustments[1] == 0
+    assert boluses[2] == 0 and temp_basal_adjustments[2] == -0.1
+
+    for i in range(2):
+        schedule = TreatmentSchedule(
+            bolus_times=[0],
+            bolus_amounts=[boluses[i]],
+            basal_start_times=[0, 120],
+            basal_rates=[temp_basal_adjustments[i], 0.0],
+        )
+        delta_bg, _, _ = smm.run_at_times([0, 240], schedule)
+        assert abs(starting_bgs[i] + np.sum(delta_bg) - 110) < EPSILON_TEST
+
+
+def test_simple_metabolism_model_run_cache():
+    """
+    Do duplicated scenarios come from the cache, read-only and equal to uncached runs?
+    """
+    run_cache = LRUArrayCache(max_bytes=1024 * 1024)
+    smm = SimpleMetabolismModel(
+        insulin_sensitivity_factor=100, carb_insulin_ratio=10, run_cache=run_cache
+    )
+    uncached_smm = SimpleMetabolismModel(
+        insulin_sensitivity_factor=100, carb_insulin_ratio=10
+    )
+
+    scenarios = [(30.0, np.nan), (30.0, 3.0), (10.0, 2.0), (30.0, np.nan), (10.0, 2.0)]
+    for carb_amount, insulin_amount in scenarios:
+        delta_bg, t, insulin, iob = smm.run(carb_amount, insulin_amount)
+        (
+            delta_bg_uncached,
+            t_uncached,
+            insulin_uncached,
+            iob_uncached,
+        ) = uncached_smm.run(carb_amount, insulin_amount)
+
+        assert np.array_equal(delta_bg, delta_bg_uncached)
+        assert np.array_equal(t, t_uncached)
+        assert insulin == insulin_uncached
+        assert np.array_equal(iob, iob_uncached)
+        assert not delta_bg.flags.writeable and not iob.flags.writeable
+
+    # 30 g with the insulin computed from carbs is the same scenario as 30 g with 3 U
+    stats = run_cache.get_stats()
+    assert stats["misses"] == 2
+    assert stats["hits"] == 3
+    assert stats["hit_rate"] == 3 / 5
+
+    # The cache is shared by models with different settings without collisions
+    other_smm = SimpleMetabolismModel(
+        insulin_sensitivity_factor=50, carb_insulin_ratio=10, run_cache=run_cache
+    )
+    delta_bg_other, _, _, _ = other_smm.run(30.0, 3.0)
+    assert not np.array_equal(delta_bg_other, smm.run(30.0, 3.0)[0])
+    assert run_cache.get_stats()["misses"] == 3
+
+    # The memory budget is kept by evicting least recently used results, 3 arrays of
+    # 96 steps each
+    small_cache = LRUArrayCache(max_bytes=3 * 3 * 96 * 8)
+    small_cache_smm = SimpleMetabolismModel(
+        insulin_sensitivity_factor=100, carb_insulin_ratio=10, run_cache=small_cache
+    )
+    for carb_amount in range(10):
+        small_cache_smm.run(float(carb_amount))
+    assert len(small_cache) == 3
+    assert small_cache.get_stats()["evictions"] == 7
+
+
+def test_insulin_onboard_from_scheduled_basal_rate_options():
+    isf = 100
+    cir = 10
+
+    smm = SimpleMetabolismModel(
+        insulin_sensitivity_factor=isf,
+        carb_insulin_ratio=cir,
+        insulin_model_name="palerm",
+        carb_model_name="cescon",
+    )
+
+    # Many basal rates at once match one at a time
+    scheduled_basal_rates = np.array([0.1, 0.5, 1.0, 2.0, 5.0, 10.0])
+    iob_t_all = smm.get_iob_from_sbr(scheduled_basal_rates)
+    assert iob_t_all.shape == (len(scheduled_basal_rates), 8 * 60 / 5)
+    for scheduled_basal_rate, iob_t in zip(scheduled_basal_rates, iob_t_all):
+        assert (
+            np.max(np.abs(iob_t - smm.get_iob_from_sbr(scheduled_basal_rate)))
+            < EPSILON_TEST
+        )
+
+    steady_state_iob = smm.get_steady_state_iob_from_sbr(
+        scheduled_basal_rates, use_fda_submission_constant=False
+    )
+    assert (
+        np.max(
+            np.abs(
+                steady_state_iob - scheduled_basal_rates * STEADY_STATE_IOB_FACTOR_FDA
+            )
+        )
+        < EPSILON_TEST
+    )
+
+    # More time before t0 doesn't change the steady state since the curve has decayed
+    iob_t_long = smm.get_iob_from_sbr(1.0, num_hours_pre_t0=12, num_hours_post_t0=4)
+    assert len(iob_t_long) == 4 * 60 / 5
+    assert abs(iob_t_long[0] - STEADY_STATE_IOB_FACTOR_FDA) < INSULIN_DECAY_8HR_EPSILON
+
+    # Shorter time after t0 is the start of the default
+    iob_t_short = smm.get_iob_from_sbr(1.0, num_hours_post_t0=2)
+    assert np.max(np.abs(iob_t_short - smm.get_iob_from_sbr(1.0)[:24])) < EPSILON_TEST
+
+    # Other pump pulse intervals deliver the same insulin per hour
+    for minutes_per_pump_pulse in [1, 3, 10]:
+        iob_t = smm.get_iob_from_sbr(1.0, minutes_per_pump_pulse=minutes_per_pump_pulse)
+        assert len(iob_t) == 8 * 60 / minutes_per_pump_pulse
+        assert abs(iob_t[0] - STEADY_STATE_IOB_FACTOR_FDA) < 0.1
+        assert iob_t[-1] < INSULIN_DECAY_8HR_EPSILON
@@ -82,7 +82,11 @@ def test_simple_metabolism_model_class_iob_sbr():
     for sbr in [0, 0.1, 1.0, 10.0]:
         iob_t_class = smm.get_iob_from_sbr(sbr)
         iob_t_func = get_iob_from_sbr(sbr)
-        assert np.array_equal(iob_t_class, iob_t_func)
+
+        # The class scales one 1 U curve by the basal rate instead of summing a curve per
+        # pulse amount, so results match to floating point precision rather than bit for bit
+        assert iob_t_class.shape == iob_t_func.shape
+        assert np.max(np.abs(iob_t_class - iob_t_func)) < EPSILON_TEST
 
 
 def test_simple_metabolism_model_class_iob_steady_state():
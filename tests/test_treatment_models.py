@@ -0,0 +1,483 @@
+"""
+Testing the functionality of the insulin and carb treatment models.
+"""
+import numpy as np
+import pytest
+
+from tidepool_data_science_models.models.curve_cache import LRUArrayCache, UNIT_RESPONSE_CACHE
+from tidepool_data_science_models.models.run_workspace import RunWorkspace
+from tidepool_data_science_models.models.treatment_models import (
+    PalermInsulinModel,
+    CesconCarbModel,
+    get_palerm_bg_jacobian,
+    get_cescon_bg_jacobian,
+)
+from tidepool_data_science_models.utils import EPSILON_TEST
+
+
+def test_palerm_run_batch_matches_run():
+    """
+    Does each row of the batch output match the scalar run with the same parameters?
+    """
+    insulin_amounts = np.array([0.0, 0.5, 1.0, 2.0, 10.0, -1.0])
+    isfs = np.array([100, 50, 75, 100, 20, 40])
+    tau1s = np.array([55, 40, 55, 60, 55, 50])
+    tau2s = np.array([70, 70, 80, 90, 70, 65])
+
+    for five_min in [True, False]:
+        model = PalermInsulinModel(isf=100, cir=10)
+        t_batch, bg_delta_batch, bg_batch, iob_batch = model.run_batch(
+            num_hours=8, insulin_amounts=insulin_amounts, isfs=isfs, tau1s=tau1s, tau2s=tau2s, five_min=five_min
+        )
+
+        assert bg_batch.shape == (len(insulin_amounts), len(t_batch))
+
+        for i, insulin_amount in enumerate(insulin_amounts):
+            scenario_model = PalermInsulinModel(isf=isfs[i], cir=10, tau1=tau1s[i], tau2=tau2s[i])
+            t, bg_delta, bg, iob = scenario_model.run(num_hours=8, insulin_amount=insulin_amount, five_min=five_min)
+
+            assert np.array_equal(t, t_batch)
+            assert np.array_equal(bg_delta, bg_delta_batch[i])
+            assert np.array_equal(bg, bg_batch[i])
+            assert np.array_equal(iob, iob_batch[i])
+
+
+def test_palerm_run_batch_defaults_to_model_parameters():
+
+    model = PalermInsulinModel(isf=100, cir=10)
+    _, _, bg_batch, iob_batch = model.run_batch(num_hours=8, insulin_amounts=[1.0, 2.0])
+    _, _, bg, iob = model.run(num_hours=8, insulin_amount=2.0)
+
+    assert np.max(np.abs(bg_batch[1] - bg)) < EPSILON_TEST
+    assert np.max(np.abs(iob_batch[1] - iob)) < EPSILON_TEST
+
+
+def test_palerm_run_batch_bad_parameter_shape():
+
+    model = PalermInsulinModel(isf=100, cir=10)
+
+    with pytest.raises(ValueError):
+        model.run_batch(num_hours=8, insulin_amounts=[1.0, 2.0], isfs=[100, 50, 25])
+
+
+def test_palerm_run_at_times_matches_run():
+    """
+    Does the closed form evaluation match the 1 minute grid in run() at regular times?
+    """
+    model = PalermInsulinModel(isf=100, cir=10)
+
+    for five_min in [True, False]:
+        for insulin_amount in [0.5, 1.0, 10.0]:
+            t, bg_delta, bg, iob = model.run(num_hours=24, insulin_amount=insulin_amount, five_min=five_min)
+            t_closed, bg_delta_closed, bg_closed, iob_closed = model.run_at_times(t, insulin_amount=insulin_amount)
+
+            assert np.array_equal(t, t_closed)
+            assert np.max(np.abs(bg - bg_closed)) < EPSILON_TEST
+            assert np.max(np.abs(bg_delta - bg_delta_closed)) < EPSILON_TEST
+            assert np.max(np.abs(iob - iob_closed)) < EPSILON_TEST
+
+
+def test_palerm_run_at_times_irregular():
+
+    model = PalermInsulinModel(isf=100, cir=10)
+    t_irregular = np.array([-3.0, 0.0, 4.2, 9.7, 15.1, 31.0, 122.5, 480.0])
+
+    t, bg_delta, bg, iob = model.run_at_times(t_irregular, insulin_amount=1.0)
+    _, _, bg_minute, iob_minute = model.run(num_hours=9, insulin_amount=1.0, five_min=False)
+
+    # No effect before the insulin is given
+    assert bg[0] == 0 and iob[0] == 1.0
+
+    # Between whole minutes the curve stays within its neighbors
+    assert bg_minute[5] <= bg[2] <= bg_minute[4]
+    assert iob_minute[123] <= iob[6] <= iob_minute[122]
+    assert abs(iob[-1] - iob_minute[480]) < EPSILON_TEST
+    assert np.all(np.diff(bg) <= 0)
+
+
+def test_unit_response_scales_to_run():
+    """
+    Are the models linear in the dose so that the cached unit curves scale to run()?
+    """
+    UNIT_RESPONSE_CACHE.clear()
+
+    insulin_model = PalermInsulinModel(isf=100, cir=10)
+    carb_model = CesconCarbModel(isf=100, cir=10)
+
+    _, unit_bg_delta, unit_bg, unit_iob = insulin_model.get_unit_response(num_hours=8)
+    _, bg_delta, bg, iob = insulin_model.run(num_hours=8, insulin_amount=3.0)
+    assert np.max(np.abs(3.0 * unit_bg - bg)) < EPSILON_TEST
+    assert np.max(np.abs(3.0 * unit_iob - iob)) < EPSILON_TEST
+
+    _, unit_bg_delta, unit_bg = carb_model.get_unit_response(num_hours=8)
+    _, bg_delta, bg = carb_model.run(num_hours=8, carb_amount=30.0)
+    assert np.max(np.abs(30.0 * unit_bg - bg)) < EPSILON_TEST
+
+    # Shared curves can't be modified by callers
+    with pytest.raises(ValueError):
+        unit_bg[0] = 1.0
+
+    # Same parameters hit, different parameters miss
+    stats_before = UNIT_RESPONSE_CACHE.get_stats()
+    CesconCarbModel(isf=100, cir=10).get_unit_response(num_hours=8)
+    stats_after = UNIT_RESPONSE_CACHE.get_stats()
+    assert stats_after["hits"] == stats_before["hits"] + 1
+    assert stats_after["misses"] == stats_before["misses"]
+
+    CesconCarbModel(isf=100, cir=10, tau=30).get_unit_response(num_hours=8)
+    assert UNIT_RESPONSE_CACHE.get_stats()["misses"] > stats_after["misses"]
+
+
+def test_lru_array_cache_eviction():
+
+    cache = LRUArrayCache(max_bytes=3 * 8 * 100)
+
+    for key in range(3):
+        cache.get_or_compute(key, lambda: np.zeros(100))
+    assert len(cache) == 3
+
+    # Touch 0 so 1 is the least recently used
+    cache.get_or_compute(0, lambda: np.ones(100))
+    cache.get_or_compute(3, lambda: np.zeros(100))
+
+    stats = cache.get_stats()
+    assert stats == {
+        "hits": 1,
+        "misses": 4,
+        "hit_rate": 1 / 5,
+        "evictions": 1,
+        "num_entries": 3,
+        "num_bytes": 3 * 8 * 100,
+        "max_bytes": 3 * 8 * 100,
+    }
+
+    # 1 was evicted, 0 is still the original value
+    assert np.all(cache.get_or_compute(1, lambda: np.ones(100)) == 1)
+    assert np.all(cache.get_or_compute(0, lambda: np.ones(100)) == 0)
+
+    # Values over budget are returned but not cached
+    too_big = cache.get_or_compute("big", lambda: np.zeros(1000))
+    assert len(too_big) == 1000
+    assert cache.get_stats()["num_bytes"] <= cache.max_bytes
+
+
+def test_palerm_stepper_matches_run():
+    """
+    Does stepping a dose through the state-space model match run()?
+    """
+    model = PalermInsulinModel(isf=100, cir=10)
+
+    for five_min in [True, False]:
+        _, bg_delta, _, iob = model.run(num_hours=8, insulin_amount=2.0, five_min=five_min)
+        doses = np.zeros(len(iob) - 1)
+        doses[0] = 2.0
+
+        stepper = model.get_stepper(five_min=five_min)
+        stepped = np.array([stepper.step(dose) for dose in doses])
+
+        # Step k ends at time k + 1 of run()
+        assert np.max(np.abs(stepped[:, 0] - bg_delta[1:])) < EPSILON_TEST
+        assert np.max(np.abs(stepped[:, 1] - iob[1:])) < EPSILON_TEST
+
+        stepper.init_state()
+        bg_delta_many, iob_many = stepper.step_many(doses)
+        assert np.max(np.abs(bg_delta_many - bg_delta[1:])) < EPSILON_TEST
+        assert np.max(np.abs(iob_many - iob[1:])) < EPSILON_TEST
+
+
+def test_palerm_stepper_step_many_continues_state():
+
+    model = PalermInsulinModel(isf=50, cir=10, tau1=45, tau2=80)
+    doses = np.zeros(200)
+    doses[[0, 10, 11, 50, 120]] = [1.0, 0.5, 0.25, 3.0, 1.0]
+
+    stepper = model.get_stepper()
+    stepped = np.array([stepper.step(dose) for dose in doses])
+    compartments = stepper.compartments.copy()
+
+    # Split the doses across calls, each one picks up where the last left off
+    stepper.init_state()
+    bg_delta_first, iob_first = stepper.step_many(doses[:37])
+    bg_delta_second, iob_second = stepper.step_many(doses[37:])
+
+    assert np.max(np.abs(np.append(bg_delta_first, bg_delta_second) - stepped[:, 0])) < EPSILON_TEST
+    assert np.max(np.abs(np.append(iob_first, iob_second) - stepped[:, 1])) < EPSILON_TEST
+    assert np.max(np.abs(stepper.compartments - compartments)) < EPSILON_TEST
+
+
+def test_cescon_stepper_matches_run():
+    """
+    Does stepping carbs through the dead time buffer and absorption state match run()?
+    """
+    for theta in [0, 5, 20, 22.5]:
+        model = CesconCarbModel(isf=100, cir=10, theta=theta)
+
+        for five_min in [True, False]:
+            _, bg_delta, _ = model.run(num_hours=8, carb_amount=30.0, five_min=five_min)
+            carbs = np.zeros(len(bg_delta) - 1)
+            carbs[0] = 30.0
+
+            stepper = model.get_stepper(five_min=five_min)
+            stepped = np.array([stepper.step(carb_amount) for carb_amount in carbs])
+            assert np.max(np.abs(stepped - bg_delta[1:])) < EPSILON_TEST
+
+            stepper.init_state()
+            assert np.max(np.abs(stepper.step_many(carbs) - bg_delta[1:])) < EPSILON_TEST
+
+
+def test_cescon_stepper_many_meals():
+
+    model = CesconCarbModel(isf=40, cir=12, tau=35, theta=17)
+    carbs = np.zeros(300)
+    carbs[[0, 1, 3, 50, 51, 140, 290]] = [10.0, 20.0, 5.0, 60.0, 15.0, 45.0, 30.0]
+
+    stepper = model.get_stepper()
+    stepped = np.array([stepper.step(carb_amount) for carb_amount in carbs])
+
+    # Superposition of shifted single meals
+    _, unit_bg_delta, _ = model.run(num_hours=len(carbs) * 5 / 60, carb_amount=1.0)
+    expected = np.convolve(carbs, unit_bg_delta[1:])[: len(carbs)]
+    assert np.max(np.abs(stepped - expected)) < EPSILON_TEST
+
+    # Split across calls, carbs in the dead time carry over
+    stepper.init_state()
+    bg_delta_many = np.append(stepper.step_many(carbs[:2]), stepper.step_many(carbs[2:]))
+    assert np.max(np.abs(bg_delta_many - stepped)) < EPSILON_TEST
+
+
+def test_run_events_matches_shifted_runs():
+    """
+    Does the combined effect of doses at arbitrary times match shifting and adding run() for each dose?
+    """
+    insulin_model = PalermInsulinModel(isf=80, cir=10)
+    carb_model = CesconCarbModel(isf=80, cir=10)
+
+    t = np.arange(0, 24 * 60)
+    event_times = np.array([0, 37, 600, 601, 1200])
+    amounts = np.array([1.0, 2.5, 0.5, 1.0, 3.0])
+
+    _, bg_delta_insulin, bg_insulin, iob = insulin_model.run_events(t, event_times, amounts)
+    _, bg_delta_carb, bg_carb = carb_model.run_events(t, event_times, 10 * amounts)
+
+    expected_bg_insulin = np.zeros(len(t))
+    expected_iob = np.zeros(len(t))
+    expected_bg_carb = np.zeros(len(t))
+    for event_time, amount in zip(event_times, amounts):
+        _, _, bg, event_iob = insulin_model.run(24, insulin_amount=amount, five_min=False)
+        expected_bg_insulin[event_time:] += bg[: len(t) - event_time]
+        expected_iob[event_time:] += event_iob[: len(t) - event_time]
+
+        _, _, bg = carb_model.run(24, carb_amount=10 * amount, five_min=False)
+        expected_bg_carb[event_time:] += bg[: len(t) - event_time]
+
+    assert np.max(np.abs(bg_insulin - expected_bg_insulin)) < EPSILON_TEST
+    assert np.max(np.abs(iob - expected_iob)) < EPSILON_TEST
+    assert np.max(np.abs(bg_carb - expected_bg_carb)) < EPSILON_TEST
+    assert np.max(np.abs(np.cumsum(bg_delta_insulin) - bg_insulin)) < EPSILON_TEST
+    assert np.max(np.abs(np.cumsum(bg_delta_carb) - bg_carb)) < EPSILON_TEST
+
+
+def test_run_events_irregular_times():
+
+    insulin_model = PalermInsulinModel(isf=80, cir=10)
+    carb_model = CesconCarbModel(isf=80, cir=10)
+
+    # Jittered cgm times with a gap, and events long after the last one
+    rng = np.random.RandomState(0)
+    t = np.sort(np.concatenate([rng.uniform(0, 300, 50), rng.uniform(900, 1500, 80)]))
+    event_times = np.array([12.3, 250.9, 1000.25, 1e6])
+    amounts = np.array([1.0, 0.5, 2.0, 5.0])
+
+    _, _, bg_insulin, iob = insulin_model.run_events(t, event_times, amounts)
+    _, _, bg_carb = carb_model.run_events(t, event_times, 10 * amounts)
+
+    expected_bg_insulin = np.zeros(len(t))
+    expected_iob = np.zeros(len(t))
+    expected_bg_carb = np.zeros(len(t))
+    for event_time, amount in zip(event_times, amounts):
+        _, _, bg, event_iob = insulin_model.run_at_times(t - event_time, insulin_amount=amount)
+        expected_bg_insulin += bg
+        expected_iob += np.where(t >= event_time, event_iob, 0.0)
+        expected_bg_carb += carb_model.run_at_times(t - event_time, carb_amount=10 * amount)[2]
+
+    assert np.all(np.isfinite(bg_insulin)) and np.all(np.isfinite(bg_carb))
+    assert np.max(np.abs(bg_insulin - expected_bg_insulin)) < EPSILON_TEST
+    assert np.max(np.abs(iob - expected_iob)) < EPSILON_TEST
+    assert np.max(np.abs(bg_carb - expected_bg_carb)) < EPSILON_TEST
+
+    with pytest.raises(ValueError):
+        insulin_model.run_events(t, [0, 5], [1.0])
+
+
+def test_cescon_run_at_times_matches_run():
+
+    carb_model = CesconCarbModel(isf=80, cir=10, theta=17)
+
+    for five_min in [True, False]:
+        t, bg_delta, bg = carb_model.run(8, carb_amount=30.0, five_min=five_min)
+        t_at_times, bg_delta_at_times, bg_at_times = carb_model.run_at_times(t, carb_amount=30.0)
+
+        assert np.array_equal(t, t_at_times)
+        assert np.array_equal(bg, bg_at_times)
+        assert np.array_equal(bg_delta, bg_delta_at_times)
+
+
+def test_run_with_output_buffers():
+    """
+    Does writing into caller buffers or a workspace give exactly the allocated outputs?
+    """
+    insulin_model = PalermInsulinModel(isf=100, cir=10)
+    carb_model = CesconCarbModel(isf=100, cir=10)
+    workspace = RunWorkspace(num_hours=24, five_min=False)
+
+    for num_hours in [8, 24]:
+        expected_insulin = insulin_model.run(num_hours, insulin_amount=2.0, five_min=False)
+        expected_carb = carb_model.run(num_hours, carb_amount=30.0, five_min=False)
+
+        out = tuple(np.empty(num_hours * 60) for _ in range(3))
+        insulin = insulin_model.run(num_hours, insulin_amount=2.0, five_min=False, out=out)
+        assert all(result is buffer for result, buffer in zip(insulin[1:], out))
+
+        carb_out = (np.empty(num_hours * 60), np.empty(num_hours * 60))
+
+        for results, expected in [
+            (insulin, expected_insulin),
+            (insulin_model.run(num_hours, insulin_amount=2.0, five_min=False, workspace=workspace), expected_insulin),
+            (carb_model.run(num_hours, carb_amount=30.0, five_min=False, out=carb_out), expected_carb),
+            (carb_model.run(num_hours, carb_amount=30.0, five_min=False, workspace=workspace), expected_carb),
+        ]:
+            assert all(np.array_equal(result, value) for result, value in zip(results, expected))
+
+    with pytest.raises(ValueError):
+        insulin_model.run(8, insulin_amount=2.0, out=(np.empty(10), np.empty(10), np.empty(10)))
+
+    # The workspace is for 1 minute runs up to 24 hours
+    with pytest.raises(ValueError):
+        carb_model.run(8, carb_amount=30.0, five_min=True, workspace=workspace)
+
+    with pytest.raises(ValueError):
+        carb_model.run(25, carb_amount=30.0, five_min=False, workspace=workspace)
+
+
+def get_finite_difference_jacobian(get_bg_jacobian, t, amount, parameters, step=1e-6):
+    """Central differences of the bg curve for each parameter"""
+    columns = []
+    for i in range(len(parameters)):
+        parameters_up = list(parameters)
+        parameters_down = list(parameters)
+        parameters_up[i] += step
+        parameters_down[i] -= step
+        bg_up, _ = get_bg_jacobian(t, amount, *parameters_up)
+        bg_down, _ = get_bg_jacobian(t, amount, *parameters_down)
+        columns.append((bg_up - bg_down) / (2 * step))
+    return np.column_stack(columns)
+
+
+def test_palerm_jacobian():
+    """
+    Does the analytic jacobian match finite differences, and the bg match run()?
+    """
+    model = PalermInsulinModel(isf=80, cir=10, tau1=50, tau2=75, kcl=1.2)
+    t = np.arange(-10, 8 * 60, 5)
+
+    bg, jacobian = model.get_jacobian(t, insulin_amount=2.0)
+    assert jacobian.shape == (len(t), 4)
+
+    _, _, bg_run, _ = model.run(num_hours=8, insulin_amount=2.0)
+    assert np.max(np.abs(bg[t >= 0] - bg_run)) < EPSILON_TEST
+    assert not np.any(bg[t < 0]) and not np.any(jacobian[t < 0])
+
+    finite_difference_jacobian = get_finite_difference_jacobian(get_palerm_bg_jacobian, t, 2.0, [80, 50, 75, 1.2])
+    assert np.max(np.abs(jacobian - finite_difference_jacobian)) < EPSILON_TEST * 100
+
+
+def test_cescon_jacobian():
+
+    model = CesconCarbModel(isf=80, cir=10, tau=40, theta=17)
+    t = np.arange(0, 8 * 60, 5)
+
+    bg, jacobian = model.get_jacobian(t, carb_amount=30.0)
+    assert jacobian.shape == (len(t), 4)
+
+    _, _, bg_run = model.run(num_hours=8, carb_amount=30.0)
+    assert np.max(np.abs(bg - bg_run)) < EPSILON_TEST
+
+    finite_difference_jacobian = get_finite_difference_jacobian(get_cescon_bg_jacobian, t, 30.0, [80, 10, 40, 17])
+    assert np.max(np.abs(jacobian - finite_difference_jacobian)) < EPSILON_TEST * 100
+
+
+def test_jacobian_broadcasts_over_patients():
+
+    t = np.arange(0, 8 * 60, 5)
+    isfs = np.array([[40.0], [100.0]])
+    tau1s = np.array([[50.0], [60.0]])
+
+    bg, jacobian = get_palerm_bg_jacobian(t, 1.5, isfs, tau1s, 70.0, 1.0)
+    assert bg.shape == (2, len(t))
+    assert jacobian.shape == (2, len(t), 4)
+
+    for i in range(2):
+        model = PalermInsulinModel(isf=isfs[i, 0], cir=10, tau1=tau1s[i, 0])
+        bg_patient, jacobian_patient = model.get_jacobian(t, insulin_amount=1.5)
+        assert np.max(np.abs(bg[i] - bg_patient)) < EPSILON_TEST
+        assert np.max(np.abs(jacobian[i] - jacobian_patient)) < EPSILON_TEST
+
+
+def test_float32_matches_float64():
+    """
+    How far are the float32 runs from the float64 runs? The curves are computed in float64 and rounded once,
+    or scaled once in float32, so the relative error stays below 1e-6.
+    """
+    rng = np.random.default_rng(0)
+    num_scenarios = 200
+    insulin_amounts = rng.uniform(0, 10, num_scenarios)
+    carb_amounts = rng.uniform(0, 100, num_scenarios)
+    isfs = rng.uniform(20, 150, num_scenarios)
+
+    for model_class, amounts, parameters in [
+        (PalermInsulinModel, insulin_amounts, dict(tau1s=rng.uniform(40, 60, num_scenarios))),
+        (CesconCarbModel, carb_amounts, dict(taus=rng.uniform(30, 50, num_scenarios))),
+    ]:
+        model_64 = model_class(isf=100, cir=10)
+        model_32 = model_class(isf=100, cir=10, dtype=np.float32)
+
+        for five_min in [True, False]:
+            for batch_parameters in [{}, parameters]:
+                results_64 = model_64.run_batch(8, amounts, isfs=isfs, five_min=five_min, **batch_parameters)
+                results_32 = model_32.run_batch(8, amounts, isfs=isfs, five_min=five_min, **batch_parameters)
+
+                assert np.array_equal(results_64[0], results_32[0])
+                assert_float32_close(results_64, results_32, 1e-6)
+
+            assert_float32_close(
+                model_64.run(8, amounts[0], five_min=five_min), model_32.run(8, amounts[0], five_min=five_min), 1e-6
+            )
+
+
+def test_float32_unit_response_not_shared_with_float64():
+    """Do float32 models keep their unit curves apart from float64 models with the same parameters?"""
+    UNIT_RESPONSE_CACHE.clear()
+
+    for model_class in [PalermInsulinModel, CesconCarbModel]:
+        unit_response_32 = model_class(isf=100, cir=10, dtype=np.float32).get_unit_response(8)
+        unit_response_64 = model_class(isf=100, cir=10).get_unit_response(8)
+
+        assert all(curve.dtype == np.float32 for curve in unit_response_32[1:])
+        assert all(curve.dtype == np.float64 for curve in unit_response_64[1:])
+
+    UNIT_RESPONSE_CACHE.clear()
+
+
+def assert_float32_close(results_64, results_32, tolerance):
+    """Check the bg_delta and bg relative to the bg range, and the iob if any relative to its range"""
+    _, bg_delta_64, bg_64, *iob_64 = results_64
+    _, bg_delta_32, bg_32, *iob_32 = results_32
+
+    bg_range = np.max(np.abs(bg_64))
+    comparisons = [(bg_delta_64, bg_delta_32, bg_range), (bg_64, bg_32, bg_range)]
+    if iob_64:
+        comparisons.append((iob_64[0], iob_32[0], np.max(iob_64[0])))
+
+    for result_64, result_32, result_range in comparisons:
+        assert result_32.dtype == np.float32
+        assert np.max(np.abs(result_64 - result_32)) < tolerance * result_range
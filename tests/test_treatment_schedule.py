@@ -0,0 +1,329 @@
+"""
+Testing the multi-event treatment schedule engine.
+"""
+import numpy as np
+import pytest
+
+from tidepool_data_science_models.models.simple_metabolism_model import SimpleMetabolismModel
+from tidepool_data_science_models.models.treatment_schedule import TreatmentSchedule, DailySchedule, TempBasals
+from tidepool_data_science_models.utils import EPSILON_TEST, INSULIN_DECAY_8HR_EPSILON, STEADY_STATE_IOB_FACTOR_FDA
+
+
+def get_simple_metabolism_model(isf=100, cir=10):
+    return SimpleMetabolismModel(
+        insulin_sensitivity_factor=isf,
+        carb_insulin_ratio=cir,
+        insulin_model_name="palerm",
+        carb_model_name="cescon",
+    )
+
+
+def test_schedule_single_event_matches_run():
+    """
+    Does a schedule with one bolus and one carb entry at t0 match run()?
+    """
+    smm = get_simple_metabolism_model()
+
+    for five_min in [True, False]:
+        schedule = TreatmentSchedule(bolus_times=[0], bolus_amounts=[2.0], carb_times=[0], carb_amounts=[30.0])
+        delta_bg, t, iob = smm.run_schedule(schedule, num_hours=8, five_min=five_min)
+        delta_bg_run, t_run, _, iob_run = smm.run(carb_amount=30.0, insulin_amount=2.0, num_hours=8, five_min=five_min)
+
+        assert np.array_equal(t, t_run)
+        assert np.max(np.abs(iob - iob_run)) < EPSILON_TEST
+        assert np.max(np.abs(np.cumsum(delta_bg) - np.cumsum(delta_bg_run))) < EPSILON_TEST
+
+
+def test_schedule_iob_matches_run_past_8_hours():
+    """
+    Does the schedule iob keep decaying like run() past 8 hours instead of dropping to zero?
+    """
+    smm = get_simple_metabolism_model()
+
+    for five_min in [True, False]:
+        schedule = TreatmentSchedule(bolus_times=[0], bolus_amounts=[2.0])
+        _, t, iob = smm.run_schedule(schedule, num_hours=12, five_min=five_min)
+        _, t_run, _, iob_run = smm.run(carb_amount=0.0, insulin_amount=2.0, num_hours=12, five_min=five_min)
+
+        assert np.array_equal(t, t_run)
+        assert np.max(np.abs(iob - iob_run)) < EPSILON_TEST
+        assert np.all(iob[t >= 8 * 60] > 0)
+
+
+def test_schedule_partial_step_horizon():
+    """
+    Does a horizon that isn't a whole number of steps give outputs the same length as the time series?
+    """
+    smm = get_simple_metabolism_model()
+    schedule = TreatmentSchedule(bolus_times=[0], bolus_amounts=[2.0], basal_start_times=[0], basal_rates=[1.0])
+
+    for num_hours, five_min, num_steps in [(8.1, True, 98), (7 / 60, True, 2), (7.5 / 60, False, 7)]:
+        delta_bg, t, iob = smm.run_schedule(schedule, num_hours=num_hours, five_min=five_min)
+        assert len(t) == len(delta_bg) == len(iob) == num_steps
+
+        delta_bg, t, iob = smm.run_basal_schedule(
+            DailySchedule([0], [1.0]), num_hours=num_hours, five_min=five_min, num_hours_pre_t0=7 / 60
+        )
+        assert len(t) == len(delta_bg) == len(iob) == num_steps
+
+
+def test_schedule_is_superposition_of_shifted_runs():
+
+    smm = get_simple_metabolism_model()
+    num_hours = 3 * 24
+
+    bolus_times = [0, 60, 600, 1445, 3000]
+    bolus_amounts = [1.0, 3.0, 0.5, 2.0, 4.0]
+    carb_times = [0, 600, 1450, 3000]
+    carb_amounts = [10.0, 45.0, 20.0, 60.0]
+
+    schedule = TreatmentSchedule(
+        bolus_times=bolus_times, bolus_amounts=bolus_amounts, carb_times=carb_times, carb_amounts=carb_amounts
+    )
+    delta_bg, t, iob = smm.run_schedule(schedule, num_hours=num_hours)
+
+    assert len(delta_bg) == num_hours * 12
+
+    expected_delta_bg = np.zeros(len(t))
+    expected_iob = np.zeros(len(t))
+    # Each effect lasts the 24 hour kernel horizon
+    for time, amount in zip(bolus_times, bolus_amounts):
+        _, bg_delta_bolus, _, iob_bolus = smm.insulin_model.run(24, insulin_amount=amount)
+        end_index = min(time // 5 + len(bg_delta_bolus), len(t))
+        expected_delta_bg[time // 5 : end_index] += bg_delta_bolus[: end_index - time // 5]
+        expected_iob[time // 5 : end_index] += iob_bolus[: end_index - time // 5]
+    for time, amount in zip(carb_times, carb_amounts):
+        _, bg_delta_carb, _ = smm.carb_model.run(24, carb_amount=amount)
+        end_index = min(time // 5 + len(bg_delta_carb), len(t))
+        expected_delta_bg[time // 5 : end_index] += bg_delta_carb[: end_index - time // 5]
+
+    assert np.max(np.abs(iob - expected_iob)) < EPSILON_TEST
+    assert np.max(np.abs(np.cumsum(delta_bg) - np.cumsum(expected_delta_bg))) < EPSILON_TEST
+
+
+def test_schedule_basal():
+
+    smm = get_simple_metabolism_model()
+
+    # A basal rate is the same as a bolus of rate / 12 every 5 minutes
+    schedule = TreatmentSchedule(basal_start_times=[0, 120], basal_rates=[1.2, 0.0])
+    pulse_schedule = TreatmentSchedule(bolus_times=np.arange(0, 120, 5), bolus_amounts=np.ones(24) * 0.1)
+
+    delta_bg, _, iob = smm.run_schedule(schedule, num_hours=12)
+    delta_bg_pulses, _, iob_pulses = smm.run_schedule(pulse_schedule, num_hours=12)
+
+    assert np.allclose(delta_bg, delta_bg_pulses)
+    assert np.allclose(iob, iob_pulses)
+    assert abs(np.sum(delta_bg) + 2.4 * 100) < INSULIN_DECAY_8HR_EPSILON * 2.4 * 100
+
+
+def test_schedule_invalid_events():
+
+    with pytest.raises(ValueError):
+        TreatmentSchedule(bolus_times=[0, 5], bolus_amounts=[1.0])
+
+    with pytest.raises(ValueError):
+        TreatmentSchedule(carb_times=[-5], carb_amounts=[10.0])
+
+    schedule = TreatmentSchedule()
+    with pytest.raises(ValueError):
+        schedule.add_carb(10, -10.0)
+
+
+def test_daily_schedule_values():
+
+    basal_schedule = DailySchedule(start_times=[0, 360, 1200], values=[0.8, 1.2, 0.5])
+
+    t = np.array([-60, 0, 359, 360, 1199, 1200, 1439, 1440, 1800, 3000])
+    expected_values = [0.5, 0.8, 0.8, 1.2, 1.2, 0.5, 0.5, 0.8, 1.2, 0.8]
+    assert np.array_equal(basal_schedule.get_values(t), expected_values)
+
+    # t0 at 10pm
+    assert np.array_equal(basal_schedule.get_values([0, 120, 480], start_minute_of_day=1320), [0.5, 0.8, 1.2])
+
+    # The first segment can start after midnight, the last one wraps
+    assert np.array_equal(DailySchedule([60, 600], [1.0, 2.0]).get_values([0, 60, 600]), [2.0, 1.0, 2.0])
+
+    with pytest.raises(ValueError):
+        DailySchedule([360, 0], [1.0, 2.0])
+
+    with pytest.raises(ValueError):
+        DailySchedule([0, 1440], [1.0, 2.0])
+
+
+def test_basal_schedule_steady_state():
+
+    smm = get_simple_metabolism_model()
+
+    for five_min in [True, False]:
+        delta_bg, t, iob = smm.run_basal_schedule(DailySchedule([0], [1.0]), num_hours=48, five_min=five_min)
+
+        assert len(t) == len(iob) == len(delta_bg)
+
+        # A constant basal rate stays at the steady state iob at each pulse and lowers bg by isf * rate per hour
+        iob_at_pulses = iob if five_min else iob[::5]
+        assert np.max(np.abs(iob_at_pulses - STEADY_STATE_IOB_FACTOR_FDA)) < EPSILON_TEST
+        assert abs(np.sum(delta_bg) / (-100 * 1.0 * 48) - 1) < INSULIN_DECAY_8HR_EPSILON
+
+
+def test_basal_schedule_temp_basal_matches_iob_from_sbr():
+
+    smm = get_simple_metabolism_model()
+
+    # Suspending basal after the pulse at t0 leaves the decaying steady state insulin
+    _, _, iob = smm.run_basal_schedule(
+        DailySchedule([0], [2.0]), num_hours=8, temp_basals=TempBasals(start_times=[5], durations=[480], rates=[0.0])
+    )
+    assert np.max(np.abs(iob - smm.get_iob_from_sbr(2.0))) < EPSILON_TEST
+
+
+def test_basal_schedule_batch():
+
+    smm = get_simple_metabolism_model()
+
+    basal_schedules = [
+        DailySchedule([0], [1.0]),
+        DailySchedule([0, 360, 1200], [0.8, 1.2, 0.5]),
+        DailySchedule([180, 900], [0.3, 0.6]),
+    ]
+    temp_basals = [None, TempBasals([60, 600], [30, 120], [0.0, 3.0]), TempBasals([2000], [60], [1.5])]
+    isfs = [100, 40, 75]
+
+    delta_bg, t, iob = smm.run_basal_schedule(
+        basal_schedules, num_hours=3 * 24, temp_basals=temp_basals, isfs=isfs, start_minute_of_day=420
+    )
+    assert delta_bg.shape == iob.shape == (3, 3 * 24 * 12)
+
+    for i in range(3):
+        patient_smm = get_simple_metabolism_model(isf=isfs[i])
+        delta_bg_patient, _, iob_patient = patient_smm.run_basal_schedule(
+            basal_schedules[i], num_hours=3 * 24, temp_basals=temp_basals[i], start_minute_of_day=420
+        )
+        assert np.max(np.abs(delta_bg[i] - delta_bg_patient)) < EPSILON_TEST
+        assert np.max(np.abs(iob[i] - iob_patient)) < EPSILON_TEST
+
+    # The schedule repeats daily
+    assert np.max(np.abs(iob[1, 288:576] - iob[1, 576:864])) < EPSILON_TEST
+
+    # The temp basal shows up on top of the schedule
+    _, _, iob_without_temp = smm.run_basal_schedule(basal_schedules[1], num_hours=3 * 24, start_minute_of_day=420)
+    assert np.max(iob[1, :12] - iob_without_temp[:12]) < EPSILON_TEST
+    assert np.max(iob[1] - iob_without_temp) > 1.0
+
+
+def test_schedule_at_irregular_times():
+    """
+    Does evaluating a schedule at arbitrary times match the 1 minute superposition of run() at those times?
+    """
+    smm = get_simple_metabolism_model()
+
+    schedule = TreatmentSchedule(
+        bolus_times=[0, 61, 300],
+        bolus_amounts=[2.0, 0.5, 1.0],
+        carb_times=[0, 299],
+        carb_amounts=[30.0, 15.0],
+        basal_start_times=[0, 120],
+        basal_rates=[0.6, 1.2],
+    )
+
+    t_dense = np.arange(0, 12 * 60)
+    pulse_times, pulse_amounts = schedule.get_basal_pulses(12)
+    expected_bg = np.zeros(len(t_dense))
+    expected_iob = np.zeros(len(t_dense))
+    for times, amounts, carbs in [
+        (schedule.bolus_times, schedule.bolus_amounts, 0.0),
+        (pulse_times, pulse_amounts, 0.0),
+        (schedule.carb_times, np.zeros(2), schedule.carb_amounts),
+    ]:
+        for time, amount, carb_amount in zip(times.astype(int), amounts, np.broadcast_to(carbs, amounts.shape)):
+            delta_bg, _, _, iob = smm.run(carb_amount, amount, num_hours=12, five_min=False)
+            expected_bg[time:] += np.cumsum(delta_bg)[: len(t_dense) - time]
+            expected_iob[time:] += iob[: len(t_dense) - time]
+
+    # Cgm times that drift off the 5 minute grid with a gap
+    t = np.concatenate([np.arange(0, 200, 5.0), np.arange(400, 12 * 60, 5.0) + 2])
+    delta_bg, t_out, iob = smm.run_at_times(t, schedule)
+
+    assert np.array_equal(t_out, t)
+    assert len(delta_bg) == len(iob) == len(t)
+    assert delta_bg[0] == 0
+    assert np.max(np.abs(np.cumsum(delta_bg) - expected_bg[t.astype(int)])) < EPSILON_TEST
+    assert np.max(np.abs(iob - expected_iob[t.astype(int)])) < EPSILON_TEST
+
+
+def test_schedule_with_isf_and_cir_schedules():
+    """
+    Does a bolus acting across an isf boundary lower bg by each isf times the insulin cleared while it's active?
+    """
+    smm = get_simple_metabolism_model()
+
+    # t0 at 11pm, the isf changes at midnight and 2am
+    isf_schedule = DailySchedule(start_times=[0, 120, 1320], values=[50, 100, 80])
+    cir_schedule = DailySchedule(start_times=[0, 1320], values=[8, 12])
+    schedule = TreatmentSchedule(bolus_times=[30], bolus_amounts=[1.0], carb_times=[45], carb_amounts=[40.0])
+
+    for five_min in [True, False]:
+        minutes_per_step = 5 if five_min else 1
+        bolus_schedule = TreatmentSchedule(bolus_times=[30], bolus_amounts=[1.0])
+        delta_bg, t, iob = smm.run_schedule(
+            bolus_schedule, num_hours=12, five_min=five_min, isfs=isf_schedule, start_minute_of_day=1380
+        )
+
+        # The isf is 80 until midnight, 50 until 2am and then 100, while the insulin acts
+        interval_start_times = t - minutes_per_step
+        isf_in_effect = np.where(interval_start_times < 60, 80, np.where(interval_start_times < 180, 50, 100))
+        insulin_cleared = (t >= 30) - iob
+        expected_bg = -1 * np.cumsum(isf_in_effect * np.diff(insulin_cleared, prepend=0))
+
+        assert np.max(np.abs(np.cumsum(delta_bg) - expected_bg)) < EPSILON_TEST
+
+        # Constant schedules match the scalar settings, and the iob doesn't depend on them
+        delta_bg, _, iob = smm.run_schedule(schedule, num_hours=12, five_min=five_min)
+        delta_bg_constant, _, iob_constant = smm.run_schedule(
+            schedule, num_hours=12, five_min=five_min, isfs=DailySchedule([0], [100]), cirs=DailySchedule([0], [10])
+        )
+        assert np.max(np.abs(delta_bg - delta_bg_constant)) < EPSILON_TEST
+        assert np.array_equal(iob, iob_constant)
+
+    # Carbs at midnight act with isf / cir = 50 / 8 until 2am, then 100 / 8
+    carb_schedule = TreatmentSchedule(carb_times=[60], carb_amounts=[40.0])
+    delta_bg, _, _ = smm.run_schedule(
+        carb_schedule, num_hours=12, isfs=isf_schedule, cirs=cir_schedule, start_minute_of_day=1380
+    )
+    for isf, steps in [(50, slice(0, 37)), (100, slice(37, 60))]:
+        delta_bg_scalar = get_simple_metabolism_model(isf=isf, cir=8).run_schedule(carb_schedule, num_hours=12)[0]
+        assert np.max(np.abs(delta_bg[steps] - delta_bg_scalar[steps])) < EPSILON_TEST
+
+
+def test_schedule_batch_with_isf_schedules():
+
+    smm = get_simple_metabolism_model()
+
+    schedules = [
+        TreatmentSchedule(bolus_times=[0, 300], bolus_amounts=[2.0, 1.0], carb_times=[0], carb_amounts=[30.0]),
+        TreatmentSchedule(bolus_times=[600], bolus_amounts=[3.0], basal_start_times=[0], basal_rates=[0.8]),
+        TreatmentSchedule(carb_times=[120, 800], carb_amounts=[20.0, 50.0]),
+    ]
+    isfs = [DailySchedule([0, 360, 1200], [40, 60, 50]), 75, DailySchedule([0, 720], [90, 110])]
+    cirs = [DailySchedule([0, 600], [8, 12]), 15, 10]
+
+    delta_bg, t, iob = smm.run_schedule(schedules, num_hours=36, isfs=isfs, cirs=cirs, start_minute_of_day=420)
+    assert delta_bg.shape == iob.shape == (3, len(t))
+
+    for i in range(3):
+        delta_bg_patient, _, iob_patient = smm.run_schedule(
+            schedules[i], num_hours=36, isfs=isfs[i], cirs=cirs[i], start_minute_of_day=420
+        )
+        assert np.max(np.abs(delta_bg[i] - delta_bg_patient)) < EPSILON_TEST
+        assert np.max(np.abs(iob[i] - iob_patient)) < EPSILON_TEST
+
+    # An isf schedule for the basal schedule matches the basal running through run_schedule
+    basal_delta_bg, _, _ = smm.run_basal_schedule(
+        DailySchedule([0], [0.8]), num_hours=36, isfs=isfs[0], start_minute_of_day=420, num_hours_pre_t0=0
+    )
+    basal_schedule = TreatmentSchedule(basal_start_times=[0], basal_rates=[0.8])
+    expected_delta_bg, _, _ = smm.run_schedule(basal_schedule, num_hours=36, isfs=isfs[0], start_minute_of_day=420)
+    assert np.max(np.abs(basal_delta_bg - expected_delta_bg)) < EPSILON_TEST
+
+    with pytest.raises(ValueError):
+        smm.run_schedule(schedules, num_hours=8, isfs=[50, 60])
@@ -0,0 +1,142 @@
+"""
+This file houses the process-wide cache of unit response curves shared by the treatment models,
+and the LRU cache it's built on, which can also memoize SimpleMetabolismModel.run.
+"""
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Default memory budget for the unit response cache
+UNIT_RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+class LRUArrayCache(object):
+    """
+    Thread-safe least recently used cache of numpy arrays, bounded by the number of
+    bytes held rather than the number of entries.
+
+    Cached arrays are made read-only since they are shared by every caller.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        Parameters
+        ----------
+        max_bytes: int
+            Memory budget for the cached arrays. Least recently used entries are
+            evicted to stay within it and values larger than it are not cached.
+        """
+        if max_bytes < 0:
+            raise ValueError("Cache max_bytes can't be negative.")
+
+        self.max_bytes = max_bytes
+
+        self._entries = OrderedDict()
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_compute(self, key, compute_value):
+        """
+        Get the value for the key, computing and caching it on a miss.
+
+        Parameters
+        ----------
+        key: hashable
+            Identifies the value, e.g. the model name, parameters, horizon and resolution
+
+        compute_value: callable
+            Called with no arguments on a miss. Returns an np.array or a tuple of np.arrays.
+
+        Returns
+        -------
+        np.array or tuple of np.array
+            The read-only cached value
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+
+        # Compute outside the lock so other threads aren't blocked. Two threads
+        # missing on the same key at once both compute it, which is harmless.
+        value = _freeze(compute_value())
+        value_num_bytes = _get_num_bytes(value)
+
+        if value_num_bytes > self.max_bytes:
+            return value
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (value, value_num_bytes)
+                self._num_bytes += value_num_bytes
+                self._evict()
+
+        return value
+
+    def _evict(self):
+        """Drop least recently used entries until within the memory budget. Caller holds the lock."""
+        while self._num_bytes > self.max_bytes:
+            _, (_, value_num_bytes) = self._entries.popitem(last=False)
+            self._num_bytes -= value_num_bytes
+            self.evictions += 1
+
+    def clear(self):
+        """Remove all entries and reset the counters"""
+        with self._lock:
+            self._entries.clear()
+            self._num_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def get_stats(self):
+        """
+        Get the cache counters.
+
+        Returns
+        -------
+        dict
+            hits, misses, hit_rate, evictions, num_entries, num_bytes and max_bytes. hit_rate is
+            the fraction of lookups that were hits, 0 before any lookups.
+        """
+        with self._lock:
+            num_lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / num_lookups if num_lookups else 0.0,
+                "evictions": self.evictions,
+                "num_entries": len(self._entries),
+                "num_bytes": self._num_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _freeze(value):
+    """Make the array(s) in value read-only"""
+    arrays = value if isinstance(value, tuple) else (value,)
+    for array in arrays:
+        if isinstance(array, np.ndarray):
+            array.flags.writeable = False
+    return value
+
+
+def _get_num_bytes(value):
+    """Get the bytes held by the array(s) in value"""
+    arrays = value if isinstance(value, tuple) else (value,)
+    return sum(array.nbytes for array in arrays if isinstance(array, np.ndarray))
+
+
+# Unit dose curves shared by all treatment models in the process
+UNIT_RESPONSE_CACHE = LRUArrayCache(max_bytes=UNIT_RESPONSE_CACHE_MAX_BYTES)
@@ -1,7 +1,6 @@
 import numpy as np
 import sys
 import datetime
-import copy
 
 
 class SensorExpiredError(Exception):
@@ -9,6 +8,18 @@ class SensorExpiredError(Exception):
     pass
 
 
+# Range of bg values Loop accepts from a cgm, sensor bgs are clipped to it
+LOOP_MIN_BG = 40
+LOOP_MAX_BG = 400
+
+# Noise and drift are generated lazily in chunks of one day of readings
+NOISE_CHUNK_NUM_READINGS = 288
+
+# The noise and drift of a sensor span at least 10 days, so a sensor with a shorter life can still
+# take predictions past its end of life, and its drift has the same period as a 10 day sensor
+NOISE_STREAM_MIN_DAYS = 10
+
+
 # %% Definitions
 class Sensor(object):
     """Base CGM Sensor Class"""
@@ -41,30 +52,263 @@ class SensorState(object):
         self.sensor_bg_prediction = kwargs.get("sensor_bg_prediction")
 
 
-class iCGMSensor(Sensor):
-    """iCGM Sensor Object
+class ReadingDelayBuffer(object):
+    """
+    Fixed capacity FIFO of the most recent true bgs, used as the sensor's delay line.
+
+    Readings are kept in a preallocated ring, so pushing a reading and taking the delayed one out is O(1)
+    and doesn't allocate.
+    """
+
+    def __init__(self, delay_steps):
+        """
+        Parameters
+        ----------
+        delay_steps : int
+            The number of readings each value is delayed by
+        """
+        self.values = np.empty(delay_steps)
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return "ReadingDelayBuffer({})".format(self.get_values().tolist())
+
+    def push(self, value):
+        """
+        Add a reading and take out the reading from delay_steps readings ago.
+
+        Parameters
+        ----------
+        value : float
+            The newest reading
+
+        Returns
+        -------
+        float
+            The delayed reading, nan until the buffer has filled
+        """
+        capacity = len(self.values)
+        if capacity == 0:
+            return value
+
+        if self.size < capacity:
+            self.values[(self.start + self.size) % capacity] = value
+            self.size += 1
+            return np.nan
+
+        delayed_value = self.values[self.start]
+        self.values[self.start] = value
+        self.start = (self.start + 1) % capacity
+
+        return delayed_value
+
+    def get_values(self):
+        """Get a copy of the buffered readings, oldest first"""
+        return np.roll(self.values, -self.start)[: self.size]
+
+    def snapshot(self):
+        """Get a copy of the buffer state for restore()"""
+        return self.values.copy(), self.start, self.size
+
+    def restore(self, snapshot):
+        """Reset the buffer to a state from snapshot()"""
+        values, self.start, self.size = snapshot
+        self.values[:] = values
+
+
+class SensorNoiseStream(object):
+    """
+    The time series noise and bias drift of a sensor, generated lazily in chunks of chunk_size readings.
+
+    The noise of chunk k is drawn from a Philox counter based random stream keyed by the random seed
+    with the chunk index in the counter, so each chunk is the same no matter when or in what order it
+    is requested. Only the chunks covering the requested readings are kept, so memory follows the time
+    being simulated rather than the sensor's age.
 
     Parameters
         ----------
-        sensor_properties : pandas DataFrame object
-            A set of sensor properties needed to initialize an iCGM Sensor
+        random_seed : int
+            Random seed of the sensor's noise
+        noise_coefficient : float
+            Standard deviation of the noise (mg/dL)
+        bias_drift_type : str
+            Type of drift used in the sensor bias (random, none)
+        bias_drift_oscillations : float
+            Number of half oscillations of the random drift over the num_values readings
+        phi_drift : float
+            Phase of the random drift
+        bias_drift_range_start : float
+            The drift multiplier range start
+        num_values : int
+            Number of readings in the stream, every 5 minutes
+        chunk_size : int
+            Number of readings generated at a time
+    """
+
+    def __init__(
+        self,
+        random_seed,
+        noise_coefficient,
+        bias_drift_type,
+        bias_drift_oscillations,
+        phi_drift,
+        bias_drift_range_start,
+        num_values,
+        chunk_size=NOISE_CHUNK_NUM_READINGS,
+    ):
+
+        if bias_drift_type == "linear":
+            print("No 'linear' bias_drift_type implemented in iCGM Sensor")
+            raise NotImplementedError
+
+        if bias_drift_type not in ["random", "none"]:
+            raise ValueError("{} not a recognized bias_drift_type.".format(bias_drift_type))
+
+        self.random_seed = int(random_seed)
+        self.noise_scale = np.max([noise_coefficient, sys.float_info.epsilon])
+        self.bias_drift_type = bias_drift_type
+        self.bias_drift_oscillations = bias_drift_oscillations
+        self.phi_drift = phi_drift
+        self.bias_drift_range_start = bias_drift_range_start
+        self.num_values = num_values
+        self.chunk_size = chunk_size
+
+        # Generated (noise, drift_multiplier) by chunk index
+        self.chunks = {}
+
+    def __repr__(self):
+        # Generated chunks are a cache of the stream, so they are left out
+        return "SensorNoiseStream(random_seed={}, num_values={}, chunk_size={})".format(
+            self.random_seed, self.num_values, self.chunk_size
+        )
+
+    def get_chunk(self, chunk_index):
+        """
+        Generate the noise and drift multiplier of a chunk. This is STATELESS, each chunk draws from its
+        own random stream, so chunks can be generated in any order or from several threads at once.
+
+        Parameters
+        ----------
+        chunk_index : int
+            The chunk, covering readings chunk_index * chunk_size up to the next chunk or num_values
+
+        Returns
+        -------
+        noise, drift_multiplier : numpy float arrays
+            The noise and drift multiplier at each reading of the chunk
+        """
+        start_index = chunk_index * self.chunk_size
+        end_index = min(start_index + self.chunk_size, self.num_values)
+
+        if chunk_index < 0 or start_index >= self.num_values:
+            raise SensorExpiredError("Chunk {} outside of the sensor's noise and drift.".format(chunk_index))
+
+        random_stream = np.random.Generator(np.random.Philox(key=self.random_seed, counter=[0, chunk_index, 0, 0]))
+        noise = random_stream.normal(loc=0, scale=self.noise_scale, size=end_index - start_index)
+
+        if self.bias_drift_type == "random":
+
+            # bias drift component over the stream with cgm point every 5 minutes
+            drift_step = self.bias_drift_oscillations * np.pi / max(self.num_values - 1, 1)
+            t = np.arange(start_index, end_index) * drift_step
+            sn = np.sin(t + self.phi_drift)
+
+            drift_multiplier = np.interp(sn, (-1, 1), (self.bias_drift_range_start, self.bias_drift_range_start))
+
+        else:
+            drift_multiplier = np.ones(end_index - start_index)
+
+        return noise, drift_multiplier
+
+    def get_values(self, start_index, end_index):
+        """
+        Get the noise and drift multiplier of readings start_index up to end_index. Only the chunks
+        covering them are generated, and earlier chunks are dropped.
+
+        Returns
+        -------
+        noise, drift_multiplier : numpy float arrays
+            The values, views of a chunk when the readings fall within one
+        """
+        if end_index > self.num_values:
+            raise SensorExpiredError("Sensor bg trace extends past the sensor's noise and drift.")
+
+        return get_chunked_values(self.chunks, start_index, end_index, self.chunk_size, self.get_chunk)
+
+
+def get_chunked_values(chunks, start_index, end_index, chunk_size, get_chunk):
+    """
+    Get readings start_index up to end_index of chunked time series, generating the chunks covering
+    them. Chunks before start_index are dropped, as sensors only move forward in time.
+
+    Parameters
+    ----------
+    chunks : dict
+        The generated chunks by chunk index, each a tuple of arrays with readings along the last axis.
+        Updated in place.
+    start_index : int
+        The first reading
+    end_index : int
+        The reading after the last one
+    chunk_size : int
+        Number of readings in a chunk
+    get_chunk : function
+        Generates the tuple of arrays of a chunk from its index
+
+    Returns
+    -------
+    tuple of numpy arrays
+        The readings of each time series
+    """
+    first_chunk = start_index // chunk_size
+    last_chunk = max(end_index - 1, start_index) // chunk_size
+
+    for chunk_index in [chunk_index for chunk_index in chunks if chunk_index < first_chunk]:
+        del chunks[chunk_index]
+
+    for chunk_index in range(first_chunk, last_chunk + 1):
+        if chunk_index not in chunks:
+            chunks[chunk_index] = get_chunk(chunk_index)
+
+    if first_chunk == last_chunk:
+        series = chunks[first_chunk]
+    else:
+        series = [
+            np.concatenate([chunks[chunk_index][i] for chunk_index in range(first_chunk, last_chunk + 1)], axis=-1)
+            for i in range(len(chunks[first_chunk]))
+        ]
+
+    offset = first_chunk * chunk_size
+    return tuple(values[..., start_index - offset : end_index - offset] for values in series)
+
+
+class iCGMSensorBase(Sensor):
+    """
+    The clock, history and Loop inputs shared by iCGMSensor and iCGMSensorFleet. Subclasses compute
+    the sensor bgs in get_bg() and get_bg_trace().
+
+    Parameters
+        ----------
+        current_datetime : datetime.datetime or None
+            The datetime timestamp associated with the time_index
         sensor_life_days : int
             The number of days the sensor will last.
         time_index : int
             The internal time of the sensor, used for errors and drift over the sensor life.
             (1 = 5 minutes, 2 = 10 minutes, etc)
-        current_datetime : datetime.datetime or None
-            The datetime timestamp associated with the time_index
+        sensor_shape : tuple
+            The shape of the sensor bgs at each reading, () for one sensor or (n_sensors,) for a fleet
 
     """
 
-    def __init__(self, current_datetime, sensor_properties, sensor_life_days=10, time_index=0):
+    def __init__(self, current_datetime, sensor_life_days, time_index, sensor_shape=()):
 
         super().__init__()
 
-        if sensor_properties is None:
-            raise Exception("No Sensor Properties Given")
-
         if sensor_life_days <= 0 or not isinstance(sensor_life_days, int):
             raise Exception("iCGM Sensor's sensor_life_days must be a positive non-zero integer")
 
@@ -80,22 +324,15 @@ class iCGMSensor(Sensor):
 
         self.validate_time_index(self.time_index)
 
-        self.reading_delay_buffer = []
-        self.sensor_bg_history = []
-        self.datetime_history = []
-
-        self.initial_bias = sensor_properties["initial_bias"].values[0]
-        self.phi_drift = sensor_properties["phi_drift"].values[0]
-        self.bias_drift_range_start = sensor_properties["bias_drift_range_start"].values[0]
-        self.bias_drift_range_end = sensor_properties["bias_drift_range_end"].values[0]
-        self.bias_drift_oscillations = sensor_properties["bias_drift_oscillations"].values[0]
-        self.bias_norm_factor = sensor_properties["bias_norm_factor"].values[0]
-        self.noise_coefficient = sensor_properties["noise_coefficient"].values[0]
-        self.delay_minutes = sensor_properties["delay"].values[0]
-        self.random_seed = sensor_properties["random_seed"].values[0]
-        self.bias_drift_type = sensor_properties["bias_drift_type"].values[0]
+        # Readings of noise and drift, which may run past the end of the sensor life for predictions
+        self.noise_stream_num_values = self.num_readings_24hrs * max(self.sensor_life_days, NOISE_STREAM_MIN_DAYS)
 
-        self.calculate_sensor_bias_properties()
+        # History for the whole sensor life, readings along the last axis. The first history_size are filled.
+        max_history_size = self.sensor_life_days * self.num_readings_24hrs
+        self.history_size = 0
+        self._sensor_bg_history = np.full(sensor_shape + (max_history_size,), np.nan)
+        self._loop_bg_history = np.full(sensor_shape + (max_history_size,), np.nan)
+        self._datetime_history = np.full(max_history_size, np.datetime64("NaT"), dtype="datetime64[m]")
 
     def get_state(self):
 
@@ -111,13 +348,38 @@ class iCGMSensor(Sensor):
         if before_sensor_starts or after_sensor_expires:
             raise Exception("Sensor time_index {} outside of sensor life! ".format(str(time_index)))
 
+    @property
+    def sensor_bg_history(self):
+        """The sensor bgs so far, a view of the history array"""
+        return self._sensor_bg_history[..., : self.history_size]
+
+    @property
+    def datetime_history(self):
+        """The datetimes of the sensor bgs as minutes since the epoch (datetime64[m]), a view of the history array"""
+        return self._datetime_history[: self.history_size]
+
     def store(self):
         """Store the current sensor state into history"""
-        self.sensor_bg_history.append(self.current_sensor_bg)
-        self.datetime_history.append(self.current_datetime)
+        self._sensor_bg_history[..., self.history_size] = self.current_sensor_bg
+        self._datetime_history[self.history_size] = np.datetime64(self.current_datetime, "m")
+
+        # Loop's value is computed once here rather than on every get_loop_inputs() call.
+        # NaNs are returned as the max value.
+        self._loop_bg_history[..., self.history_size] = np.where(
+            np.isnan(self.current_sensor_bg),
+            LOOP_MAX_BG,
+            np.clip(np.round(self.current_sensor_bg), LOOP_MIN_BG, LOOP_MAX_BG),
+        )
+
+        self.history_size += 1
 
     def update(self, next_datetime, **kwargs):
-        """Step the sensor clock time forward"""
+        """
+        Step the sensor clock time forward
+
+        Keyword arguments are patient_true_bg and optionally patient_true_bg_prediction, for get_bg()
+        and get_bg_trace()
+        """
 
         if self.is_sensor_expired():
             raise SensorExpiredError("Sensor has expired.")
@@ -145,38 +407,93 @@ class iCGMSensor(Sensor):
         """
         return self.time_index >= self.sensor_life_days * self.num_readings_24hrs
 
-    def calculate_sensor_bias_properties(self):
-        """Calculates the time series noise and bias drift properties based on other sensor properties"""
+    def prefill_sensor_history(self, true_bg_history):
+        """Prefills the sensor with true bgs and calculates the corresponding sensor bgs"""
 
-        num_days = 10  # CS 2020-06-20: Can this just be the sensor life or does that cause problems?
+        history_start_time = self.current_datetime - datetime.timedelta(minutes=len(true_bg_history) * 5)
+        self.current_datetime = history_start_time
 
-        # random seed for reproducibility
-        np.random.seed(seed=self.random_seed)
+        try:
+            for true_bg_value in true_bg_history:
+                next_datetime = self.current_datetime + datetime.timedelta(minutes=5)
+                self.update(next_datetime, patient_true_bg=true_bg_value)
+        except SensorExpiredError as e:
+            e_message = (
+                "Trying to prefill past sensor life. "
+                + "Establish the sensor at a different time_index or prefill with less data."
+            )
+            raise SensorExpiredError(e_message)
 
-        # noise component
-        self.noise = np.random.normal(
-            loc=0, scale=np.max([self.noise_coefficient, sys.float_info.epsilon]), size=self.num_readings_24hrs * num_days
-        )
+    def get_loop_inputs(self):
+        """
+        Get two arrays for dates and values, used for Loop input.
 
-        # bias of individual sensor
-        self.bias_factor = (self.bias_norm_factor + self.initial_bias) / (np.max([self.bias_norm_factor, 1]))
+        Returns
+        -------
+        (numpy datetime64[m] array, numpy float array)
+            Views of the sensor history, the datetimes and the bgs rounded and clipped to the range
+            Loop accepts. For a fleet the bgs have shape (n_sensors, number of readings).
+        """
+        return self.datetime_history, self._loop_bg_history[..., : self.history_size]
 
-        if self.bias_drift_type == "random":
 
-            # bias drift component over 10 days with cgm point every 5 minutes
-            t = np.linspace(
-                0, (self.bias_drift_oscillations * np.pi), self.num_readings_24hrs * num_days
-            )  # this is the number of cgm points in 11 days
-            sn = np.sin(t + self.phi_drift)
+class iCGMSensor(iCGMSensorBase):
+    """iCGM Sensor Object
 
-            self.drift_multiplier = np.interp(sn, (-1, 1), (self.bias_drift_range_start, self.bias_drift_range_start))
+    Parameters
+        ----------
+        sensor_properties : pandas DataFrame object
+            A set of sensor properties needed to initialize an iCGM Sensor
+        sensor_life_days : int
+            The number of days the sensor will last.
+        time_index : int
+            The internal time of the sensor, used for errors and drift over the sensor life.
+            (1 = 5 minutes, 2 = 10 minutes, etc)
+        current_datetime : datetime.datetime or None
+            The datetime timestamp associated with the time_index
 
-        if self.bias_drift_type == "linear":
-            print("No 'linear' bias_drift_type implemented in iCGM Sensor")
-            raise NotImplementedError
+    """
+
+    def __init__(self, current_datetime, sensor_properties, sensor_life_days=10, time_index=0):
+
+        if sensor_properties is None:
+            raise Exception("No Sensor Properties Given")
 
-        if self.bias_drift_type == "none":
-            self.drift_multiplier = np.ones(self.num_readings_24hrs * num_days)
+        super().__init__(current_datetime, sensor_life_days, time_index)
+
+        self.initial_bias = sensor_properties["initial_bias"].values[0]
+        self.phi_drift = sensor_properties["phi_drift"].values[0]
+        self.bias_drift_range_start = sensor_properties["bias_drift_range_start"].values[0]
+        self.bias_drift_range_end = sensor_properties["bias_drift_range_end"].values[0]
+        self.bias_drift_oscillations = sensor_properties["bias_drift_oscillations"].values[0]
+        self.bias_norm_factor = sensor_properties["bias_norm_factor"].values[0]
+        self.noise_coefficient = sensor_properties["noise_coefficient"].values[0]
+        self.delay_minutes = sensor_properties["delay"].values[0]
+        self.random_seed = sensor_properties["random_seed"].values[0]
+        self.bias_drift_type = sensor_properties["bias_drift_type"].values[0]
+
+        self.reading_delay_buffer = ReadingDelayBuffer(int(self.delay_minutes / self.minutes_per_reading))
+
+        self.calculate_sensor_bias_properties()
+
+    def calculate_sensor_bias_properties(self):
+        """
+        Calculates the bias factor and sets up the time series noise and bias drift over the sensor life,
+        which are generated as the sensor uses them
+        """
+
+        self.noise_stream = SensorNoiseStream(
+            random_seed=self.random_seed,
+            noise_coefficient=self.noise_coefficient,
+            bias_drift_type=self.bias_drift_type,
+            bias_drift_oscillations=self.bias_drift_oscillations,
+            phi_drift=self.phi_drift,
+            bias_drift_range_start=self.bias_drift_range_start,
+            num_values=self.noise_stream_num_values,
+        )
+
+        # bias of individual sensor
+        self.bias_factor = (self.bias_norm_factor + self.initial_bias) / (np.max([self.bias_norm_factor, 1]))
 
     def get_bg(self, true_bg_value):
         """
@@ -202,15 +519,11 @@ class iCGMSensor(Sensor):
             raise Exception("True bg must be a valid value, not None")
 
         # Get delayed true bg
-        delayed_true_bg = np.nan
-        self.reading_delay_buffer.append(true_bg_value)
-        if len(self.reading_delay_buffer) > int(self.delay_minutes / self.minutes_per_reading):
-            delayed_true_bg = self.reading_delay_buffer.pop(0)
+        delayed_true_bg = self.reading_delay_buffer.push(true_bg_value)
 
         # Calculate value
-        drift_multiplier = self.drift_multiplier[self.time_index]
-        noise = self.noise[self.time_index]
-        icgm_value = (delayed_true_bg * self.bias_factor * drift_multiplier) + noise
+        noise, drift_multiplier = self.noise_stream.get_values(self.time_index, self.time_index + 1)
+        icgm_value = (delayed_true_bg * self.bias_factor * drift_multiplier[0]) + noise[0]
 
         return icgm_value
 
@@ -219,7 +532,9 @@ class iCGMSensor(Sensor):
         This is STATELESS. Will compute the trace but not advance the state of the sensor. To advance
         sensor state use the update() function.
 
-        Given a trace of true bg values, calculate the sensor bgs using the current sensor state
+        Given a trace of true bg values, calculate the sensor bgs using the current sensor state.
+        The values match calling get_bg() on each true bg in turn from the current state. The delay is
+        applied as a shift of the true bg trace that continues from the readings in the delay buffer.
 
         Parameters
         ----------
@@ -231,40 +546,176 @@ class iCGMSensor(Sensor):
         sensor_bg_trace : numpy float array
             The array of iCGM sensor bgs generated from the true_bg_trace
         """
-        delay_buffer_original = copy.copy(self.reading_delay_buffer)
-        time_index_original = copy.copy(self.time_index)
+        true_bg_trace = np.asarray(true_bg_trace, dtype=float)
+        num_values = len(true_bg_trace)
+        end_time_index = self.time_index + num_values
+
+        noise, drift_multiplier = self.noise_stream.get_values(self.time_index, end_time_index)
 
-        sensor_bg_trace = []
+        # Each value is delayed by delay_steps readings, the first ones come from the delay buffer and
+        # any before the buffer has filled are nan
+        delay_steps = int(self.delay_minutes / self.minutes_per_reading)
+        num_buffered = len(self.reading_delay_buffer)
+        first_delayed_index = max(num_buffered - delay_steps, 0)
+        num_delayed = min(max(num_buffered + num_values - delay_steps, 0), num_values)
 
-        for true_bg_value in true_bg_trace:
-            sensor_bg = self.get_bg(true_bg_value)
-            sensor_bg_trace.append(sensor_bg)
-            self.time_index += 1
+        delayed_true_bg = np.full(num_values, np.nan)
+        if num_delayed > 0:
+            delay_line = np.concatenate([self.reading_delay_buffer.get_values(), true_bg_trace])
+            delayed_true_bg[num_values - num_delayed :] = delay_line[
+                first_delayed_index : first_delayed_index + num_delayed
+            ]
 
-        # Reset any changed sensor state
-        self.reading_delay_buffer = delay_buffer_original
-        self.time_index = time_index_original
+        sensor_bg_trace = (delayed_true_bg * self.bias_factor * drift_multiplier) + noise
 
         return sensor_bg_trace
 
-    def prefill_sensor_history(self, true_bg_history):
-        """Prefills the sensor with true bgs and calculates the corresponding sensor bgs"""
 
-        history_start_time = self.current_datetime - datetime.timedelta(minutes=len(true_bg_history) * 5)
-        self.current_datetime = history_start_time
+class iCGMSensorFleet(iCGMSensorBase):
+    """iCGM Sensors stepped together, with the state of every sensor held in arrays
 
-        try:
-            for true_bg_value in true_bg_history:
-                next_datetime = self.current_datetime + datetime.timedelta(minutes=5)
-                self.update(next_datetime, patient_true_bg=true_bg_value)
-        except SensorExpiredError as e:
-            e_message = (
-                "Trying to prefill past sensor life. "
-                + "Establish the sensor at a different time_index or prefill with less data."
+    Each sensor gives the same values as an iCGMSensor with the same properties, but update() and
+    get_bg_trace() advance all of the sensors with one set of array operations.
+
+    Parameters
+        ----------
+        current_datetime : datetime.datetime or None
+            The datetime timestamp associated with the time_index, shared by the sensors
+        sensor_properties : pandas DataFrame object
+            One row of iCGM Sensor properties for each sensor
+        sensor_life_days : int
+            The number of days the sensors will last.
+        time_index : int
+            The internal time of the sensors, used for errors and drift over the sensor life.
+            (1 = 5 minutes, 2 = 10 minutes, etc)
+
+    """
+
+    def __init__(self, current_datetime, sensor_properties, sensor_life_days=10, time_index=0):
+
+        if sensor_properties is None:
+            raise Exception("No Sensor Properties Given")
+
+        self.n_sensors = len(sensor_properties)
+
+        super().__init__(current_datetime, sensor_life_days, time_index, sensor_shape=(self.n_sensors,))
+
+        initial_bias = sensor_properties["initial_bias"].values.astype(float)
+        bias_norm_factor = sensor_properties["bias_norm_factor"].values.astype(float)
+        self.bias_factor = (bias_norm_factor + initial_bias) / np.maximum(bias_norm_factor, 1)
+
+        # The same noise streams as iCGMSensor. Each chunk is generated once for all of the sensors as the
+        # fleet reaches it.
+        self.noise_streams = [
+            SensorNoiseStream(
+                random_seed=sensor["random_seed"],
+                noise_coefficient=sensor["noise_coefficient"],
+                bias_drift_type=sensor["bias_drift_type"],
+                bias_drift_oscillations=sensor["bias_drift_oscillations"],
+                phi_drift=sensor["phi_drift"],
+                bias_drift_range_start=sensor["bias_drift_range_start"],
+                num_values=self.noise_stream_num_values,
             )
-            raise SensorExpiredError(e_message)
+            for _, sensor in sensor_properties.iterrows()
+        ]
 
-    def get_loop_inputs(self):
-        """Get two arrays for dates and values, used for Loop input"""
-        loop_bg_values = [max(40, min(400, round(bg))) for bg in self.sensor_bg_history]
-        return self.datetime_history, loop_bg_values
+        # Generated (noise, drift_multiplier) of every sensor by chunk index, shape (n_sensors, chunk size)
+        self.noise_chunks = {}
+
+        # Delay line of the true bgs shared by all sensors. Each sensor reads it at its own delay,
+        # the newest reading is at (num_delay_readings - 1) % ring length.
+        self.delay_steps = (sensor_properties["delay"].values / self.minutes_per_reading).astype(int)
+        self.true_bg_ring = np.full((self.n_sensors, np.max(self.delay_steps, initial=0) + 1), np.nan)
+        self.num_delay_readings = 0
+
+    def get_bg(self, true_bg_vector):
+        """
+        Calculate the iCGM value of every sensor, pushing the true bgs onto the delay line.
+
+        Parameters
+        ----------
+        true_bg_vector : numpy float array
+            The true blood glucose value (mg/dL) for each sensor, or one shared by all of them
+
+        Returns
+        -------
+        icgm_values : numpy float array
+            The generated iCGM value of each sensor, nan until a sensor's delay has filled
+        """
+        if true_bg_vector is None:
+            raise Exception("True bg must be a valid value, not None")
+
+        ring_length = self.true_bg_ring.shape[1]
+        newest_index = self.num_delay_readings % ring_length
+        self.true_bg_ring[:, newest_index] = true_bg_vector
+        self.num_delay_readings += 1
+
+        sensor_index = np.arange(self.n_sensors)
+        delayed_true_bg = self.true_bg_ring[sensor_index, (newest_index - self.delay_steps) % ring_length]
+        delayed_true_bg[self.delay_steps >= self.num_delay_readings] = np.nan
+
+        noise, drift_multiplier = self.get_noise_and_drift(self.time_index, self.time_index + 1)
+        icgm_values = (delayed_true_bg * self.bias_factor * drift_multiplier[:, 0]) + noise[:, 0]
+
+        return icgm_values
+
+    def get_bg_trace(self, true_bg_matrix):
+        """
+        This is STATELESS. Will compute the traces but not advance the state of the sensors. To advance
+        sensor state use the update() function.
+
+        Parameters
+        ----------
+        true_bg_matrix : numpy float array
+            The true blood glucose value trace (mg/dL) for each sensor, shape (n_sensors, number of values),
+            or one trace shared by all of them
+
+        Returns
+        -------
+        sensor_bg_traces : numpy float array
+            The iCGM sensor bgs of each sensor, shape (n_sensors, number of values)
+        """
+        true_bg_matrix = np.asarray(true_bg_matrix, dtype=float)
+        true_bg_matrix = np.broadcast_to(true_bg_matrix, (self.n_sensors, true_bg_matrix.shape[-1]))
+        num_values = true_bg_matrix.shape[1]
+        end_time_index = self.time_index + num_values
+
+        noise, drift_multiplier = self.get_noise_and_drift(self.time_index, end_time_index)
+
+        # The delay line oldest first, unfilled readings are nan, followed by the trace. Each value
+        # is the one delay_steps before it.
+        ring_length = self.true_bg_ring.shape[1]
+        delay_line = np.concatenate(
+            [np.roll(self.true_bg_ring, -(self.num_delay_readings % ring_length), axis=1), true_bg_matrix], axis=1
+        )
+        delayed_index = ring_length + np.arange(num_values) - self.delay_steps[:, np.newaxis]
+        delayed_true_bg = np.take_along_axis(delay_line, delayed_index, axis=1)
+
+        sensor_bg_traces = (delayed_true_bg * self.bias_factor[:, np.newaxis] * drift_multiplier) + noise
+
+        return sensor_bg_traces
+
+    def get_noise_and_drift(self, start_index, end_index):
+        """
+        Get the noise and drift multiplier of every sensor for readings start_index up to end_index.
+        Only the chunks covering them are generated, and earlier chunks are dropped.
+
+        Returns
+        -------
+        noise, drift_multiplier : numpy float arrays
+            The values, shape (n_sensors, end_index - start_index)
+        """
+        if end_index > self.noise_stream_num_values:
+            raise SensorExpiredError("Sensor bg trace extends past the sensor's noise and drift.")
+
+        return get_chunked_values(
+            self.noise_chunks, start_index, end_index, NOISE_CHUNK_NUM_READINGS, self._get_noise_chunk
+        )
+
+    def _get_noise_chunk(self, chunk_index):
+        """Generate a chunk of the sensors' noise streams, stacked into (n_sensors, chunk size) arrays"""
+        chunks = [noise_stream.get_chunk(chunk_index) for noise_stream in self.noise_streams]
+        noise = np.array([noise for noise, _ in chunks]).reshape(self.n_sensors, -1)
+        drift_multiplier = np.array([drift for _, drift in chunks]).reshape(self.n_sensors, -1)
+
+        return noise, drift_multiplier
@@ -11,7 +11,7 @@ The Dexcom G6 Specifications in this file are publicly available from:
 # %% Libraries
 import numpy as np
 from scipy.optimize import brute, fmin
-from tidepool_data_science_models.models.icgm_sensor import iCGMSensor
+from tidepool_data_science_models.models.icgm_sensor import iCGMSensor, iCGMSensorFleet
 import tidepool_data_science_models.models.icgm_sensor_generator_functions as sf
 import multiprocessing
 multiprocessing.set_start_method("fork")
@@ -92,6 +92,7 @@ class iCGMSensorGenerator(object):
 
         self.icgm_traces = None
         self.individual_sensor_properties = None
+        self.sensor_fleet = None
         self.batch_sensor_brute_search_results = None
         self.batch_sensor_properties = None
         self.dist_params = None
@@ -141,6 +142,51 @@ class iCGMSensorGenerator(object):
 
     def generate_sensors(self, n_sensors, sensor_start_datetime, sensor_start_time_index=0):
 
+        self._generate_individual_sensor_properties(n_sensors)
+
+        sensors = []
+
+        for sensor_num in range(n_sensors):
+            sensor_properties = self.individual_sensor_properties.loc[sensor_num]
+            sensors.append(
+                iCGMSensor(
+                    sensor_properties=sensor_properties,
+                    time_index=sensor_start_time_index,
+                    current_datetime=sensor_start_datetime,
+                )
+            )
+
+        self.n_sensors = n_sensors
+        self.sensors = sensors  # Array of sensor objects
+
+        return sensors
+
+    def generate_sensor_fleet(self, n_sensors, sensor_start_datetime, sensor_start_time_index=0):
+        """
+        Generate sensors like generate_sensors(), held in one iCGMSensorFleet that steps them together.
+
+        Returns
+        -------
+        iCGMSensorFleet
+            The sensors, in the same order and with the same values as generate_sensors()
+        """
+
+        self._generate_individual_sensor_properties(n_sensors)
+
+        sensor_fleet = iCGMSensorFleet(
+            sensor_properties=self.individual_sensor_properties,
+            time_index=sensor_start_time_index,
+            current_datetime=sensor_start_datetime,
+        )
+
+        self.n_sensors = n_sensors
+        self.sensor_fleet = sensor_fleet
+
+        return sensor_fleet
+
+    def _generate_individual_sensor_properties(self, n_sensors):
+        """Draw n_sensors sets of sensor properties from the fit distribution"""
+
         if self.dist_params is None:
             raise Exception("iCGM Sensor Generator has not been fit() to a true_bg_trace distribution.")
 
@@ -171,20 +217,3 @@ class iCGMSensorGenerator(object):
             delay=self.delay,
             random_seed=self.random_seed,
         )
-
-        sensors = []
-
-        for sensor_num in range(n_sensors):
-            sensor_properties = self.individual_sensor_properties.loc[sensor_num]
-            sensors.append(
-                iCGMSensor(
-                    sensor_properties=sensor_properties,
-                    time_index=sensor_start_time_index,
-                    current_datetime=sensor_start_datetime,
-                )
-            )
-
-        self.n_sensors = n_sensors
-        self.sensors = sensors  # Array of sensor objects
-
-        return sensors
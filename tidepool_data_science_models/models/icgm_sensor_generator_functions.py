@@ -25,6 +25,9 @@ import datetime
 EPS = sys.float_info.epsilon
 MICRO = 1e-6
 
+# Most random values drawn at once in generate_icgm_sensors, bounding the float64 draws
+NOISE_BLOCK_MAX_VALUES = 2 ** 20
+
 
 # FUNCTIONS
 def create_dataset(
@@ -136,26 +139,34 @@ def generate_icgm_sensors(
     noise_coefficient=0,  # (0 ~ 60dB, 5 ~ 36 dB, 10, 30 dB)
     delay=5,  # (suggest 0, 5, 10, 15)
     random_seed=0,
+    dtype=np.float64,  # (float32 halves the memory of the traces)
 ):
     # set a random seed for reproducibility
 
     np.random.seed(seed=random_seed)
-    true_matrix = np.tile(true_bg_trace, (n_sensors, 1))
+    true_matrix = np.tile(np.asarray(true_bg_trace, dtype=dtype), (n_sensors, 1))
 
     # get the initial bias
     a, b, mu, sigma = dist_params
     initial_bias = johnsonsu.rvs(a=a, b=b, loc=mu, scale=sigma, size=n_sensors)
 
-    # add noise
-    noise = np.random.normal(loc=0, scale=np.max([noise_coefficient, EPS]), size=(n_sensors, len(true_bg_trace)))
+    # add noise, drawn in blocks of sensors so only the dtype matrix is full size.
+    # The draws are in the same order as one (n_sensors, n_values) draw.
+    noise = np.empty((n_sensors, len(true_bg_trace)), dtype=dtype)
+    n_sensors_per_block = max(1, NOISE_BLOCK_MAX_VALUES // max(len(true_bg_trace), 1))
+    for start in range(0, n_sensors, n_sensors_per_block):
+        end = min(start + n_sensors_per_block, n_sensors)
+        noise[start:end] = np.random.normal(
+            loc=0, scale=np.max([noise_coefficient, EPS]), size=(end - start, len(true_bg_trace))
+        )
 
     # bias drift
     if "none" in bias_drift_type:
-        drift_multiplier = np.ones(np.shape(true_matrix))
+        drift_multiplier = np.ones(np.shape(true_matrix), dtype=dtype)
         phi = 0
 
     if "linear" in bias_drift_type:
-        drift_multiplier = np.linspace(bias_drift_range[0], bias_drift_range[1], len(true_bg_trace))
+        drift_multiplier = np.linspace(bias_drift_range[0], bias_drift_range[1], len(true_bg_trace), dtype=dtype)
         drift_multiplier = np.tile(drift_multiplier, (n_sensors, 1))
 
     if "random" in bias_drift_type:
@@ -163,12 +174,12 @@ def generate_icgm_sensors(
 
         if bias_drift_oscillations == 0:
             bias_drift_oscillations = 1 / 32
-        t = np.linspace(0, (bias_drift_oscillations * np.pi), len(true_bg_trace))
+        t = np.linspace(0, (bias_drift_oscillations * np.pi), len(true_bg_trace), dtype=dtype)
         t_matrix = np.tile(t, (n_sensors, 1))
-        phi_matrix = np.tile(phi, (len(true_bg_trace), 1)).T
+        phi_matrix = np.tile(phi.astype(dtype), (len(true_bg_trace), 1)).T
         sn = np.sin(t_matrix + phi_matrix)
 
-        drift_multiplier = np.interp(sn, (-1, 1), (bias_drift_range[0], bias_drift_range[1]))
+        drift_multiplier = np.interp(sn, (-1, 1), (bias_drift_range[0], bias_drift_range[1])).astype(dtype, copy=False)
 
     # if the bias type is percentage_of_value (varies by value)
     if "percentage_of_value" in bias_type:
@@ -182,7 +193,7 @@ def generate_icgm_sensors(
         norm_factor = 0
 
     bias_factor = (norm_factor + initial_bias) / (np.max([norm_factor, 1]))
-    bias_factor_matrix = np.tile(bias_factor, (len(true_bg_trace), 1)).T
+    bias_factor_matrix = np.tile(bias_factor.astype(dtype), (len(true_bg_trace), 1)).T
     iCGM = ((true_matrix * bias_factor_matrix) * drift_multiplier) + noise
     # else:
     #     bias_matrix = np.tile(initial_bias, (len(true_bg_trace), 1)).T
@@ -0,0 +1,299 @@
+"""
+This file houses the compute kernels behind the treatment model runs. Each backend fills caller
+provided output buffers, so the models can swap backends without changing their outputs' layout.
+
+The NumPy backend is the default. The Numba backend fuses each model into a single compiled loop
+and is available when numba is installed.
+"""
+
+import numpy as np
+
+from tidepool_data_science_models.models.curve_cache import UNIT_RESPONSE_CACHE
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+DEFAULT_KERNEL_BACKEND = "numpy"
+
+
+class NumpyKernelBackend(object):
+    """
+    Vectorized kernels. The dose independent curve shapes come from the unit response cache and
+    results are written into the output buffers, so the outputs match the original array code exactly.
+    """
+
+    name = "numpy"
+
+    def palerm_insulin(self, insulin_amount, isf, tau1, tau2, kcl, minutes_per_step, bg, iob, bg_delta, scratch=None):
+        """
+        Palerm insulin response to a dose at t=0, every minutes_per_step minutes.
+
+        Parameters
+        ----------
+        insulin_amount: float
+            The insulin given at t=0, units: U
+
+        isf: float
+            Insulin sensitivity factor
+
+        tau1: float
+            Palerm tau1
+
+        tau2: float
+            Palerm tau2
+
+        kcl: float
+            Palerm kcl
+
+        minutes_per_step: int
+            Minutes between outputs, e.g. 5 or 1
+
+        bg: np.array
+            Output for the bg starting at 0, its length sets the number of time steps
+
+        iob: np.array
+            Output for the insulin on board, same length as bg
+
+        bg_delta: np.array
+            Output for the change in bg at each time step, same length as bg
+
+        scratch: np.array or None
+            Buffer of at least (len(bg) - 1) * minutes_per_step + 1 values for the 1 minute insulin curve.
+            Allocated if None.
+        """
+        if len(bg) == 0:
+            return
+
+        num_minutes = (len(bg) - 1) * minutes_per_step + 1
+        gain = insulin_amount * (1 / (kcl * (tau2 - tau1)))
+        activity_shape = get_palerm_activity_shape(tau1, tau2, num_minutes)
+        if scratch is None:
+            insulin = gain * activity_shape
+        else:
+            insulin = np.multiply(gain, activity_shape, out=scratch[:num_minutes])
+
+        insulin_cleared = np.cumsum(insulin, out=insulin)[::minutes_per_step]
+        np.subtract(insulin_amount, insulin_cleared, out=iob)
+        np.multiply(-1 * isf, insulin_cleared, out=bg)
+
+        _get_difference(bg, out=bg_delta)
+
+    def cescon_carb(self, carb_amount, isf, cir, tau, theta, minutes_per_step, bg, bg_delta):
+        """
+        Cescon carb response to carbs eaten at t=0, every minutes_per_step minutes.
+
+        Parameters
+        ----------
+        carb_amount: float
+            The carbs eaten at t=0, units: g
+
+        isf: float
+            Insulin sensitivity factor
+
+        cir: float
+            Carb insulin ratio
+
+        tau: float
+            Cescon tau
+
+        theta: float
+            Cescon theta
+
+        minutes_per_step: int
+            Minutes between outputs, e.g. 5 or 1
+
+        bg: np.array
+            Output for the bg starting at 0, its length sets the number of time steps
+
+        bg_delta: np.array
+            Output for the change in bg at each time step, same length as bg
+        """
+        if len(bg) == 0:
+            return
+
+        K = isf / cir  # mg/dL / g = (mg/dL / U) / (g / U)
+        np.multiply(K * carb_amount, get_cescon_absorption_shape(tau, theta, minutes_per_step, len(bg)), out=bg)
+
+        _get_difference(bg, out=bg_delta)
+
+
+class NumbaKernelBackend(object):
+    """
+    Kernels compiled with numba that compute each model in one pass over the output buffers,
+    with no temporary arrays. They agree with the NumPy backend to floating point precision.
+    """
+
+    name = "numba"
+
+    def __init__(self):
+        if numba is None:
+            raise ValueError("The numba kernel backend requires numba to be installed.")
+
+        self._palerm_insulin = numba.njit(cache=True)(_palerm_insulin_loop)
+        self._cescon_carb = numba.njit(cache=True)(_cescon_carb_loop)
+
+    def palerm_insulin(self, insulin_amount, isf, tau1, tau2, kcl, minutes_per_step, bg, iob, bg_delta, scratch=None):
+        """Same as NumpyKernelBackend.palerm_insulin, the fused loop needs no scratch buffer"""
+        self._palerm_insulin(
+            float(insulin_amount),
+            float(isf),
+            float(tau1),
+            float(tau2),
+            float(kcl),
+            int(minutes_per_step),
+            bg,
+            iob,
+            bg_delta,
+        )
+
+    def cescon_carb(self, carb_amount, isf, cir, tau, theta, minutes_per_step, bg, bg_delta):
+        """Same as NumpyKernelBackend.cescon_carb"""
+        self._cescon_carb(
+            float(carb_amount), float(isf), float(cir), float(tau), float(theta), int(minutes_per_step), bg, bg_delta
+        )
+
+
+def _palerm_insulin_loop(insulin_amount, isf, tau1, tau2, kcl, minutes_per_step, bg, iob, bg_delta):
+    """Fused Palerm kernel, compiled by NumbaKernelBackend"""
+    gain = insulin_amount * (1 / (kcl * (tau2 - tau1)))
+
+    insulin_cleared = 0.0
+    next_minute = 0
+    previous_bg = 0.0
+    for i in range(len(bg)):
+        # Sum the 1 minute activity curve up to this time step
+        while next_minute <= i * minutes_per_step:
+            insulin_cleared += gain * (np.exp(-next_minute / tau2) - np.exp(-next_minute / tau1))
+            next_minute += 1
+
+        iob[i] = insulin_amount - insulin_cleared
+        bg[i] = -1 * isf * insulin_cleared
+        bg_delta[i] = bg[i] - previous_bg if i > 0 else 0.0
+        previous_bg = bg[i]
+
+
+def _cescon_carb_loop(carb_amount, isf, cir, tau, theta, minutes_per_step, bg, bg_delta):
+    """Fused Cescon kernel, compiled by NumbaKernelBackend"""
+    gain = isf / cir * carb_amount
+
+    previous_bg = 0.0
+    for i in range(len(bg)):
+        t = i * minutes_per_step
+        bg[i] = gain * (1 - np.exp((theta - t) / tau)) if t >= theta else 0.0
+        bg_delta[i] = bg[i] - previous_bg if i > 0 else 0.0
+        previous_bg = bg[i]
+
+
+KERNEL_BACKENDS = {
+    "numpy": NumpyKernelBackend,
+    "numba": NumbaKernelBackend,
+}
+
+_kernel_backend_instances = {}
+
+
+def get_available_kernel_backends():
+    """
+    Get the names of the backends that can be used in this environment.
+
+    Returns
+    -------
+    list
+        Backend names, the NumPy backend is always available
+    """
+    return [name for name in KERNEL_BACKENDS if name != "numba" or numba is not None]
+
+
+def get_kernel_backend(name=None):
+    """
+    Get a kernel backend by name. Backends are stateless so one instance is shared per name.
+
+    Parameters
+    ----------
+    name: str or None
+        One of KERNEL_BACKENDS, defaults to DEFAULT_KERNEL_BACKEND
+
+    Returns
+    -------
+    NumpyKernelBackend or NumbaKernelBackend
+    """
+    name = DEFAULT_KERNEL_BACKEND if name is None else name
+
+    if name not in KERNEL_BACKENDS:
+        raise ValueError("{} not a recognized kernel backend.".format(name))
+
+    if name not in _kernel_backend_instances:
+        _kernel_backend_instances[name] = KERNEL_BACKENDS[name]()
+
+    return _kernel_backend_instances[name]
+
+
+def get_palerm_activity_shape(tau1, tau2, num_minutes):
+    """
+    Get the dose independent part of the 1 minute Palerm activity curve, exp(-t / tau2) - exp(-t / tau1),
+    from the unit response cache.
+
+    Parameters
+    ----------
+    tau1: float
+        Palerm tau1
+
+    tau2: float
+        Palerm tau2
+
+    num_minutes: int
+        Number of minutes from t=0
+
+    Returns
+    -------
+    np.array
+        The read-only curve
+    """
+
+    def compute_activity_shape():
+        t_min = np.arange(num_minutes)
+        return np.exp(-t_min / tau2) - np.exp(-t_min / tau1)
+
+    key = ("Palerm", "activity_shape", tau1, tau2, num_minutes)
+    return UNIT_RESPONSE_CACHE.get_or_compute(key, compute_activity_shape)
+
+
+def get_cescon_absorption_shape(tau, theta, minutes_per_step, num_steps):
+    """
+    Get the carb amount independent part of the Cescon curve, (1 - exp((theta - t) / tau)) * heaviside(t - theta),
+    from the unit response cache.
+
+    Parameters
+    ----------
+    tau: float
+        Cescon tau
+
+    theta: float
+        Cescon theta
+
+    minutes_per_step: int
+        Minutes between time steps
+
+    num_steps: int
+        Number of time steps from t=0
+
+    Returns
+    -------
+    np.array
+        The read-only curve
+    """
+
+    def compute_absorption_shape():
+        t_min = np.arange(num_steps) * minutes_per_step
+        return (1 - np.exp((theta - t_min) / tau)) * np.heaviside(t_min - theta, 1)
+
+    key = ("Cescon", "absorption_shape", tau, theta, minutes_per_step, num_steps)
+    return UNIT_RESPONSE_CACHE.get_or_compute(key, compute_absorption_shape)
+
+
+def _get_difference(values, out):
+    """Write the change from the previous value into out, 0 for the first value"""
+    out[0] = 0
+    np.subtract(values[1:], values[:-1], out=out[1:])
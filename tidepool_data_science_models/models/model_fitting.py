@@ -0,0 +1,356 @@
+"""
+This file houses batched least squares fitting of the treatment model parameters to observed bg curves.
+"""
+
+import numpy as np
+
+from tidepool_data_science_models.models.treatment_models import (
+    PALERM_PARAMETER_NAMES,
+    CESCON_PARAMETER_NAMES,
+    get_palerm_bg_jacobian,
+    get_cescon_bg_jacobian,
+)
+
+# Starting values for the kinetic parameters, these match the model defaults
+PALERM_INITIAL_PARAMETERS = {"tau1": 55.0, "tau2": 70.0, "kcl": 1.0}
+CESCON_INITIAL_PARAMETERS = {"tau": 42.0, "theta": 20.0}
+
+# Parameters are kept at or above these during fitting, time constants are at least a minute
+PALERM_LOWER_BOUNDS = {"isf": 0.0, "tau1": 1.0, "tau2": 1.0, "kcl": 1e-3}
+CESCON_LOWER_BOUNDS = {"isf": 0.0, "cir": 1e-3, "tau": 1.0, "theta": 0.0}
+
+# Levenberg-Marquardt damping schedule
+INITIAL_DAMPING = 1e-3
+DAMPING_FACTOR = 3.0
+MAX_DAMPING = 1e12
+
+
+def fit_palerm_insulin_curves(
+    t,
+    observed_bg,
+    insulin_amounts,
+    initial_parameters=None,
+    fit_parameters=("isf", "tau1", "tau2"),
+    max_iterations=100,
+    tolerance=1e-10,
+):
+    """
+    Fit the Palerm insulin model to the bg response of many patients to an insulin dose at t=0.
+
+    All patients are fit at once with Levenberg-Marquardt on the analytic jacobian from
+    get_palerm_bg_jacobian, so each iteration is a handful of array operations over
+    (n_patients, n_times) and a batched solve of (n_fit_parameters, n_fit_parameters) systems.
+
+    Parameters
+    ----------
+    t: array-like
+        Times in minutes since the insulin was given, shape (n_times,) or (n_patients, n_times)
+
+    observed_bg: array-like
+        The change in bg since t=0 for each patient and time, shape (n_patients, n_times).
+        np.nan marks missing readings, which are left out of the fit.
+
+    insulin_amounts: float or array-like
+        The insulin given at t=0, shared or for each patient
+
+    initial_parameters: dict or None
+        Starting value for any of isf, tau1, tau2 and kcl, shared or for each patient. Parameters not
+        being fit stay at these values. Defaults to PALERM_INITIAL_PARAMETERS and, for isf, the least
+        squares isf for those curve shapes.
+
+    fit_parameters: tuple
+        Names of the parameters to fit
+
+    max_iterations: int
+        Maximum number of Levenberg-Marquardt iterations
+
+    tolerance: float
+        Patients stop iterating once an accepted step lowers their residual sum of squares
+        by less than this fraction
+
+    Returns
+    -------
+    (dict, np.array, np.array, np.array)
+        parameters: The fitted value of each parameter in PALERM_PARAMETER_NAMES for each patient
+        residual_sum_of_squares: The fit error for each patient
+        converged: Whether each patient reached a minimum within max_iterations
+        stalled: Whether each patient stopped away from a minimum because no step lowered its
+        fit error. Patients neither converged nor stalled ran out of iterations.
+    """
+    observed_bg = np.atleast_2d(np.asarray(observed_bg, dtype=float))
+    insulin_amounts = np.asarray(insulin_amounts, dtype=float)
+    if insulin_amounts.ndim == 1:
+        insulin_amounts = insulin_amounts[:, np.newaxis]
+
+    def get_bg_jacobian(parameters):
+        isf, tau1, tau2, kcl = [parameters[:, [i]] for i in range(len(PALERM_PARAMETER_NAMES))]
+        return get_palerm_bg_jacobian(t, insulin_amounts, isf, tau1, tau2, kcl)
+
+    return _fit_isf_scaled_curves(
+        get_bg_jacobian,
+        observed_bg,
+        PALERM_PARAMETER_NAMES,
+        dict(PALERM_INITIAL_PARAMETERS, **(initial_parameters or {})),
+        PALERM_LOWER_BOUNDS,
+        fit_parameters,
+        max_iterations,
+        tolerance,
+    )
+
+
+def fit_cescon_carb_curves(
+    t,
+    observed_bg,
+    carb_amounts,
+    cirs,
+    initial_parameters=None,
+    fit_parameters=("isf", "tau", "theta"),
+    max_iterations=100,
+    tolerance=1e-10,
+):
+    """
+    Fit the Cescon carb model to the bg response of many patients to carbs eaten at t=0.
+
+    isf and cir only enter the curve as isf / cir, so fitting both at once is ill-posed. By default
+    cir is held at the given values and isf is fit. All patients are fit at once with
+    Levenberg-Marquardt on the analytic jacobian from get_cescon_bg_jacobian.
+
+    Parameters
+    ----------
+    t: array-like
+        Times in minutes since the carbs were eaten, shape (n_times,) or (n_patients, n_times)
+
+    observed_bg: array-like
+        The change in bg since t=0 for each patient and time, shape (n_patients, n_times).
+        np.nan marks missing readings, which are left out of the fit.
+
+    carb_amounts: float or array-like
+        The carbs eaten at t=0, shared or for each patient
+
+    cirs: float or array-like
+        Carb insulin ratio, shared or for each patient
+
+    initial_parameters: dict or None
+        Starting value for any of isf, tau and theta, shared or for each patient. Parameters not
+        being fit stay at these values. Defaults to CESCON_INITIAL_PARAMETERS and, for isf, the least
+        squares isf for those curve shapes.
+
+    fit_parameters: tuple
+        Names of the parameters to fit
+
+    max_iterations: int
+        Maximum number of Levenberg-Marquardt iterations
+
+    tolerance: float
+        Patients stop iterating once an accepted step lowers their residual sum of squares
+        by less than this fraction
+
+    Returns
+    -------
+    (dict, np.array, np.array, np.array)
+        parameters: The fitted value of each parameter in CESCON_PARAMETER_NAMES for each patient
+        residual_sum_of_squares: The fit error for each patient
+        converged: Whether each patient reached a minimum within max_iterations
+        stalled: Whether each patient stopped away from a minimum because no step lowered its
+        fit error. Patients neither converged nor stalled ran out of iterations.
+    """
+    observed_bg = np.atleast_2d(np.asarray(observed_bg, dtype=float))
+    carb_amounts = np.asarray(carb_amounts, dtype=float)
+    if carb_amounts.ndim == 1:
+        carb_amounts = carb_amounts[:, np.newaxis]
+
+    def get_bg_jacobian(parameters):
+        isf, cir, tau, theta = [parameters[:, [i]] for i in range(len(CESCON_PARAMETER_NAMES))]
+        return get_cescon_bg_jacobian(t, carb_amounts, isf, cir, tau, theta)
+
+    return _fit_isf_scaled_curves(
+        get_bg_jacobian,
+        observed_bg,
+        CESCON_PARAMETER_NAMES,
+        dict(CESCON_INITIAL_PARAMETERS, **dict({"cir": cirs}, **(initial_parameters or {}))),
+        CESCON_LOWER_BOUNDS,
+        fit_parameters,
+        max_iterations,
+        tolerance,
+    )
+
+
+def _fit_isf_scaled_curves(
+    get_bg_jacobian,
+    observed_bg,
+    parameter_names,
+    initial_parameters,
+    lower_bounds,
+    fit_parameters,
+    max_iterations,
+    tolerance,
+):
+    """
+    Shared setup for models whose bg is proportional to isf: start isf at its least squares value
+    for the initial curve shapes when not given, then run the batched fit.
+    """
+    num_patients = observed_bg.shape[0]
+
+    unknown_parameters = set(fit_parameters) - set(parameter_names)
+    if unknown_parameters:
+        raise ValueError("Can't fit unknown parameters {}".format(sorted(unknown_parameters)))
+
+    parameters = np.column_stack(
+        [
+            np.broadcast_to(np.asarray(initial_parameters.get(name, 1.0), dtype=float), (num_patients,))
+            for name in parameter_names
+        ]
+    )
+
+    if "isf" not in initial_parameters:
+        unit_bg, _ = get_bg_jacobian(parameters)
+        is_observed = ~np.isnan(observed_bg)
+        unit_bg = np.where(is_observed, unit_bg, 0.0)
+        observed = np.where(is_observed, observed_bg, 0.0)
+        unit_bg_norm = np.sum(unit_bg ** 2, axis=1)
+        parameters[:, 0] = np.where(
+            unit_bg_norm > 0, np.sum(unit_bg * observed, axis=1) / np.where(unit_bg_norm > 0, unit_bg_norm, 1), 1.0
+        )
+        parameters[:, 0] = np.maximum(parameters[:, 0], lower_bounds["isf"])
+
+    fit_columns = [parameter_names.index(name) for name in fit_parameters]
+    parameters, residual_sum_of_squares, converged, stalled = fit_least_squares(
+        get_bg_jacobian,
+        observed_bg,
+        parameters,
+        fit_columns,
+        np.array([lower_bounds[name] for name in parameter_names]),
+        max_iterations=max_iterations,
+        tolerance=tolerance,
+    )
+
+    fitted_parameters = {name: parameters[:, i] for i, name in enumerate(parameter_names)}
+
+    return fitted_parameters, residual_sum_of_squares, converged, stalled
+
+
+def fit_least_squares(
+    get_bg_jacobian, observed_bg, parameters, fit_columns, lower_bounds, max_iterations=100, tolerance=1e-10
+):
+    """
+    Batched Levenberg-Marquardt. Each patient has its own damping and is frozen once it converges
+    or stalls, while the curve and jacobian evaluations stay vectorized across all patients.
+
+    Parameters
+    ----------
+    get_bg_jacobian: callable
+        Maps parameters, shape (n_patients, n_parameters), to the modeled bg, shape (n_patients, n_times),
+        and its jacobian, shape (n_patients, n_times, n_parameters)
+
+    observed_bg: np.array
+        The observed bg, shape (n_patients, n_times), np.nan for missing readings
+
+    parameters: np.array
+        Initial parameters, shape (n_patients, n_parameters)
+
+    fit_columns: list
+        Indices of the parameters to fit, the others are held fixed
+
+    lower_bounds: np.array
+        Lower bound for each parameter, shape (n_parameters,). Steps are projected onto the bounds.
+
+    max_iterations: int
+        Maximum number of iterations
+
+    tolerance: float
+        Relative reduction of the residual sum of squares below which a patient has converged
+
+    Returns
+    -------
+    (np.array, np.array, np.array, np.array)
+        parameters: The fitted parameters, shape (n_patients, n_parameters)
+        residual_sum_of_squares: The fit error for each patient
+        converged: Whether each patient reached a minimum within max_iterations
+        stalled: Whether each patient stopped because its damping passed MAX_DAMPING while the
+        Gauss-Newton step still predicted a lower fit error, i.e. it's stuck away from a minimum
+    """
+    parameters = np.array(parameters, dtype=float)
+    num_patients = parameters.shape[0]
+
+    is_observed = ~np.isnan(observed_bg)
+    observed_bg = np.where(is_observed, observed_bg, 0.0)
+
+    def evaluate(parameters):
+        with np.errstate(all="ignore"):
+            bg, jacobian = get_bg_jacobian(parameters)
+        residual = np.where(is_observed, bg - observed_bg, 0.0)
+        jacobian = np.where(is_observed[..., np.newaxis], jacobian[..., fit_columns], 0.0)
+        residual_sum_of_squares = np.sum(residual ** 2, axis=1)
+        # A step into a singularity, e.g. tau1 == tau2, is rejected like any step that doesn't improve the fit
+        is_valid = np.isfinite(residual_sum_of_squares) & np.all(np.isfinite(jacobian), axis=(1, 2))
+        return residual, jacobian, np.where(is_valid, residual_sum_of_squares, np.inf)
+
+    residual, jacobian, residual_sum_of_squares = evaluate(parameters)
+
+    damping = np.full(num_patients, INITIAL_DAMPING)
+    converged = np.zeros(num_patients, dtype=bool)
+    stalled = np.zeros(num_patients, dtype=bool)
+
+    for _ in range(max_iterations):
+        active = ~(converged | stalled)
+        if not np.any(active):
+            break
+
+        gradient = np.einsum("nti,nt->ni", jacobian, residual)
+        hessian = np.einsum("nti,ntj->nij", jacobian, jacobian)
+
+        with np.errstate(all="ignore"):
+            step = -_solve_damped(hessian, gradient, damping)
+        step = np.where(np.isfinite(step) & active[:, np.newaxis], step, 0.0)
+
+        candidate_parameters = parameters.copy()
+        candidate_parameters[:, fit_columns] = np.maximum(
+            parameters[:, fit_columns] + step, lower_bounds[fit_columns]
+        )
+
+        candidate_residual, candidate_jacobian, candidate_residual_sum_of_squares = evaluate(candidate_parameters)
+
+        improved = active & (candidate_residual_sum_of_squares < residual_sum_of_squares)
+        relative_improvement = (residual_sum_of_squares - candidate_residual_sum_of_squares) / np.maximum(
+            residual_sum_of_squares, np.finfo(float).tiny
+        )
+
+        parameters[improved] = candidate_parameters[improved]
+        residual[improved] = candidate_residual[improved]
+        jacobian[improved] = candidate_jacobian[improved]
+        residual_sum_of_squares = np.where(improved, candidate_residual_sum_of_squares, residual_sum_of_squares)
+        damping = np.where(improved, damping / DAMPING_FACTOR, damping * DAMPING_FACTOR)
+
+        converged |= improved & (relative_improvement < tolerance)
+        converged |= residual_sum_of_squares == 0
+
+        # Once the damping runs out no step lowers the fit error. At a minimum the Gauss-Newton step
+        # predicts no reduction either, beyond rounding, otherwise the patient is stuck away from one.
+        out_of_damping = active & ~converged & (damping > MAX_DAMPING)
+        if np.any(out_of_damping):
+            # Parameters at a lower bound can't move against a gradient that pushes them below it
+            at_bound = parameters[:, fit_columns] <= lower_bounds[fit_columns]
+            free_gradient = np.where(at_bound & (gradient > 0), 0.0, gradient)
+            with np.errstate(all="ignore"):
+                predicted_reduction = np.sum(
+                    free_gradient * _solve_damped(hessian, free_gradient, INITIAL_DAMPING), axis=1
+                )
+            at_minimum = predicted_reduction <= tolerance * np.sum(observed_bg ** 2, axis=1)
+
+            converged |= out_of_damping & at_minimum
+            stalled |= out_of_damping & ~at_minimum
+
+    return parameters, residual_sum_of_squares, converged, stalled
+
+
+def _solve_damped(hessian, gradient, damping):
+    """
+    Solve the Levenberg-Marquardt system for each patient. The damping is scaled by the diagonal
+    so parameters with different units are damped alike.
+    """
+    hessian_diagonal = np.diagonal(hessian, axis1=1, axis2=2)
+    damped_hessian = hessian + np.eye(hessian.shape[-1]) * (
+        np.reshape(damping, (-1, 1)) * np.maximum(hessian_diagonal, np.finfo(float).tiny)
+    )[:, np.newaxis, :]
+
+    return np.linalg.solve(damped_hessian, gradient[..., np.newaxis])[..., 0]
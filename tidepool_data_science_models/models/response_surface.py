@@ -0,0 +1,402 @@
+"""
+This file houses precomputed lookup tables of the metabolism model response for low latency queries.
+"""
+
+import os
+
+import numpy as np
+
+from tidepool_data_science_models.models.treatment_models import PalermInsulinModel, CesconCarbModel
+from tidepool_data_science_models.utils import EPSILON_TEST
+
+# Arrays saved in a table directory, one .npy file each
+RESPONSE_SURFACE_ARRAY_NAMES = (
+    "t_min",
+    "tau1s",
+    "tau2s",
+    "unit_insulin_cleared",
+    "taus",
+    "thetas",
+    "unit_carb_absorbed",
+)
+
+# Largest number of grid points allowed on one axis while refining to the tolerance
+MAX_AXIS_POINTS = 1025
+
+
+class ResponseSurfaceTable(object):
+    """
+    Precomputed response of SimpleMetabolismModel over a grid of the insulin and carb kinetics.
+
+    isf, cir, carbs and insulin enter the response linearly, so the table holds only the fraction
+    of 1 U of insulin cleared, over (tau1, tau2), and of 1 g of carbs absorbed, over (tau, theta),
+    and a query scales them. Queries between grid points are bilinearly interpolated. No exponentials
+    are evaluated at query time, and a table saved with save() can be opened memory-mapped so
+    many processes share it without loading it.
+    """
+
+    def __init__(self, t_min, tau1s, tau2s, unit_insulin_cleared, taus, thetas, unit_carb_absorbed):
+        """
+        Parameters
+        ----------
+        t_min: np.array
+            The time series in minutes, shape (n_times,)
+
+        tau1s: np.array
+            Sorted Palerm tau1 grid
+
+        tau2s: np.array
+            Sorted Palerm tau2 grid
+
+        unit_insulin_cleared: np.array
+            Insulin cleared for 1 U at each grid point and time, shape (n_tau1s, n_tau2s, n_times)
+
+        taus: np.array
+            Sorted Cescon tau grid
+
+        thetas: np.array
+            Sorted Cescon theta grid
+
+        unit_carb_absorbed: np.array
+            Carbs absorbed for 1 g at each grid point and time, shape (n_taus, n_thetas, n_times)
+        """
+        self.t_min = t_min
+        self.tau1s = tau1s
+        self.tau2s = tau2s
+        self.unit_insulin_cleared = unit_insulin_cleared
+        self.taus = taus
+        self.thetas = thetas
+        self.unit_carb_absorbed = unit_carb_absorbed
+
+    @classmethod
+    def build(
+        cls,
+        num_hours=8,
+        five_min=True,
+        tau1_range=(55, 55),
+        tau2_range=(70, 70),
+        tau_range=(42, 42),
+        theta_range=(20, 20),
+        tolerance=EPSILON_TEST,
+    ):
+        """
+        Compute a table, refining each kinetics grid until interpolating between its points is
+        within tolerance of the models at the cell centers.
+
+        Parameters
+        ----------
+        num_hours: float
+            How long to compute the response
+
+        five_min: bool
+            If true, tabulate in increments of 5 minutes, otherwise 1 minute
+
+        tau1_range: (float, float)
+            Smallest and largest Palerm tau1 to cover, a single point if equal
+
+        tau2_range: (float, float)
+            Smallest and largest Palerm tau2 to cover. Must not overlap tau1_range
+            since the Palerm model is singular at tau1 == tau2.
+
+        tau_range: (float, float)
+            Smallest and largest Cescon tau to cover
+
+        theta_range: (float, float)
+            Smallest and largest Cescon theta to cover
+
+        tolerance: float
+            Allowed interpolation error of the unit curves. The bg error of a query is at most
+            tolerance * (isf * |insulin| + isf / cir * carbs).
+
+        Returns
+        -------
+        ResponseSurfaceTable
+        """
+        if max(tau1_range) >= min(tau2_range):
+            raise ValueError("tau1_range must be below tau2_range.")
+
+        def get_unit_insulin_cleared(tau1s, tau2s):
+            insulin_model = PalermInsulinModel(isf=1, cir=1)
+            t_min, _, bg, _ = insulin_model.run_batch(
+                num_hours, insulin_amounts=np.ones(len(tau1s)), tau1s=tau1s, tau2s=tau2s, five_min=five_min
+            )
+            return t_min, -1 * bg
+
+        def get_unit_carb_absorbed(taus, thetas):
+            carb_model = CesconCarbModel(isf=1, cir=1)
+            t_min, _, bg = carb_model.run_batch(
+                num_hours, carb_amounts=np.ones(len(taus)), taus=taus, thetas=thetas, five_min=five_min
+            )
+            return t_min, bg
+
+        t_min, tau1s, tau2s, unit_insulin_cleared = _build_refined_grid(
+            get_unit_insulin_cleared, _get_axis(tau1_range), _get_axis(tau2_range), tolerance
+        )
+
+        # The carb curve has a kink in theta where absorption starts at t = theta. Keeping every
+        # tabulated time on the theta grid leaves the kinks on grid points, where interpolation is exact.
+        _, taus, thetas, unit_carb_absorbed = _build_refined_grid(
+            get_unit_carb_absorbed, _get_axis(tau_range), _get_axis(theta_range, breakpoints=t_min), tolerance
+        )
+
+        return cls(t_min, tau1s, tau2s, unit_insulin_cleared, taus, thetas, unit_carb_absorbed)
+
+    @classmethod
+    def load(cls, directory, mmap_mode="r"):
+        """
+        Open a table written by save().
+
+        Parameters
+        ----------
+        directory: str
+            The table directory
+
+        mmap_mode: str or None
+            Passed to np.load. The default memory-maps the arrays read-only, None loads them.
+
+        Returns
+        -------
+        ResponseSurfaceTable
+        """
+        arrays = [
+            np.load(os.path.join(directory, "{}.npy".format(name)), mmap_mode=mmap_mode)
+            for name in RESPONSE_SURFACE_ARRAY_NAMES
+        ]
+        return cls(*arrays)
+
+    def save(self, directory):
+        """
+        Write the table as one .npy file per array.
+
+        Parameters
+        ----------
+        directory: str
+            The table directory, created if needed
+        """
+        os.makedirs(directory, exist_ok=True)
+        for name in RESPONSE_SURFACE_ARRAY_NAMES:
+            np.save(os.path.join(directory, "{}.npy".format(name)), getattr(self, name))
+
+    def query(self, carb_amounts, insulin_amounts=np.nan, isfs=100, cirs=10, tau1=55, tau2=70, tau=42, theta=20):
+        """
+        Look up the response of many scenarios, matching SimpleMetabolismModel.run_batch to the
+        table tolerance. Where insulin is not given (np.nan), the amount is calculated from the
+        carbs using bolus wizard logic.
+
+        Parameters
+        ----------
+        carb_amounts: array-like
+            Amount of carbs for each scenario
+
+        insulin_amounts: array-like
+            Amount of insulin for each scenario, np.nan entries are calculated based on carb_amounts
+
+        isfs: float or array-like
+            Insulin sensitivity factor, shared or for each scenario
+
+        cirs: float or array-like
+            Carb insulin ratio, shared or for each scenario
+
+        tau1: float or array-like
+            Palerm tau1, shared or for each scenario, within the table grid
+
+        tau2: float or array-like
+            Palerm tau2, shared or for each scenario, within the table grid
+
+        tau: float or array-like
+            Cescon tau, shared or for each scenario, within the table grid
+
+        theta: float or array-like
+            Cescon theta, shared or for each scenario, within the table grid
+
+        Returns
+        -------
+        (np.array, np.array, np.array, np.array)
+            combined_delta_bg - The delta bg for each scenario, shape (n_scenarios, n_timesteps)
+            t_min - time series that matches the outputs
+            insulin_amounts - Input insulin or insulin computed from carbs for each scenario
+            iob - The insulin on board for each scenario, shape (n_scenarios, n_timesteps)
+        """
+        carb_amounts = np.atleast_1d(np.asarray(carb_amounts, dtype=float))
+        insulin_amounts = np.broadcast_to(np.asarray(insulin_amounts, dtype=float), carb_amounts.shape)
+        isfs = np.asarray(isfs, dtype=float)
+        cirs = np.asarray(cirs, dtype=float)
+
+        if np.any(carb_amounts < 0):
+            raise ValueError("Carbs must be greater than zero.")
+
+        insulin_amounts = np.where(np.isnan(insulin_amounts), carb_amounts / cirs, insulin_amounts)
+
+        unit_insulin_cleared = _interpolate_grid(self.unit_insulin_cleared, self.tau1s, self.tau2s, tau1, tau2)
+        unit_carb_absorbed = _interpolate_grid(self.unit_carb_absorbed, self.taus, self.thetas, tau, theta)
+
+        insulin_cleared = insulin_amounts[:, np.newaxis] * unit_insulin_cleared
+        bg = isfs[..., np.newaxis] * (
+            (carb_amounts / cirs)[:, np.newaxis] * unit_carb_absorbed - insulin_cleared
+        )
+
+        combined_delta_bg = np.zeros(bg.shape)
+        combined_delta_bg[:, 1:] = bg[:, 1:] - bg[:, :-1]
+
+        iob = insulin_amounts[:, np.newaxis] - insulin_cleared
+
+        return combined_delta_bg, np.asarray(self.t_min), insulin_amounts, iob
+
+
+def _build_refined_grid(get_unit_curves, first_axis, second_axis, tolerance):
+    """
+    Tabulate unit curves over a 2D parameter grid, bisecting the grid cells until bilinear
+    interpolation halfway between grid points is within tolerance of the exact curves.
+    Each axis is only refined while interpolating along it is what exceeds the tolerance.
+    """
+    while True:
+        t_min, unit_curves = _get_grid_curves(get_unit_curves, first_axis, second_axis)
+
+        first_centers = _get_cell_centers(first_axis)
+        second_centers = _get_cell_centers(second_axis)
+        first_error, second_error, center_error = [
+            _get_interpolation_error(get_unit_curves, unit_curves, first_axis, second_axis, first_values, second_values)
+            for first_values, second_values in [
+                (first_centers, second_axis),
+                (first_axis, second_centers),
+                (first_centers, second_centers),
+            ]
+        ]
+
+        if max(first_error, second_error, center_error) <= tolerance:
+            return t_min, first_axis, second_axis, unit_curves
+
+        refine_first = first_error > tolerance / 2
+        refine_second = second_error > tolerance / 2
+        if refine_first or not refine_second:
+            first_axis = _bisect_cells(first_axis)
+        if refine_second or not refine_first:
+            second_axis = _bisect_cells(second_axis)
+
+        if max(len(first_axis), len(second_axis)) > MAX_AXIS_POINTS:
+            raise ValueError(
+                "Can't reach tolerance {} within {} grid points per axis.".format(tolerance, MAX_AXIS_POINTS)
+            )
+
+
+def _get_grid_curves(get_unit_curves, first_axis, second_axis):
+    """Evaluate the unit curves at every grid point, shape (n_first, n_second, n_times)"""
+    first_values, second_values = np.meshgrid(first_axis, second_axis, indexing="ij")
+    t_min, unit_curves = get_unit_curves(first_values.ravel(), second_values.ravel())
+    return t_min, unit_curves.reshape((len(first_axis), len(second_axis), -1))
+
+
+def _get_interpolation_error(get_unit_curves, unit_curves, first_axis, second_axis, first_values, second_values):
+    """Get the largest difference between the exact and interpolated curves over a grid of query points"""
+    _, exact_curves = _get_grid_curves(get_unit_curves, first_values, second_values)
+
+    first_values, second_values = np.meshgrid(first_values, second_values, indexing="ij")
+    interpolated_curves = _interpolate_grid(unit_curves, first_axis, second_axis, first_values, second_values)
+
+    return np.max(np.abs(interpolated_curves - exact_curves))
+
+
+def _get_axis(value_range, breakpoints=()):
+    """Get the initial grid for a parameter range, including any breakpoints inside it"""
+    low, high = value_range
+    if low > high:
+        raise ValueError("Range {} is not sorted.".format(value_range))
+
+    breakpoints = np.asarray(breakpoints, dtype=float)
+    return np.unique(np.concatenate([[low, high], breakpoints[(breakpoints > low) & (breakpoints < high)]]))
+
+
+def _get_cell_centers(axis):
+    """Get the midpoint of each grid cell, or the single point of a one point axis"""
+    if len(axis) == 1:
+        return axis
+    return (axis[:-1] + axis[1:]) / 2
+
+
+def _bisect_cells(axis):
+    """Add the midpoint of each grid cell to the axis"""
+    if len(axis) == 1:
+        return axis
+    return np.insert(axis, np.arange(1, len(axis)), _get_cell_centers(axis))
+
+
+def _interpolate_grid(grid, first_axis, second_axis, first_values, second_values):
+    """
+    Bilinearly interpolate curves tabulated over two parameter axes.
+
+    Parameters
+    ----------
+    grid: np.array
+        Curves at each grid point, shape (n_first, n_second, n_times)
+
+    first_axis: np.array
+        Sorted grid values of the first parameter
+
+    second_axis: np.array
+        Sorted grid values of the second parameter
+
+    first_values: float or array-like
+        First parameter for each query
+
+    second_values: float or array-like
+        Second parameter for each query
+
+    Returns
+    -------
+    np.array
+        The interpolated curves, shape (n_times,) for scalar queries, (n_queries, n_times) otherwise
+    """
+    first_lower, first_upper, first_weight = _get_interpolation_weights(first_axis, first_values)
+    second_lower, second_upper, second_weight = _get_interpolation_weights(second_axis, second_values)
+
+    if np.ndim(first_weight) == 0 and np.ndim(second_weight) == 0:
+        # Single query, only blend the grid points it doesn't sit on
+        curve = grid[first_lower, second_lower]
+        if second_weight:
+            curve = curve + second_weight * (grid[first_lower, second_upper] - curve)
+        if first_weight:
+            upper_curve = grid[first_upper, second_lower]
+            if second_weight:
+                upper_curve = upper_curve + second_weight * (grid[first_upper, second_upper] - upper_curve)
+            curve = curve + first_weight * (upper_curve - curve)
+        return curve
+
+    first_weight = first_weight[..., np.newaxis]
+    second_weight = second_weight[..., np.newaxis]
+
+    return (1 - first_weight) * (
+        (1 - second_weight) * grid[first_lower, second_lower] + second_weight * grid[first_lower, second_upper]
+    ) + first_weight * (
+        (1 - second_weight) * grid[first_upper, second_lower] + second_weight * grid[first_upper, second_upper]
+    )
+
+
+def _get_interpolation_weights(axis, values):
+    """
+    Get the grid indices on either side of each value and the weight of the upper one.
+    A single point axis only covers that value.
+    """
+    values = np.asarray(values, dtype=float)
+
+    if values.ndim == 0:
+        # Plain python scalars keep single queries cheap
+        value = float(values)
+        if not axis[0] <= value <= axis[-1]:
+            raise ValueError("Value {} outside of the table range [{}, {}].".format(value, axis[0], axis[-1]))
+        if len(axis) == 1:
+            return 0, 0, 0.0
+        lower = min(int(axis.searchsorted(value, side="right")) - 1, len(axis) - 2)
+        return lower, lower + 1, (value - axis[lower]) / (axis[lower + 1] - axis[lower])
+
+    if np.any(values < axis[0]) or np.any(values > axis[-1]):
+        raise ValueError("Values outside of the table range [{}, {}].".format(axis[0], axis[-1]))
+
+    if len(axis) == 1:
+        index = np.zeros(values.shape, dtype=int)
+        return index, index, np.zeros(values.shape)
+
+    lower = np.clip(np.searchsorted(axis, values, side="right") - 1, 0, len(axis) - 2)
+    upper = lower + 1
+    weight = (values - axis[lower]) / (axis[upper] - axis[lower])
+
+    return lower, upper, weight
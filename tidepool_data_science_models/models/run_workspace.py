@@ -0,0 +1,82 @@
+"""
+This file houses reusable output buffers for running the treatment and metabolism models in tight loops.
+"""
+
+import numpy as np
+
+from tidepool_data_science_models.utils import get_timeseries
+
+
+class RunWorkspace(object):
+    """
+    Preallocated buffers for TreatmentModel.run and SimpleMetabolismModel.run.
+
+    Passing the same workspace to every call writes the results into its buffers, so a simulation loop
+    allocates no arrays after the workspace is created. The returned arrays are views of the buffers and
+    are overwritten by the next call with the workspace. Runs up to num_hours long with the same
+    five_min setting can use the workspace.
+    """
+
+    def __init__(self, num_hours=8, five_min=True, dtype=np.float64):
+        """
+        Parameters
+        ----------
+        num_hours: float
+            The longest run the workspace is for
+
+        five_min: bool
+            Whether the runs are in increments of 5 minutes, otherwise 1 minute
+
+        dtype: np.dtype
+            Floating point type of the output buffers, e.g. the dtype of the models
+        """
+        self.num_hours = num_hours
+        self.five_min = five_min
+        self.minutes_per_step = 5 if five_min else 1
+
+        self.t_min = get_timeseries(num_hours, five_min=five_min)
+        self.t_min.flags.writeable = False
+
+        num_steps = len(self.t_min)
+
+        # Treatment model outputs
+        self.insulin_bg_delta = np.empty(num_steps, dtype=dtype)
+        self.insulin_bg = np.empty(num_steps, dtype=dtype)
+        self.insulin_iob = np.empty(num_steps, dtype=dtype)
+        self.carb_bg_delta = np.empty(num_steps, dtype=dtype)
+        self.carb_bg = np.empty(num_steps, dtype=dtype)
+
+        # Metabolism model outputs
+        self.combined_delta_bg = np.empty(num_steps, dtype=dtype)
+        self.iob = np.empty(num_steps, dtype=dtype)
+
+        # Intermediate values at 1 minute resolution, e.g. the insulin activity curve, kept in float64
+        # so long sums don't lose precision
+        self.scratch = np.empty(max((num_steps - 1) * self.minutes_per_step + 1, 0))
+
+    def get_timeseries(self, num_hours, five_min):
+        """
+        Get the time series for a run as a read-only view, without allocating.
+
+        Parameters
+        ----------
+        num_hours: float
+            Length of the run
+
+        five_min: bool
+            Whether the run is in increments of 5 minutes, otherwise 1 minute
+
+        Returns
+        -------
+        np.array
+            The time series in minutes
+        """
+        if five_min != self.five_min or num_hours > self.num_hours:
+            raise ValueError(
+                "Workspace is for runs up to {} hours with five_min={}.".format(self.num_hours, self.five_min)
+            )
+
+        num_minutes = int(num_hours * 60)
+        num_steps = (num_minutes + self.minutes_per_step - 1) // self.minutes_per_step
+
+        return self.t_min[:num_steps]
@@ -6,6 +6,57 @@ import numpy as np
 
 from tidepool_data_science_models.utils import MINUTES_PER_HOUR, STEADY_STATE_IOB_FACTOR_FDA, get_timeseries
 from tidepool_data_science_models.models.treatment_models import PalermInsulinModel, CesconCarbModel
+from tidepool_data_science_models.models.treatment_schedule import (
+    IOB_KERNEL_NUM_HOURS,
+    KERNEL_NUM_HOURS,
+    MINUTES_PER_PUMP_PULSE,
+    DailySchedule,
+    TreatmentSchedule,
+    get_basal_pulse_series,
+    get_setting_series,
+    get_insulin_kernels,
+    get_carb_kernel,
+    get_num_time_steps,
+    convolve_events,
+)
+
+
+def get_min_bg(bg, iob, t_min, bg_threshold):
+    """Lowest bg relative to t0"""
+    return np.min(bg, axis=1)
+
+
+def get_max_bg(bg, iob, t_min, bg_threshold):
+    """Highest bg relative to t0"""
+    return np.max(bg, axis=1)
+
+
+def get_time_to_nadir(bg, iob, t_min, bg_threshold):
+    """Minutes from t0 to the first time at the lowest bg"""
+    return t_min[np.argmin(bg, axis=1)]
+
+
+def get_time_below_threshold(bg, iob, t_min, bg_threshold):
+    """Minutes with bg relative to t0 below the threshold"""
+    minutes_per_step = t_min[1] - t_min[0] if len(t_min) > 1 else 0
+    return np.count_nonzero(bg < np.reshape(bg_threshold, (-1, 1)), axis=1) * minutes_per_step
+
+
+def get_final_iob(bg, iob, t_min, bg_threshold):
+    """Insulin on board at the last time step"""
+    return iob[:, -1]
+
+
+# Per-scenario reductions available to SimpleMetabolismModel.run_summary(). Each takes the chunk's bg
+# relative to t0 and iob, shape (n_scenarios, n_timesteps), t_min and the bg threshold.
+SUMMARY_FUNCTIONS = {
+    "min_bg": get_min_bg,
+    "max_bg": get_max_bg,
+    "time_to_nadir": get_time_to_nadir,
+    "time_below_threshold": get_time_below_threshold,
+    "final_iob": get_final_iob,
+}
+DEFAULT_SUMMARY_NAMES = tuple(SUMMARY_FUNCTIONS)
 
 
 class SimpleMetabolismModel(object):
@@ -20,6 +71,8 @@ class SimpleMetabolismModel(object):
         carb_insulin_ratio,
         insulin_model_name="palerm",
         carb_model_name="cescon",
+        run_cache=None,
+        dtype=np.float64,
     ):
         """
         Parameters
@@ -35,13 +88,23 @@ class SimpleMetabolismModel(object):
 
         carb_model_name: str
             Name of the carb model to use
+
+        run_cache: LRUArrayCache or None
+            Opt-in memoization of run(). Results are keyed by the models, isf, cir and run() inputs, so
+            one cache can be shared by many models. Cached arrays are read-only. None to always compute.
+
+        dtype: np.dtype
+            Floating point type of the bg and iob arrays from run(), run_batch() and run_summary().
+            float32 halves their memory for population scale runs, with relative errors of about 1e-6.
         """
         self._cir = carb_insulin_ratio
         self._isf = insulin_sensitivity_factor
+        self._dtype = np.dtype(dtype)
+        self.run_cache = run_cache
 
         if insulin_model_name == "palerm":
             self.insulin_model = PalermInsulinModel(
-                isf=insulin_sensitivity_factor, cir=carb_insulin_ratio
+                isf=insulin_sensitivity_factor, cir=carb_insulin_ratio, dtype=self._dtype
             )
         else:
             raise ValueError(
@@ -50,12 +113,12 @@ class SimpleMetabolismModel(object):
 
         if carb_model_name == "cescon":
             self.carb_model = CesconCarbModel(
-                isf=insulin_sensitivity_factor, cir=carb_insulin_ratio
+                isf=insulin_sensitivity_factor, cir=carb_insulin_ratio, dtype=self._dtype
             )
         else:
             raise ValueError("{} not a recognized carb model.".format(carb_model_name))
 
-    def run(self, carb_amount, insulin_amount=np.nan, num_hours=8, five_min=True):
+    def run(self, carb_amount, insulin_amount=np.nan, num_hours=8, five_min=True, out=None, workspace=None):
         """
         Compute a num_hours long, 5-min interval time series metabolic response to insulin and carbs inputs
         at t0. Carbs and insulin can be either zero or non-zero.
@@ -72,11 +135,20 @@ class SimpleMetabolismModel(object):
             Amount of insulin, if not given is calculated based on carb_amount
 
         num_hours: float
-            Number of hours to run the simulation past t0
+            Number of hours to run the simulation past t0. Past KERNEL_NUM_HOURS the responses
+            have decayed (below 1e-8 per unit with the default model parameters) and are zero.
 
         five_min: bool
             Where to use 5 minute subsampling, if False default is 1 minute
 
+        out: (np.array, np.array) or None
+            Buffers for combined_delta_bg and iob with one value per time step. Allocated if None,
+            or taken from the workspace if one is given.
+
+        workspace: RunWorkspace or None
+            Reusable buffers for the outputs and the treatment model runs. Repeated runs with the same
+            workspace allocate no arrays, and the returned arrays are overwritten by the next run.
+
         Returns
         -------
         (np.array, np.array, float, np.array)
@@ -84,13 +156,11 @@ class SimpleMetabolismModel(object):
             t_min - time series that matches the simulation outputs
             insulin_amount - Input insulin or insulin computed from carbs if np.nan is passed in
             iob - The insulin on board
+            With a run cache and no output buffers the arrays are read-only and shared with other callers.
         """
         if num_hours < 0:
             raise ValueError("Number of hours for simulation can't be negative.")
 
-        if num_hours > 24:
-            raise ValueError("Number of hours for simulation can't be more than 24.")
-
         if carb_amount < 0:
             raise ValueError("Carbs must be greater than zero.")
 
@@ -99,106 +169,621 @@ class SimpleMetabolismModel(object):
         if np.isnan(insulin_amount):
             insulin_amount = carb_amount / self._cir  # insulin amount
 
-        sim_data_len = num_hours * MINUTES_PER_HOUR
-        if five_min:
-            sim_data_len = int(sim_data_len / 5)
+        if self.run_cache is None:
+            return self._run(carb_amount, insulin_amount, num_hours, five_min, out, workspace)
+
+        key = (
+            "run",
+            self.insulin_model.get_name(),
+            self.carb_model.get_name(),
+            self._isf,
+            self._cir,
+            self._dtype.name,
+            float(carb_amount),
+            float(insulin_amount),
+            num_hours,
+            five_min,
+        )
+        combined_delta_bg, t_min, insulin_amount, iob = self.run_cache.get_or_compute(
+            key, lambda: self._run(carb_amount, insulin_amount, num_hours, five_min)
+        )
+        if out is None and workspace is None:
+            return combined_delta_bg, t_min, insulin_amount, iob
+
+        combined_delta_bg_out, iob_out = _get_run_buffers(len(t_min), out, workspace)
+        np.copyto(combined_delta_bg_out, combined_delta_bg)
+        np.copyto(iob_out, iob)
+
+        return combined_delta_bg_out, t_min, insulin_amount, iob_out
+
+    def _run(self, carb_amount, insulin_amount, num_hours, five_min, out=None, workspace=None):
+        """Compute run() for validated inputs with the insulin amount resolved"""
+        if workspace is None:
+            t_min = get_timeseries(num_hours, five_min=five_min)
+        else:
+            t_min = workspace.get_timeseries(num_hours, five_min)
 
         # Init arrays to return
-        combined_delta_bg = np.zeros(sim_data_len)
-        iob = np.zeros(sim_data_len)
+        if out is None and workspace is None:
+            combined_delta_bg = np.zeros(len(t_min), dtype=self._dtype)
+            iob = np.zeros(len(t_min), dtype=self._dtype)
+        else:
+            combined_delta_bg, iob = _get_run_buffers(len(t_min), out, workspace)
+            combined_delta_bg.fill(0)
+            iob.fill(0)
+
+        # The responses have decayed by the end of the kernel horizon, so long runs only evaluate
+        # the models over that window and leave the rest at zero. Work and memory stay bounded by
+        # the window rather than growing with the horizon.
+        model_num_hours = min(num_hours, KERNEL_NUM_HOURS)
 
         # insulin model
         if insulin_amount != 0: # Note: insulin can be negative
-            t_min, bg_delta_insulin, bg, iob = self.insulin_model.run(
-                num_hours, insulin_amount=insulin_amount, five_min=five_min
+            _, bg_delta_insulin, bg, iob_insulin = self.insulin_model.run(
+                model_num_hours, insulin_amount=insulin_amount, five_min=five_min, workspace=workspace
             )
-            combined_delta_bg += bg_delta_insulin
+            combined_delta_bg[: len(bg_delta_insulin)] += bg_delta_insulin
+            iob[: len(iob_insulin)] = iob_insulin
 
         # carb model
         if carb_amount > 0:
-            t_min, bg_delta_carb, bg = self.carb_model.run(
-                num_hours, carb_amount=carb_amount, five_min=five_min
+            _, bg_delta_carb, bg = self.carb_model.run(
+                model_num_hours, carb_amount=carb_amount, five_min=five_min, workspace=workspace
             )
-            combined_delta_bg += bg_delta_carb
+            combined_delta_bg[: len(bg_delta_carb)] += bg_delta_carb
 
         # +CS - Why are we returning the carb and insulin amt?
         return combined_delta_bg, t_min, insulin_amount, iob
 
-    def get_iob_from_sbr(self, sbr_actual):
+    def run_batch(self, carb_amounts, insulin_amounts=np.nan, isfs=None, cirs=None, num_hours=8, five_min=True):
         """
-        Compute insulin on board due to the assumption that the schedule basal rate (sbr)
-        has been active for at least N_pre hours (8 hours here) prior to the start of the simulation.
-        The effect of the insulin due to the sbr prior to the start of the simulation results in
-        an initial amount of insulin on board every 5 minutes over the following N_post hours (8 hours again).
+        Compute the metabolic response for many scenarios at once, e.g. a population of virtual
+        patients. Row i matches run() for a model with the i-th isf and cir.
+
+        Where insulin is not given (np.nan), the amount is automatically determined by the carb
+        input using bolus wizard logic.
 
         Parameters
         ----------
-        sbr_actual: float
-            The scheduled basal rate
+        carb_amounts: array-like
+            Amount of carbs for each scenario
 
-        isf: float
-            The insulin sensitivity factor
+        insulin_amounts: array-like
+            Amount of insulin for each scenario, np.nan entries are calculated based on carb_amounts
 
-        cir: float
-            The carb to insulin ratio
+        isfs: array-like or None
+            Insulin sensitivity factor for each scenario. Defaults to the model isf.
+
+        cirs: array-like or None
+            Carb insulin ratio for each scenario. Defaults to the model cir.
+
+        num_hours: float
+            Number of hours to run the simulation past t0, responses are zero past KERNEL_NUM_HOURS
+
+        five_min: bool
+            Where to use 5 minute subsampling, if False default is 1 minute
 
         Returns
         -------
-        np.array
-            The insulin on board every five munutes for 8 hours
+        (np.array, np.array, np.array, np.array)
+            combined_delta_bg - The delta bg for each scenario, shape (n_scenarios, n_timesteps)
+            t_min - time series that matches the simulation outputs
+            insulin_amounts - Input insulin or insulin computed from carbs for each scenario
+            iob - The insulin on board for each scenario, shape (n_scenarios, n_timesteps)
         """
-        # Step 1: Get 8 hr iob from a bolus that is 1/12 of the scheduled basal rate.
-        #         This assumes basal rate is a series of boluses at 5 min intervals.
-        # TODO: optionally expose these as arguments to support other pumps or insulin curves (e.g. might need more
-        #  time to reach steady state or full decay with some curves), but need sufficient testing
-        num_hours_pre_t0 = 8
-        num_hours_post_t0 = 8
-        minutes_per_pump_pulse = 5
+        if num_hours < 0:
+            raise ValueError("Number of hours for simulation can't be negative.")
 
-        # E.g. 1 pulse every 5 minutes: 12 pulses/hr = 60 min/hr / 5 min/pulse
-        num_basal_pulses_per_hour = int(MINUTES_PER_HOUR / minutes_per_pump_pulse)
+        carb_amounts = np.atleast_1d(np.asarray(carb_amounts, dtype=float))
+        insulin_amounts = np.broadcast_to(np.asarray(insulin_amounts, dtype=float), carb_amounts.shape)
 
-        # NOTE: This is unrealistic pump behavior since pumps deliver in increments of U/pulse,
-        #       but in the steady state case it has an insignificant effect on the result.
-        basal_amount_per_5min = (
-            sbr_actual / num_basal_pulses_per_hour
-        )  # U/pulse = U/hr / pulse/hr
+        if np.any(carb_amounts < 0):
+            raise ValueError("Carbs must be greater than zero.")
 
-        t, delta_bg_t, bg_t, iob_t = self.insulin_model.run(
-            num_hours_pre_t0, insulin_amount=basal_amount_per_5min, five_min=True
-        )
+        cirs_all = self._cir if cirs is None else np.asarray(cirs, dtype=float)
+
+        # where insulin amount is not given,
+        # calculate carb amount like a bolus calculator
+        insulin_amounts = np.where(np.isnan(insulin_amounts), carb_amounts / cirs_all, insulin_amounts)
+
+        t_min = get_timeseries(num_hours, five_min=five_min)
+        model_num_hours = min(num_hours, KERNEL_NUM_HOURS)
 
-        # Step 2: Add hours post t0 to simulation
-        iob_with_zeros = np.append(
-            iob_t, np.zeros(num_hours_post_t0 * num_basal_pulses_per_hour)
+        _, bg_delta_insulin, bg, iob_window = self.insulin_model.run_batch(
+            model_num_hours, insulin_amounts=insulin_amounts, isfs=isfs, five_min=five_min
+        )
+        _, bg_delta_carb, bg = self.carb_model.run_batch(
+            model_num_hours, carb_amounts=carb_amounts, isfs=isfs, cirs=cirs, five_min=five_min
         )
 
-        # Step 3: Copy the activity curves across the whole matrix
-        iob_matrix = np.tile(
-            iob_with_zeros, (num_hours_post_t0 * num_basal_pulses_per_hour, 1)
-        ).T
+        # As in run(), the responses are zero past the kernel horizon
+        combined_delta_bg = np.zeros((len(carb_amounts), len(t_min)), dtype=self._dtype)
+        iob = np.zeros((len(carb_amounts), len(t_min)), dtype=self._dtype)
+        combined_delta_bg[:, : bg_delta_insulin.shape[-1]] = bg_delta_insulin + bg_delta_carb
+        iob[:, : iob_window.shape[-1]] = iob_window
 
-        # Step 4: Shift each activity curve to mimic the basal pulse at each time step
-        nrows, ncols = np.shape(iob_matrix)
-        for t_pre in np.arange(1, ncols):
-            iob_matrix[:, t_pre] = np.roll(iob_matrix[:, t_pre], t_pre)
+        return combined_delta_bg, t_min, insulin_amounts, iob
 
-        # TODO: In theory we shouldn't need this, but until this function is well tested
-        #       with different values of num_hours_pre_t0 and num_hours_post_t0 leaving it as
-        #       a safeguard.
-        if iob_matrix[0, -1] != 0.0:
-            raise ValueError(
-                "Algorithm expects zeros in the upper right triangle. Please review."
+    def run_summary(
+        self,
+        carb_amounts,
+        insulin_amounts=np.nan,
+        isfs=None,
+        cirs=None,
+        num_hours=8,
+        five_min=True,
+        summaries=DEFAULT_SUMMARY_NAMES,
+        bg_threshold=-40,
+        chunk_size=10000,
+    ):
+        """
+        Compute per-scenario summaries of run_batch() for large sweeps. Scenarios are run chunk_size at a
+        time and each chunk is reduced before the next, so memory holds one (chunk_size, n_timesteps)
+        chunk and the (n_scenarios,) summaries regardless of the number of scenarios.
+
+        Parameters
+        ----------
+        carb_amounts: array-like
+            Amount of carbs for each scenario
+
+        insulin_amounts: array-like
+            Amount of insulin for each scenario, np.nan entries are calculated based on carb_amounts
+
+        isfs: array-like or None
+            Insulin sensitivity factor for each scenario. Defaults to the model isf.
+
+        cirs: array-like or None
+            Carb insulin ratio for each scenario. Defaults to the model cir.
+
+        num_hours: float
+            Number of hours to run the simulation past t0
+
+        five_min: bool
+            Where to use 5 minute subsampling, if False default is 1 minute
+
+        summaries: tuple or dict
+            Names of summaries in SUMMARY_FUNCTIONS, or a dict of name to a function with the
+            same signature as those for custom summaries
+
+        bg_threshold: float or array-like
+            The bg, relative to the bg at t0, for time_below_threshold, shared or for each scenario
+
+        chunk_size: int
+            Number of scenarios to run at once
+
+        Returns
+        -------
+        dict
+            Each summary's name to its value for each scenario, shape (n_scenarios,)
+        """
+        carb_amounts = np.atleast_1d(np.asarray(carb_amounts, dtype=float))
+        num_scenarios = len(carb_amounts)
+        insulin_amounts = np.broadcast_to(np.asarray(insulin_amounts, dtype=float), carb_amounts.shape)
+        bg_threshold = np.asarray(bg_threshold, dtype=float)
+
+        if chunk_size < 1:
+            raise ValueError("Chunk size must be at least 1.")
+
+        if not isinstance(summaries, dict):
+            summaries = {name: SUMMARY_FUNCTIONS[name] for name in summaries}
+
+        def get_chunk(values, start, end):
+            if values is None or np.ndim(values) == 0:
+                return values
+            return np.asarray(values)[start:end]
+
+        scenario_summaries = {name: np.zeros(num_scenarios) for name in summaries}
+
+        for start in range(0, num_scenarios, chunk_size):
+            end = min(start + chunk_size, num_scenarios)
+
+            combined_delta_bg, t_min, _, iob = self.run_batch(
+                carb_amounts[start:end],
+                insulin_amounts[start:end],
+                isfs=get_chunk(isfs, start, end),
+                cirs=get_chunk(cirs, start, end),
+                num_hours=num_hours,
+                five_min=five_min,
             )
+            bg = np.cumsum(combined_delta_bg, axis=1, out=combined_delta_bg)
+
+            chunk_bg_threshold = get_chunk(bg_threshold, start, end)
+            for name, summary_function in summaries.items():
+                scenario_summaries[name][start:end] = summary_function(bg, iob, t_min, chunk_bg_threshold)
+
+        return scenario_summaries
+
+    def solve_bolus(
+        self,
+        starting_bgs,
+        target_bgs,
+        carb_amounts,
+        isfs=None,
+        cirs=None,
+        target_time=None,
+        temp_basal_duration=None,
+        basal_rates=None,
+        num_hours=8,
+        five_min=True,
+    ):
+        """
+        Get the insulin given at t0 that brings each patient's predicted bg to the target after a meal.
+
+        The bg is linear in the insulin, bg(T) = starting_bg + isf * (carbs / cir * carbs_absorbed(T)
+        - insulin * insulin_cleared(T)), so the dose is solved for directly from the cached unit curves
+        for every patient at once instead of searching with run().
+
+        With a temp basal duration, a negative correction is given as a temp basal reduction over that
+        duration instead of a negative bolus.
+
+        Parameters
+        ----------
+        starting_bgs: float or array-like
+            The bg at t0 for each patient, units: mg/dL
+
+        target_bgs: float or array-like
+            The bg to reach at the target time for each patient, units: mg/dL
+
+        carb_amounts: float or array-like
+            Carbs eaten at t0 for each patient, units: g
+
+        isfs: float, array-like or None
+            Insulin sensitivity factor for each patient. Defaults to the model isf.
+
+        cirs: float, array-like or None
+            Carb insulin ratio for each patient. Defaults to the model cir.
+
+        target_time: float or None
+            Minutes since t0 to reach the target, on the simulation time series. Defaults to its last time.
+
+        temp_basal_duration: float or None
+            Minutes of temp basal starting at t0, a multiple of MINUTES_PER_PUMP_PULSE. None for bolus only.
+
+        basal_rates: float, array-like or None
+            The scheduled basal rate of each patient, units: U/hr. A temp basal can't go below zero delivery,
+            so reductions are limited to these rates, leaving the target unreached. None for no limit.
+
+        num_hours: float
+            Number of hours of the simulation time series
+
+        five_min: bool
+            Where to use 5 minute subsampling, if False default is 1 minute
+
+        Returns
+        -------
+        np.array or (np.array, np.array)
+            boluses - The insulin to give at t0 for each patient, units: U. Negative if the patient needs
+            less insulin and no temp basal duration is given.
+            temp_basal_adjustments - Only with a temp basal duration. The change from the scheduled basal rate
+            for the duration for each patient, units: U/hr
+        """
+        starting_bgs, target_bgs, carb_amounts = np.broadcast_arrays(
+            *[np.atleast_1d(np.asarray(values, dtype=float)) for values in [starting_bgs, target_bgs, carb_amounts]]
+        )
+        isfs = self._isf if isfs is None else np.asarray(isfs, dtype=float)
+        cirs = self._cir if cirs is None else np.asarray(cirs, dtype=float)
+
+        if np.any(carb_amounts < 0):
+            raise ValueError("Carbs must be greater than zero.")
+
+        minutes_per_step = 5 if five_min else 1
+        t_min = get_timeseries(num_hours, five_min=five_min)
+        if target_time is None:
+            target_time = t_min[-1]
+
+        target_index = int(target_time // minutes_per_step)
+        if target_index * minutes_per_step != target_time or not 0 < target_time <= t_min[-1]:
+            raise ValueError("Target time must be a time after t0 in the simulation time series.")
+
+        # Unit curves with isf = cir = 1 from the cached model curves
+        _, _, unit_insulin_bg, _ = self.insulin_model.run_batch(num_hours, [1.0], isfs=1.0, five_min=five_min)
+        _, _, unit_carb_bg = self.carb_model.run_batch(num_hours, [1.0], isfs=1.0, cirs=1.0, five_min=five_min)
+        insulin_cleared = -1 * unit_insulin_bg[0]
+        carbs_absorbed = unit_carb_bg[0]
+
+        # bg at the target without any insulin, and the bg drop per U of insulin given at t0
+        predicted_bgs = starting_bgs + isfs * carb_amounts / cirs * carbs_absorbed[target_index]
+        bg_drop_per_unit = isfs * insulin_cleared[target_index]
+
+        boluses = (predicted_bgs - target_bgs) / bg_drop_per_unit
+
+        if temp_basal_duration is None:
+            return boluses
+
+        num_pulses = int(temp_basal_duration // MINUTES_PER_PUMP_PULSE)
+        if num_pulses * MINUTES_PER_PUMP_PULSE != temp_basal_duration or num_pulses < 1:
+            raise ValueError("Temp basal duration must be a positive multiple of the pump pulse interval.")
+
+        # bg drop per U/hr of temp basal, a pulse of 1 / 12 U every pump pulse before the target
+        pulse_steps = np.arange(num_pulses) * (MINUTES_PER_PUMP_PULSE // minutes_per_step)
+        pulse_steps = pulse_steps[pulse_steps <= target_index]
+        pulses_per_hour = MINUTES_PER_HOUR / MINUTES_PER_PUMP_PULSE
+        bg_drop_per_rate = isfs * np.sum(insulin_cleared[target_index - pulse_steps]) / pulses_per_hour
+
+        temp_basal_adjustments = np.minimum(boluses, 0) * bg_drop_per_unit / bg_drop_per_rate
+        if basal_rates is not None:
+            temp_basal_adjustments = np.maximum(temp_basal_adjustments, -1 * np.asarray(basal_rates, dtype=float))
+
+        return np.maximum(boluses, 0), temp_basal_adjustments
+
+    def run_schedule(
+        self, treatment_schedule, num_hours, five_min=True, isfs=None, cirs=None, start_minute_of_day=0
+    ):
+        """
+        Compute the metabolic response to every bolus, basal and carb event in a schedule, for one
+        patient or a batch of patients.
+
+        The events are binned onto the time series and convolved with the models' unit
+        responses over KERNEL_NUM_HOURS, so the cost is one convolution regardless of the number
+        of events or the horizon.
+
+        The isf and cir can follow a time of day schedule. The insulin and carb effects at each time
+        step are scaled by the settings in effect during that step, so a dose that acts across a
+        schedule boundary is split between the settings on either side of it.
+
+        Parameters
+        ----------
+        treatment_schedule: TreatmentSchedule or list of TreatmentSchedule
+            The insulin and carb events of the patient(s)
+
+        num_hours: float
+            Number of hours to run the simulation past t0
+
+        five_min: bool
+            Where to use 5 minute subsampling, if False default is 1 minute
+
+        isfs: float, DailySchedule, list of them or None
+            Insulin sensitivity factor shared by the patients or for each patient. Defaults to the model isf.
+
+        cirs: float, DailySchedule, list of them or None
+            Carb insulin ratio shared by the patients or for each patient. Defaults to the model cir.
+
+        start_minute_of_day: float
+            Minutes since midnight at t0, for the isf and cir schedules
+
+        Returns
+        -------
+        (np.array, np.array, np.array)
+            combined_delta_bg - The delta bg as a result of the insulin and carb events
+            t_min - time series that matches the simulation outputs
+            iob - The insulin on board
+            A list of schedules gives arrays of shape (number of patients, number of time steps).
+        """
+        if num_hours < 0:
+            raise ValueError("Number of hours for simulation can't be negative.")
+
+        is_single_schedule = isinstance(treatment_schedule, TreatmentSchedule)
+        treatment_schedules = [treatment_schedule] if is_single_schedule else treatment_schedule
+
+        minutes_per_step = 5 if five_min else 1
+        t_min = get_timeseries(num_hours, five_min=five_min)
+
+        event_series = [schedule.get_event_series(num_hours, minutes_per_step) for schedule in treatment_schedules]
+        insulin_series = np.array([insulin for insulin, _ in event_series])
+        carb_series = np.array([carbs for _, carbs in event_series])
+
+        insulin_bg_delta_kernel, iob_kernel = get_insulin_kernels(self.insulin_model, five_min=five_min)
+        carb_bg_delta_kernel = get_carb_kernel(self.carb_model, five_min=five_min)
+
+        insulin_delta_bg = convolve_events(insulin_series, insulin_bg_delta_kernel)
+        carb_delta_bg = convolve_events(carb_series, carb_bg_delta_kernel)
+        iob = convolve_events(insulin_series, iob_kernel)
+
+        if isfs is not None or cirs is not None:
+            # The kernels are for the model isf and cir, rescale them at each time step
+            isf_series, cir_series = [
+                get_setting_series(
+                    default if settings is None else settings,
+                    len(treatment_schedules),
+                    insulin_series.shape[-1],
+                    minutes_per_step,
+                    start_minute_of_day=start_minute_of_day,
+                )
+                for settings, default in [(isfs, self._isf), (cirs, self._cir)]
+            ]
+            insulin_delta_bg *= isf_series / self._isf
+            carb_delta_bg *= (isf_series / cir_series) / (self._isf / self._cir)
 
-        # Step 5: Sum across the curves to get the iob at every time step
-        iob_sbr_t = np.sum(iob_matrix, axis=1)
+        combined_delta_bg = insulin_delta_bg + carb_delta_bg
 
-        # Step 6: Just get the last 8 hours
-        slice_index = int(
-            (num_hours_post_t0 * MINUTES_PER_HOUR / minutes_per_pump_pulse) - 1
+        if is_single_schedule:
+            return combined_delta_bg[0], t_min, iob[0]
+
+        return combined_delta_bg, t_min, iob
+
+    def run_at_times(self, t, treatment_schedule):
+        """
+        Compute the metabolic response to every bolus, basal and carb event in a schedule at arbitrary
+        sorted times, e.g. cgm timestamps with jitter and gaps. Events keep their exact times and each
+        one is evaluated in closed form at the time since it happened, so nothing is resampled
+        onto a regular time series.
+
+        Parameters
+        ----------
+        t: array-like
+            The sorted query times in minutes since t0
+
+        treatment_schedule: TreatmentSchedule
+            The insulin and carb events
+
+        Returns
+        -------
+        (np.array, np.array, np.array)
+            combined_delta_bg - The change in bg since the previous query time, 0 at the first
+            t_min - The query times
+            iob - The insulin on board at each query time
+        """
+        t = np.asarray(t, dtype=float)
+
+        # Basal pulses up to and including the last query time
+        num_hours = (np.max(t, initial=0) + MINUTES_PER_PUMP_PULSE) / MINUTES_PER_HOUR
+        pulse_times, pulse_amounts = treatment_schedule.get_basal_pulses(num_hours)
+
+        insulin_times = np.concatenate([treatment_schedule.bolus_times, pulse_times])
+        insulin_amounts = np.concatenate([treatment_schedule.bolus_amounts, pulse_amounts])
+
+        t_min, bg_delta_insulin, _, iob = self.insulin_model.run_events(t, insulin_times, insulin_amounts)
+        _, bg_delta_carb, _ = self.carb_model.run_events(
+            t, treatment_schedule.carb_times, treatment_schedule.carb_amounts
         )
-        iob_sbr_t = iob_sbr_t[slice_index:-1]
+
+        combined_delta_bg = bg_delta_insulin + bg_delta_carb
+
+        return combined_delta_bg, t_min, iob
+
+    def run_basal_schedule(
+        self,
+        basal_schedules,
+        num_hours,
+        temp_basals=None,
+        isfs=None,
+        start_minute_of_day=0,
+        num_hours_pre_t0=8,
+        five_min=True,
+    ):
+        """
+        Compute the insulin on board and bg effect of 24 hour basal schedules with optional temp basals,
+        for one patient or a batch of patients over multi-day horizons.
+
+        Like get_iob_from_sbr(), the schedule is assumed to have been running for num_hours_pre_t0 before
+        t0 so the insulin on board starts at its steady state. All patients' basal pulses are convolved with
+        the cached insulin kernel in one call.
+
+        Parameters
+        ----------
+        basal_schedules: DailySchedule or list of DailySchedule
+            Basal rate schedule(s), units: U/hr
+
+        num_hours: float
+            Number of hours to run the simulation past t0
+
+        temp_basals: TempBasals, list of TempBasals or None
+            Temp basals for the patient(s), times in minutes since t0
+
+        isfs: float, DailySchedule, list of them or None
+            Insulin sensitivity factor shared by the patients or for each patient, optionally a time of
+            day schedule applied as in run_schedule(). Defaults to the model isf.
+
+        start_minute_of_day: float
+            Minutes since midnight at t0, for the basal and isf schedules
+
+        num_hours_pre_t0: float
+            How long the schedule was running before t0
+
+        five_min: bool
+            Where to use 5 minute subsampling, if False default is 1 minute
+
+        Returns
+        -------
+        (np.array, np.array, np.array)
+            delta_bg - The delta bg due to basal, shape (number of patients, number of time steps)
+            t_min - time series that matches the simulation outputs
+            iob - The insulin on board from basal, shape (number of patients, number of time steps)
+            A single DailySchedule gives 1D arrays.
+        """
+        if num_hours < 0:
+            raise ValueError("Number of hours for simulation can't be negative.")
+
+        is_single_schedule = isinstance(basal_schedules, DailySchedule)
+        if is_single_schedule:
+            basal_schedules = [basal_schedules]
+            temp_basals = None if temp_basals is None else [temp_basals]
+
+        minutes_per_step = 5 if five_min else 1
+        t_min = get_timeseries(num_hours, five_min=five_min)
+        num_steps_pre_t0 = get_num_time_steps(num_hours_pre_t0, minutes_per_step)
+
+        pulse_series = get_basal_pulse_series(
+            basal_schedules,
+            num_hours,
+            minutes_per_step,
+            temp_basals=temp_basals,
+            start_minute_of_day=start_minute_of_day,
+            num_hours_pre_t0=num_hours_pre_t0,
+        )
+
+        # Like get_iob_from_sbr(), pulses older than IOB_KERNEL_NUM_HOURS are fully decayed in the iob
+        bg_delta_kernel, iob_kernel = get_insulin_kernels(
+            self.insulin_model, five_min=five_min, iob_num_hours=IOB_KERNEL_NUM_HOURS
+        )
+
+        delta_bg = convolve_events(pulse_series, bg_delta_kernel)[:, num_steps_pre_t0:]
+        iob = convolve_events(pulse_series, iob_kernel)[:, num_steps_pre_t0:]
+
+        if isfs is not None:
+            delta_bg *= (
+                get_setting_series(
+                    isfs, len(basal_schedules), delta_bg.shape[-1], minutes_per_step, start_minute_of_day
+                )
+                / self._isf
+            )
+
+        if is_single_schedule:
+            return delta_bg[0], t_min, iob[0]
+
+        return delta_bg, t_min, iob
+
+    def get_iob_from_sbr(
+        self, sbr_actual, num_hours_pre_t0=8, num_hours_post_t0=8, minutes_per_pump_pulse=5
+    ):
+        """
+        Compute insulin on board due to the assumption that the schedule basal rate (sbr)
+        has been active for at least N_pre hours (8 hours by default) prior to the start of the simulation.
+        The effect of the insulin due to the sbr prior to the start of the simulation results in
+        an initial amount of insulin on board every pump pulse over the following N_post hours (8 hours by default).
+
+        Parameters
+        ----------
+        sbr_actual: float or array-like
+            The scheduled basal rate, or an array of rates to compute all at once
+
+        num_hours_pre_t0: float
+            How long the basal rate was active before t0. Pulses before this are assumed
+            fully decayed, so it needs to be long enough for the insulin curve to decay.
+
+        num_hours_post_t0: float
+            How long after t0 to compute the insulin on board
+
+        minutes_per_pump_pulse: int
+            Minutes between basal pulses, also the interval of the returned time series
+
+        Returns
+        -------
+        np.array
+            The insulin on board every pump pulse for num_hours_post_t0. For an array of
+            basal rates, shape is (number of rates, number of time steps).
+        """
+        # Step 1: Get the iob from a bolus of 1 U, at the pump pulse interval for num_hours_pre_t0.
+        #         The basal rate is a series of boluses every pump pulse and the model is linear in
+        #         the dose, so each pulse is this curve scaled by the pulse amount.
+        num_pulses_pre_t0 = int(num_hours_pre_t0 * MINUTES_PER_HOUR / minutes_per_pump_pulse)
+        num_pulses_post_t0 = int(num_hours_post_t0 * MINUTES_PER_HOUR / minutes_per_pump_pulse)
+
+        if minutes_per_pump_pulse in [1, 5]:
+            _, _, _, unit_iob = self.insulin_model.get_unit_response(
+                num_hours_pre_t0, five_min=minutes_per_pump_pulse == 5
+            )
+        else:
+            t_pulses = np.arange(num_pulses_pre_t0) * minutes_per_pump_pulse
+            _, _, _, unit_iob = self.insulin_model.run_at_times(t_pulses, insulin_amount=1.0)
+
+        # Step 2: With a pulse at t0 and at every pump pulse before it, the iob at pulse i after t0
+        #         is the sum of the unit curve from i onward, i.e. a reversed cumulative sum. Pulses
+        #         before num_hours_pre_t0 are treated as fully decayed, same as the original algorithm.
+        unit_iob_sbr_t = np.zeros(num_pulses_post_t0)
+        unit_iob_tail_sum = np.cumsum(unit_iob[::-1])[::-1]
+        num_pulses_overlap = min(num_pulses_pre_t0, num_pulses_post_t0)
+        unit_iob_sbr_t[:num_pulses_overlap] = unit_iob_tail_sum[:num_pulses_overlap]
+
+        # Step 3: Scale by the amount in each pulse
+        # E.g. 1 pulse every 5 minutes: 12 pulses/hr = 60 min/hr / 5 min/pulse
+        num_basal_pulses_per_hour = MINUTES_PER_HOUR / minutes_per_pump_pulse
+
+        # NOTE: This is unrealistic pump behavior since pumps deliver in increments of U/pulse,
+        #       but in the steady state case it has an insignificant effect on the result.
+        basal_amount_per_pulse = np.asarray(sbr_actual) / num_basal_pulses_per_hour  # U/pulse = U/hr / pulse/hr
+
+        iob_sbr_t = basal_amount_per_pulse[..., np.newaxis] * unit_iob_sbr_t
 
         return iob_sbr_t
 
@@ -209,8 +794,8 @@ class SimpleMetabolismModel(object):
 
         Parameters
         ----------
-        sbr: float
-            The scheduled basal rate
+        sbr: float or array-like
+            The scheduled basal rate, or an array of rates
 
         use_fda_submission_constant: bool
             Whether to use the constant multiplier determined from the FDA risk analysis
@@ -218,14 +803,47 @@ class SimpleMetabolismModel(object):
 
         Returns
         -------
-        float
+        float or np.array
             The steady state insulin
         """
 
         if use_fda_submission_constant:
-            steady_state_iob = sbr * STEADY_STATE_IOB_FACTOR_FDA
+            steady_state_iob = np.asarray(sbr) * STEADY_STATE_IOB_FACTOR_FDA
         else:
             iob_t_sbr_activity = self.get_iob_from_sbr(sbr)
-            steady_state_iob = iob_t_sbr_activity[0]
+            steady_state_iob = iob_t_sbr_activity[..., 0]
 
         return steady_state_iob
+
+
+def _get_run_buffers(num_steps, out, workspace):
+    """
+    Get the combined_delta_bg and iob buffers for SimpleMetabolismModel.run.
+
+    Parameters
+    ----------
+    num_steps: int
+        The number of time steps in the run
+
+    out: (np.array, np.array) or None
+        Caller provided buffers, used if given
+
+    workspace: RunWorkspace or None
+        Workspace to take the buffers from if out is None
+
+    Returns
+    -------
+    (np.array, np.array)
+        The combined_delta_bg and iob buffers
+    """
+    if out is None:
+        return workspace.combined_delta_bg[:num_steps], workspace.iob[:num_steps]
+
+    if len(out) != 2:
+        raise ValueError("Expected 2 output buffers, got {}".format(len(out)))
+
+    combined_delta_bg, iob = out
+    if combined_delta_bg.shape != (num_steps,) or iob.shape != (num_steps,):
+        raise ValueError("Expected output buffers of shape ({},)".format(num_steps))
+
+    return combined_delta_bg, iob
@@ -4,8 +4,22 @@ This file houses the various insulin and carb activity curve models
 
 import numpy as np
 
+from tidepool_data_science_models.models.curve_cache import UNIT_RESPONSE_CACHE
+from tidepool_data_science_models.models.kernels import (
+    get_kernel_backend,
+    get_palerm_activity_shape,
+    get_cescon_absorption_shape,
+)
+from tidepool_data_science_models.models.treatment_steppers import PalermInsulinStepper, CesconCarbStepper
 from tidepool_data_science_models.utils import get_timeseries
 
+# Order of the parameter columns in the model jacobians
+PALERM_PARAMETER_NAMES = ("isf", "tau1", "tau2", "kcl")
+CESCON_PARAMETER_NAMES = ("isf", "cir", "tau", "theta")
+
+# Most (query time, event) pairs evaluated at once by run_events()
+EVENT_RESPONSE_MAX_ELEMENTS = 2 ** 20
+
 
 class TreatmentModel(object):
     """
@@ -41,7 +55,10 @@ class PalermInsulinModel(TreatmentModel):
         ----------
         kwargs: dict
             Arguments specific to the model.
-            Requires insulin sensitivity factor (isf) and and carb insulin ratio (cir)
+            Requires insulin sensitivity factor (isf) and and carb insulin ratio (cir).
+            Optional kernel_backend, the name of the kernel backend for run(), defaults to numpy.
+            Optional dtype of the run() and run_batch() outputs, defaults to float64. With float32
+            the curves are still computed in float64 and rounded once, halving memory for large batches.
         """
         super().__init__("Palerm")
         self._isf = kwargs["isf"]
@@ -52,7 +69,10 @@ class PalermInsulinModel(TreatmentModel):
         self._tau2 = kwargs.get("tau2", 70)
         self._Kcl = kwargs.get("kcl", 1)
 
-    def run(self, num_hours, insulin_amount, five_min=True):
+        self._kernels = get_kernel_backend(kwargs.get("kernel_backend"))
+        self._dtype = np.dtype(kwargs.get("dtype", np.float64))
+
+    def run(self, num_hours, insulin_amount, five_min=True, out=None, workspace=None):
         """
         Run the model for num hours assuming that the insulin amount
         is given at t=0.
@@ -69,6 +89,13 @@ class PalermInsulinModel(TreatmentModel):
             If true, run the model in increments of 5 minutes, otherwise
             1 minute
 
+        out: (np.array, np.array, np.array) or None
+            Buffers for bg_delta, bg and iob with one value per time step. Allocated if None,
+            or taken from the workspace if one is given.
+
+        workspace: RunWorkspace or None
+            Reusable buffers, so repeated runs allocate no arrays
+
         Returns
         -------
         (np.array, np.array, np.array, np.array)
@@ -77,34 +104,545 @@ class PalermInsulinModel(TreatmentModel):
             bg: The bg for each time in t starting at 0
             iob: The insulin on board for each time in t
         """
-        t_min = get_timeseries(num_hours, five_min=False)
+        scratch = None
+        if workspace is None:
+            t_min = get_timeseries(num_hours, five_min=five_min)
+        else:
+            t_min = workspace.get_timeseries(num_hours, five_min)
+            scratch = workspace.scratch
+            if out is None:
+                num_steps = len(t_min)
+                out = (
+                    workspace.insulin_bg_delta[:num_steps],
+                    workspace.insulin_bg[:num_steps],
+                    workspace.insulin_iob[:num_steps],
+                )
 
-        isf = self._isf
+        if out is None:
+            bg_delta, bg, iob = [np.empty(len(t_min), dtype=self._dtype) for _ in range(3)]
+        else:
+            bg_delta, bg, iob = _check_out_buffers(out, 3, len(t_min))
 
-        tau1 = self._tau1
-        tau2 = self._tau2
-        kcl = self._Kcl
-
-        insulin = (
-            insulin_amount
-            * (1 / (kcl * (tau2 - tau1)))
-            * (np.exp(-t_min / tau2) - np.exp(-t_min / tau1))
+        self._kernels.palerm_insulin(
+            insulin_amount,
+            self._isf,
+            self._tau1,
+            self._tau2,
+            self._Kcl,
+            5 if five_min else 1,
+            bg,
+            iob,
+            bg_delta,
+            scratch=scratch,
         )
 
-        insulin_cleared = np.cumsum(insulin)
-        iob = insulin_amount - insulin_cleared
+        return t_min, bg_delta, bg, iob
+
+    def run_batch(self, num_hours, insulin_amounts, isfs=None, tau1s=None, tau2s=None, kcls=None, five_min=True):
+        """
+        Run the model for many scenarios at once assuming each insulin amount
+        is given at t=0. Every scenario is computed in the same NumPy broadcast
+        and row i matches run() with the i-th set of parameters.
+
+        When tau1, tau2 and kcl are shared by all scenarios the model is linear in
+        the dose, so the cached unit curves are scaled instead of summing a 1 minute
+        curve per scenario. Rows then match run() to floating point precision.
+
+        Parameters
+        ----------
+        num_hours: float
+            How long to compute the effect
+
+        insulin_amounts: array-like
+            The amount of insulin for each scenario, shape (n_scenarios,)
+
+        isfs: array-like or None
+            Insulin sensitivity factor for each scenario. Defaults to the model isf.
+
+        tau1s: array-like or None
+            tau1 for each scenario. Defaults to the model tau1.
+
+        tau2s: array-like or None
+            tau2 for each scenario. Defaults to the model tau2.
+
+        kcls: array-like or None
+            kcl for each scenario. Defaults to the model kcl.
+
+        five_min: bool
+            If true, run the model in increments of 5 minutes, otherwise
+            1 minute
+
+        Returns
+        -------
+        (np.array, np.array, np.array, np.array)
+            t: The time series in minutes, shape (n_timesteps,)
+            bg_delta: The change in bg for each scenario and time in t, shape (n_scenarios, n_timesteps)
+            bg: The bg for each scenario and time in t starting at 0, shape (n_scenarios, n_timesteps)
+            iob: The insulin on board for each scenario and time in t, shape (n_scenarios, n_timesteps)
+        """
+        # Parameters and curves are computed in float64 and the outputs rounded to the model dtype once
+        insulin_amounts = np.atleast_1d(np.asarray(insulin_amounts, dtype=np.float64))
+        num_scenarios = len(insulin_amounts)
+
+        isf, tau1, tau2, kcl = [
+            _get_scenario_column(values, default, num_scenarios)
+            for values, default in [(isfs, self._isf), (tau1s, self._tau1), (tau2s, self._tau2), (kcls, self._Kcl)]
+        ]
+
+        if tau1s is None and tau2s is None and kcls is None:
+            # The curve shape is shared, so scale the cached unit curves by each dose
+            t_min = get_timeseries(num_hours, five_min=five_min)
+            unit_cleared, unit_cleared_delta, unit_iob = [
+                curve.astype(self._dtype, copy=False) for curve in self._get_unit_insulin_cleared(num_hours, five_min)
+            ]
+
+            bg_gain = (-1 * isf * insulin_amounts[:, np.newaxis]).astype(self._dtype, copy=False)
+            iob = insulin_amounts[:, np.newaxis].astype(self._dtype, copy=False) * unit_iob
+
+            return t_min, bg_gain * unit_cleared_delta, bg_gain * unit_cleared, iob
+
+        t_min = get_timeseries(num_hours, five_min=False)
+        activity_shape = np.exp(-t_min / tau2) - np.exp(-t_min / tau1)
+
+        insulin = insulin_amounts[:, np.newaxis] * (1 / (kcl * (tau2 - tau1))) * activity_shape
+
+        insulin_cleared = np.cumsum(insulin, axis=1)
+        iob = insulin_amounts[:, np.newaxis] - insulin_cleared
         bg = -1 * isf * insulin_cleared
 
         # Optionally subsample
         if five_min:
             t_min = get_timeseries(num_hours, five_min=True)
-            bg = bg[t_min]
-            iob = iob[t_min]
+            bg = bg[:, t_min]
+            iob = iob[:, t_min]
 
-        bg_delta = np.append(0, bg[1:] - bg[:-1])
+        bg_delta = np.zeros(bg.shape)
+        bg_delta[:, 1:] = bg[:, 1:] - bg[:, :-1]
+
+        bg_delta, bg, iob = [result.astype(self._dtype, copy=False) for result in (bg_delta, bg, iob)]
 
         return t_min, bg_delta, bg, iob
 
+    def run_at_times(self, t, insulin_amount):
+        """
+        Evaluate the model at arbitrary times assuming that the insulin amount
+        is given at t=0, without building the 1 minute grid used by run().
+
+        run() sums the activity curve minute by minute, which for the two exponential
+        curve is a pair of geometric series. Those have a closed form, so this
+        matches run() at whole minutes to floating point precision and interpolates
+        smoothly between them. Times before 0 have no effect.
+
+        Parameters
+        ----------
+        t: array-like
+            The sorted times in minutes since the insulin was given, e.g. irregular cgm timestamps
+
+        insulin_amount: float
+            The amount of insulin to use for running the model
+
+        Returns
+        -------
+        (np.array, np.array, np.array, np.array)
+            t: The time series in minutes
+            bg_delta: The change in bg for each time in t
+            bg: The bg for each time in t starting at 0
+            iob: The insulin on board for each time in t
+        """
+        t = np.asarray(t, dtype=float)
+
+        insulin_cleared = insulin_amount * get_palerm_unit_insulin_cleared(t, self._tau1, self._tau2, self._Kcl)
+        iob = insulin_amount - insulin_cleared
+        bg = -1 * self._isf * insulin_cleared
+
+        bg_delta = np.append(0, bg[1:] - bg[:-1])
+
+        return t, bg_delta, bg, iob
+
+    def run_events(self, t, event_times, insulin_amounts):
+        """
+        Evaluate the combined effect of insulin given at arbitrary times, at arbitrary query times,
+        e.g. pump events and cgm timestamps with jitter and gaps. Each dose is evaluated with the
+        closed form in run_at_times() at the time since it was given, so nothing is resampled.
+
+        Parameters
+        ----------
+        t: array-like
+            The sorted query times in minutes
+
+        event_times: array-like
+            The time in minutes of each dose, on the same clock as t
+
+        insulin_amounts: array-like
+            The insulin of each dose, units: U
+
+        Returns
+        -------
+        (np.array, np.array, np.array, np.array)
+            t: The time series in minutes
+            bg_delta: The change in bg for each time in t
+            bg: The bg for each time in t, starting at 0 before the first dose
+            iob: The insulin on board for each time in t, doses at the query time included
+        """
+        t = np.asarray(t, dtype=float)
+        tau1 = self._tau1
+        tau2 = self._tau2
+        kcl = self._Kcl
+
+        insulin_cleared = _sum_event_responses(
+            t, event_times, insulin_amounts, lambda s: get_palerm_unit_insulin_cleared(s, tau1, tau2, kcl)
+        )
+        insulin_given = _sum_event_responses(t, event_times, insulin_amounts, lambda s: (s >= 0).astype(float))
+
+        iob = insulin_given - insulin_cleared
+        bg = -1 * self._isf * insulin_cleared
+
+        bg_delta = np.append(0, bg[1:] - bg[:-1])
+
+        return t, bg_delta, bg, iob
+
+    def get_jacobian(self, t, insulin_amount):
+        """
+        Get the bg at arbitrary times, as in run_at_times(), and its analytic derivatives with
+        respect to the model parameters, e.g. for fitting the parameters to observed bg.
+
+        Parameters
+        ----------
+        t: array-like
+            Times in minutes since the insulin was given
+
+        insulin_amount: float
+            The amount of insulin to use for running the model
+
+        Returns
+        -------
+        (np.array, np.array)
+            bg: The bg for each time in t starting at 0
+            jacobian: d bg / d parameter for each time in t, shape (n_times, 4),
+                with columns in PALERM_PARAMETER_NAMES order (isf, tau1, tau2, kcl)
+        """
+        return get_palerm_bg_jacobian(t, insulin_amount, self._isf, self._tau1, self._tau2, self._Kcl)
+
+    def get_unit_response(self, num_hours, five_min=True):
+        """
+        Get the model output for 1 U of insulin given at t=0. The model is linear in the
+        insulin amount, so scaling these curves gives the response to any dose.
+
+        The curves are shared through the process-wide unit response cache and are read-only.
+
+        Parameters
+        ----------
+        num_hours: float
+            How long to compute the effect
+
+        five_min: bool
+            If true, run the model in increments of 5 minutes, otherwise
+            1 minute
+
+        Returns
+        -------
+        (np.array, np.array, np.array, np.array)
+            t, bg_delta, bg, iob as in run() for 1 U of insulin
+        """
+        key = (
+            self.name,
+            "unit_response",
+            self._isf,
+            self._tau1,
+            self._tau2,
+            self._Kcl,
+            num_hours,
+            five_min,
+            self._dtype.name,
+        )
+        return UNIT_RESPONSE_CACHE.get_or_compute(
+            key, lambda: self.run(num_hours, insulin_amount=1.0, five_min=five_min)
+        )
+
+    def get_stepper(self, five_min=True):
+        """
+        Get a state-space version of the model that advances one time step at a time.
+
+        Parameters
+        ----------
+        five_min: bool
+            If true, step in increments of 5 minutes, otherwise 1 minute
+
+        Returns
+        -------
+        PalermInsulinStepper
+            Stepper with the model parameters and no insulin on board
+        """
+        return PalermInsulinStepper(
+            self._isf, tau1=self._tau1, tau2=self._tau2, kcl=self._Kcl, minutes_per_step=5 if five_min else 1
+        )
+
+    def _get_unit_insulin_cleared(self, num_hours, five_min):
+        """
+        Get the insulin cleared, its change per time step and the insulin on board
+        for 1 U of insulin, from the unit response cache.
+        """
+        tau1 = self._tau1
+        tau2 = self._tau2
+        kcl = self._Kcl
+
+        def compute_unit_insulin_cleared():
+            insulin_cleared = np.cumsum((1 / (kcl * (tau2 - tau1))) * self._get_activity_shape(num_hours))
+            if five_min:
+                insulin_cleared = insulin_cleared[get_timeseries(num_hours, five_min=True)]
+            insulin_cleared_delta = np.append(0, insulin_cleared[1:] - insulin_cleared[:-1])
+            return insulin_cleared, insulin_cleared_delta, 1 - insulin_cleared
+
+        key = (self.name, "unit_insulin_cleared", tau1, tau2, kcl, num_hours, five_min)
+        return UNIT_RESPONSE_CACHE.get_or_compute(key, compute_unit_insulin_cleared)
+
+    def _get_activity_shape(self, num_hours):
+        """
+        Get the dose independent part of the 1 minute activity curve, exp(-t / tau2) - exp(-t / tau1),
+        from the unit response cache.
+        """
+        num_minutes = len(get_timeseries(num_hours, five_min=False))
+        return get_palerm_activity_shape(self._tau1, self._tau2, num_minutes)
+
+
+def get_palerm_unit_insulin_cleared(t, tau1, tau2, kcl):
+    """
+    Closed form of the insulin cleared by time t for 1 U of insulin given at t=0 in the
+    Palerm model, i.e. the cumulative sum of the 1 minute activity curve in PalermInsulinModel.run.
+
+    Each exponential sums as a geometric series, sum_{k=0}^{n} r^k = (1 - r^(n+1)) / (1 - r),
+    with r = exp(-1 / tau), which is evaluated for any real t >= 0.
+
+    Parameters
+    ----------
+    t: np.array
+        Times in minutes since the insulin was given
+
+    tau1: float
+        Palerm tau1
+
+    tau2: float
+        Palerm tau2
+
+    kcl: float
+        Palerm kcl
+
+    Returns
+    -------
+    np.array
+        The insulin cleared (U) at each time in t, 0 for times before t=0
+    """
+    t = np.asarray(t, dtype=float)
+
+    # Times before the dose are zeroed below, clip them so they can't overflow
+    t_after_dose = np.maximum(t, 0)
+
+    # expm1 keeps precision for 1 - exp(-x) when x is small
+    geometric_sum_tau2 = np.expm1(-(t_after_dose + 1) / tau2) / np.expm1(-1 / tau2)
+    geometric_sum_tau1 = np.expm1(-(t_after_dose + 1) / tau1) / np.expm1(-1 / tau1)
+
+    insulin_cleared = (1 / (kcl * (tau2 - tau1))) * (geometric_sum_tau2 - geometric_sum_tau1)
+
+    return np.where(t < 0, 0.0, insulin_cleared)
+
+
+def get_palerm_bg_jacobian(t, insulin_amount, isf, tau1, tau2, kcl):
+    """
+    Get the Palerm bg curve and its analytic derivatives with respect to isf, tau1, tau2 and kcl.
+
+    bg = -isf * insulin_amount * c * (G(tau2) - G(tau1)) where c = 1 / (kcl * (tau2 - tau1)) and G is
+    the geometric sum in get_palerm_unit_insulin_cleared, so each derivative is closed form and costs
+    about as much as one evaluation of the curve.
+
+    All arguments broadcast against each other, so passing (n_patients, 1) parameter columns and
+    (n_times,) times evaluates every patient at once.
+
+    Parameters
+    ----------
+    t: array-like
+        Times in minutes since the insulin was given
+
+    insulin_amount: float or array-like
+        The amount of insulin given at t=0
+
+    isf: float or array-like
+        Insulin sensitivity factor
+
+    tau1: float or array-like
+        Palerm tau1
+
+    tau2: float or array-like
+        Palerm tau2
+
+    kcl: float or array-like
+        Palerm kcl
+
+    Returns
+    -------
+    (np.array, np.array)
+        bg: The bg at each time starting at 0, shape broadcast(t, parameters)
+        jacobian: d bg / d parameter with a trailing axis in PALERM_PARAMETER_NAMES order
+    """
+    t = np.asarray(t, dtype=float)
+
+    t_after_dose = np.maximum(t, 0)
+    geometric_sum_tau1, geometric_sum_tau1_derivative = _get_geometric_sum_and_derivative(t_after_dose, tau1)
+    geometric_sum_tau2, geometric_sum_tau2_derivative = _get_geometric_sum_and_derivative(t_after_dose, tau2)
+
+    gain = 1 / (kcl * (tau2 - tau1))
+    insulin_cleared = gain * (geometric_sum_tau2 - geometric_sum_tau1)
+
+    # d gain / d tau1 = gain / (tau2 - tau1) and d gain / d tau2 = -gain / (tau2 - tau1)
+    insulin_cleared_tau1 = insulin_cleared / (tau2 - tau1) - gain * geometric_sum_tau1_derivative
+    insulin_cleared_tau2 = -insulin_cleared / (tau2 - tau1) + gain * geometric_sum_tau2_derivative
+    insulin_cleared_kcl = -insulin_cleared / kcl
+
+    before_dose = t < 0
+    bg_gain = -1 * isf * insulin_amount
+    bg = np.where(before_dose, 0.0, bg_gain * insulin_cleared)
+
+    jacobian = np.stack(
+        np.broadcast_arrays(
+            np.where(before_dose, 0.0, -1 * insulin_amount * insulin_cleared),
+            np.where(before_dose, 0.0, bg_gain * insulin_cleared_tau1),
+            np.where(before_dose, 0.0, bg_gain * insulin_cleared_tau2),
+            np.where(before_dose, 0.0, bg_gain * insulin_cleared_kcl),
+        ),
+        axis=-1,
+    )
+
+    return bg, jacobian
+
+
+def _get_geometric_sum_and_derivative(t, tau):
+    """
+    Get G = sum_{k=0}^{t} r^k = (1 - r^(t+1)) / (1 - r) with r = exp(-1 / tau), and dG / d tau.
+    """
+    step_decay = np.exp(-1 / tau)
+    decay = np.exp(-(t + 1) / tau)
+
+    # expm1 keeps precision for 1 - exp(-x) when x is small
+    numerator = -np.expm1(-(t + 1) / tau)
+    denominator = -np.expm1(-1 / tau)
+
+    # d r^(t+1) / d tau = r^(t+1) * (t + 1) / tau^2 and d r / d tau = r / tau^2
+    derivative = (numerator * step_decay - decay * (t + 1) * denominator) / (tau ** 2 * denominator ** 2)
+
+    return numerator / denominator, derivative
+
+
+def _sum_event_responses(t, event_times, event_amounts, get_unit_curve):
+    """
+    Sum the unit curve of each event, scaled by its amount, at each query time.
+
+    The (query time, event) pairs are evaluated in vectorized blocks of query times so memory
+    stays within EVENT_RESPONSE_MAX_ELEMENTS however many times and events there are.
+
+    Parameters
+    ----------
+    t: np.array
+        The query times in minutes
+
+    event_times: array-like
+        The time of each event in minutes
+
+    event_amounts: array-like
+        The amount of each event
+
+    get_unit_curve: callable
+        Maps times since an event, negative before it, to the response to one unit
+
+    Returns
+    -------
+    np.array
+        The combined response at each time in t
+    """
+    event_times = np.atleast_1d(np.asarray(event_times, dtype=float))
+    event_amounts = np.atleast_1d(np.asarray(event_amounts, dtype=float))
+
+    if event_times.shape != event_amounts.shape:
+        raise ValueError("Expected the same number of event times and amounts.")
+
+    response = np.zeros(len(t))
+    if len(event_times) == 0:
+        return response
+
+    num_times_per_block = max(1, EVENT_RESPONSE_MAX_ELEMENTS // len(event_times))
+    for start in range(0, len(t), num_times_per_block):
+        end = start + num_times_per_block
+        time_since_event = t[start:end, np.newaxis] - event_times
+        response[start:end] = get_unit_curve(time_since_event) @ event_amounts
+
+    return response
+
+
+def _check_out_buffers(out, num_buffers, num_steps):
+    """
+    Check the caller provided output buffers for a run.
+
+    Parameters
+    ----------
+    out: tuple of np.array
+        The output buffers
+
+    num_buffers: int
+        The number of outputs of the run
+
+    num_steps: int
+        The number of time steps in the run
+
+    Returns
+    -------
+    tuple of np.array
+        The buffers
+    """
+    if len(out) != num_buffers:
+        raise ValueError("Expected {} output buffers, got {}".format(num_buffers, len(out)))
+
+    for buffer in out:
+        if buffer.shape != (num_steps,):
+            raise ValueError("Expected output buffers of shape ({},), got {}".format(num_steps, buffer.shape))
+
+    return out
+
+
+def _get_scenario_column(values, default, num_scenarios, dtype=np.float64):
+    """
+    Shape a per-scenario parameter as a column so it broadcasts against (n_scenarios, n_timesteps).
+
+    Parameters
+    ----------
+    values: array-like or None
+        Parameter value per scenario, a scalar to share across scenarios, or None to use the default
+
+    default: float
+        The value to use when values is None
+
+    num_scenarios: int
+        The number of scenarios in the batch
+
+    dtype: np.dtype
+        The floating point type of the returned parameter, whether per-scenario, shared or the default
+
+    Returns
+    -------
+    np.array
+        The parameter with shape (n_scenarios, 1), or a scalar if it's shared by all scenarios
+    """
+    if values is None:
+        return np.asarray(default, dtype=dtype)
+
+    values = np.asarray(values, dtype=dtype)
+    if values.ndim == 0:
+        return values
+
+    if values.shape != (num_scenarios,):
+        raise ValueError(
+            "Expected {} values for batch parameter, got shape {}".format(num_scenarios, values.shape)
+        )
+
+    return values[:, np.newaxis]
+
 
 class CesconCarbModel(TreatmentModel):
     """
@@ -119,7 +657,10 @@ class CesconCarbModel(TreatmentModel):
         ----------
         kwargs: dict
             Arguments specific to the model.
-            Requires insulin sensitivity factor (isf) and and carb insulin ratio (cir)
+            Requires insulin sensitivity factor (isf) and and carb insulin ratio (cir).
+            Optional kernel_backend, the name of the kernel backend for run(), defaults to numpy.
+            Optional dtype of the run() and run_batch() outputs, defaults to float64. With float32
+            the curves are still computed in float64 and rounded once, halving memory for large batches.
         """
         super().__init__("Cescon")
         self._isf = kwargs["isf"]
@@ -130,7 +671,10 @@ class CesconCarbModel(TreatmentModel):
         self._theta = kwargs.get("theta", 20)
         self._Kcl = kwargs.get("kcl", 1)
 
-    def run(self, num_hours, carb_amount, five_min=True):
+        self._kernels = get_kernel_backend(kwargs.get("kernel_backend"))
+        self._dtype = np.dtype(kwargs.get("dtype", np.float64))
+
+    def run(self, num_hours, carb_amount, five_min=True, out=None, workspace=None):
         """
         Run the model for num hours assuming that the carb amount
         is given at t=0.
@@ -147,6 +691,13 @@ class CesconCarbModel(TreatmentModel):
             If true, run the model in increments of 5 minutes, otherwise
             1 minute
 
+        out: (np.array, np.array) or None
+            Buffers for bg_delta and bg with one value per time step. Allocated if None,
+            or taken from the workspace if one is given.
+
+        workspace: RunWorkspace or None
+            Reusable buffers, so repeated runs allocate no arrays
+
         Returns
         -------
         (np.array, np.array, np.array)
@@ -154,27 +705,345 @@ class CesconCarbModel(TreatmentModel):
             bg_delta: The change in bg for each time in t
             bg: The bg for each time in t starting at 0
         """
-        t_min = get_timeseries(num_hours, five_min=False)
+        if workspace is None:
+            t_min = get_timeseries(num_hours, five_min=five_min)
+        else:
+            t_min = workspace.get_timeseries(num_hours, five_min)
+            if out is None:
+                out = (workspace.carb_bg_delta[: len(t_min)], workspace.carb_bg[: len(t_min)])
 
-        if five_min:
-            t_min = get_timeseries(num_hours, five_min=True)
+        # mg/dL * min = (mg/dL / g) * g * min and its change, mg/dL / min
+        if out is None:
+            bg_delta, bg = np.empty(len(t_min), dtype=self._dtype), np.empty(len(t_min), dtype=self._dtype)
+        else:
+            bg_delta, bg = _check_out_buffers(out, 2, len(t_min))
+
+        self._kernels.cescon_carb(
+            carb_amount, self._isf, self._cir, self._tau, self._theta, 5 if five_min else 1, bg, bg_delta
+        )
+
+        return t_min, bg_delta, bg
+
+    def run_batch(self, num_hours, carb_amounts, isfs=None, cirs=None, taus=None, thetas=None, five_min=True):
+        """
+        Run the model for many scenarios at once assuming each carb amount
+        is given at t=0. Every scenario is computed in the same NumPy broadcast
+        and row i matches run() with the i-th set of parameters.
+
+        When tau and theta are shared by all scenarios the cached curve shape is
+        scaled, and rows match run() to floating point precision.
+
+        Parameters
+        ----------
+        num_hours: float
+            The amount of time in hours to compute the effect
+
+        carb_amounts: array-like
+            The amount of carbs for each scenario, shape (n_scenarios,)
+
+        isfs: array-like or None
+            Insulin sensitivity factor for each scenario. Defaults to the model isf.
+
+        cirs: array-like or None
+            Carb insulin ratio for each scenario. Defaults to the model cir.
+
+        taus: array-like or None
+            tau for each scenario. Defaults to the model tau.
+
+        thetas: array-like or None
+            theta for each scenario. Defaults to the model theta.
+
+        five_min: bool
+            If true, run the model in increments of 5 minutes, otherwise
+            1 minute
+
+        Returns
+        -------
+        (np.array, np.array, np.array)
+            t: The time series in minutes, shape (n_timesteps,)
+            bg_delta: The change in bg for each scenario and time in t, shape (n_scenarios, n_timesteps)
+            bg: The bg for each scenario and time in t starting at 0, shape (n_scenarios, n_timesteps)
+        """
+        # Parameters and curves are computed in float64 and the outputs rounded to the model dtype once
+        carb_amounts = np.atleast_1d(np.asarray(carb_amounts, dtype=np.float64))
+        num_scenarios = len(carb_amounts)
+
+        isf, cir, tau, theta = [
+            _get_scenario_column(values, default, num_scenarios)
+            for values, default in [(isfs, self._isf), (cirs, self._cir), (taus, self._tau), (thetas, self._theta)]
+        ]
+
+        t_min = get_timeseries(num_hours, five_min=five_min)
+
+        K = isf / cir  # mg/dL / g = (mg/dL / U) / (g / U)
+
+        if taus is None and thetas is None:
+            # The curve shape is shared, so scale the cached shape and its change per time step
+            absorption_shape, absorption_shape_delta = [
+                curve.astype(self._dtype, copy=False)
+                for curve in [
+                    self._get_absorption_shape(num_hours, five_min),
+                    self._get_absorption_shape_delta(num_hours, five_min),
+                ]
+            ]
+
+            bg_gain = (K * carb_amounts[:, np.newaxis]).astype(self._dtype, copy=False)
+
+            return t_min, bg_gain * absorption_shape_delta, bg_gain * absorption_shape
+
+        absorption_shape = (1 - np.exp((theta - t_min) / tau)) * np.heaviside(t_min - theta, 1)
+
+        # mg/dL * min = (mg/dL / g) * g * min
+        bg = K * carb_amounts[:, np.newaxis] * absorption_shape
+
+        bg_delta = np.zeros(bg.shape)
+        bg_delta[:, 1:] = bg[:, 1:] - bg[:, :-1]
+
+        bg_delta, bg = [result.astype(self._dtype, copy=False) for result in (bg_delta, bg)]
+
+        return t_min, bg_delta, bg
+
+    def run_at_times(self, t, carb_amount):
+        """
+        Evaluate the model at arbitrary times assuming that the carb amount
+        is given at t=0, without building the time series used by run().
+
+        Parameters
+        ----------
+        t: array-like
+            The sorted times in minutes since the carbs were eaten, e.g. irregular cgm timestamps
+
+        carb_amount: float
+            The amount of carbs to use for running the model
+
+        Returns
+        -------
+        (np.array, np.array, np.array)
+            t: The time series in minutes
+            bg_delta: The change in bg for each time in t
+            bg: The bg for each time in t starting at 0
+        """
+        t = np.asarray(t, dtype=float)
 
         K = self._isf / self._cir  # mg/dL / g = (mg/dL / U) / (g / U)
+        bg = K * carb_amount * get_cescon_unit_carb_absorbed(t, self._tau, self._theta)
+
+        bg_delta = np.append(0, bg[1:] - bg[:-1])
+
+        return t, bg_delta, bg
+
+    def run_events(self, t, event_times, carb_amounts):
+        """
+        Evaluate the combined effect of carbs eaten at arbitrary times, at arbitrary query times,
+        without resampling onto a regular time series.
+
+        Parameters
+        ----------
+        t: array-like
+            The sorted query times in minutes
+
+        event_times: array-like
+            The time in minutes of each carb entry, on the same clock as t
+
+        carb_amounts: array-like
+            The carbs of each entry, units: g
+
+        Returns
+        -------
+        (np.array, np.array, np.array)
+            t: The time series in minutes
+            bg_delta: The change in bg for each time in t
+            bg: The bg for each time in t, starting at 0 before the first entry
+        """
+        t = np.asarray(t, dtype=float)
         tau = self._tau
         theta = self._theta
 
-        # mg/dL * min = (mg/dL / g) * g * min
-        bg = (
-            K
-            * carb_amount
-            * (1 - np.exp((theta - t_min) / tau))
-            * np.heaviside(t_min - theta, 1)
+        K = self._isf / self._cir  # mg/dL / g = (mg/dL / U) / (g / U)
+        bg = K * _sum_event_responses(
+            t, event_times, carb_amounts, lambda s: get_cescon_unit_carb_absorbed(s, tau, theta)
         )
 
-        # mg/dL / min
         bg_delta = np.append(0, bg[1:] - bg[:-1])
 
-        return t_min, bg_delta, bg
+        return t, bg_delta, bg
+
+    def get_jacobian(self, t, carb_amount):
+        """
+        Get the bg at arbitrary times and its analytic derivatives with respect to the
+        model parameters, e.g. for fitting the parameters to observed bg.
+
+        Parameters
+        ----------
+        t: array-like
+            Times in minutes since the carbs were eaten
+
+        carb_amount: float
+            The amount of carbs to use for running the model
+
+        Returns
+        -------
+        (np.array, np.array)
+            bg: The bg for each time in t starting at 0, as in run() at those times
+            jacobian: d bg / d parameter for each time in t, shape (n_times, 4),
+                with columns in CESCON_PARAMETER_NAMES order (isf, cir, tau, theta)
+        """
+        return get_cescon_bg_jacobian(t, carb_amount, self._isf, self._cir, self._tau, self._theta)
+
+    def get_unit_response(self, num_hours, five_min=True):
+        """
+        Get the model output for 1 g of carbs given at t=0. The model is linear in the
+        carb amount, so scaling these curves gives the response to any amount.
+
+        The curves are shared through the process-wide unit response cache and are read-only.
+
+        Parameters
+        ----------
+        num_hours: float
+            The amount of time in hours to compute the effect
+
+        five_min: bool
+            If true, run the model in increments of 5 minutes, otherwise
+            1 minute
+
+        Returns
+        -------
+        (np.array, np.array, np.array)
+            t, bg_delta, bg as in run() for 1 g of carbs
+        """
+        key = (
+            self.name,
+            "unit_response",
+            self._isf,
+            self._cir,
+            self._tau,
+            self._theta,
+            num_hours,
+            five_min,
+            self._dtype.name,
+        )
+        return UNIT_RESPONSE_CACHE.get_or_compute(
+            key, lambda: self.run(num_hours, carb_amount=1.0, five_min=five_min)
+        )
+
+    def get_stepper(self, five_min=True):
+        """
+        Get an incremental version of the model that advances one time step at a time.
+
+        Parameters
+        ----------
+        five_min: bool
+            If true, step in increments of 5 minutes, otherwise 1 minute
+
+        Returns
+        -------
+        CesconCarbStepper
+            Stepper with the model parameters and no carbs being absorbed
+        """
+        return CesconCarbStepper(
+            self._isf, self._cir, tau=self._tau, theta=self._theta, minutes_per_step=5 if five_min else 1
+        )
+
+    def _get_absorption_shape(self, num_hours, five_min):
+        """
+        Get the carb amount independent part of the curve, (1 - exp((theta - t) / tau)) * heaviside(t - theta),
+        from the unit response cache.
+        """
+        num_steps = len(get_timeseries(num_hours, five_min=five_min))
+        return get_cescon_absorption_shape(self._tau, self._theta, 5 if five_min else 1, num_steps)
+
+    def _get_absorption_shape_delta(self, num_hours, five_min):
+        """Get the change per time step of the absorption shape from the unit response cache"""
+
+        def compute_absorption_shape_delta():
+            absorption_shape = self._get_absorption_shape(num_hours, five_min)
+            return np.append(0, absorption_shape[1:] - absorption_shape[:-1])
+
+        key = (self.name, "absorption_shape_delta", self._tau, self._theta, num_hours, five_min)
+        return UNIT_RESPONSE_CACHE.get_or_compute(key, compute_absorption_shape_delta)
+
+
+def get_cescon_unit_carb_absorbed(t, tau, theta):
+    """
+    Carbs absorbed by time t for 1 g of carbs eaten at t=0 in the Cescon model, the curve
+    that CesconCarbModel.run scales by the gain and carb amount.
+
+    Parameters
+    ----------
+    t: np.array
+        Times in minutes since the carbs were eaten
+
+    tau: float
+        Cescon tau
+
+    theta: float
+        Cescon theta
+
+    Returns
+    -------
+    np.array
+        The carbs absorbed (g) at each time in t, 0 until theta
+    """
+    # Times before theta are zeroed by the step, clip them so they can't overflow
+    return (1 - np.exp(np.minimum(theta - t, 0) / tau)) * np.heaviside(t - theta, 1)
+
+
+def get_cescon_bg_jacobian(t, carb_amount, isf, cir, tau, theta):
+    """
+    Get the Cescon bg curve and its analytic derivatives with respect to isf, cir, tau and theta.
+
+    bg = isf / cir * carb_amount * (1 - exp((theta - t) / tau)) for t >= theta and 0 before. The curve
+    has a kink at t = theta, where the theta derivative is taken from after the dead time.
+
+    All arguments broadcast against each other, so passing (n_patients, 1) parameter columns and
+    (n_times,) times evaluates every patient at once.
+
+    Parameters
+    ----------
+    t: array-like
+        Times in minutes since the carbs were eaten
+
+    carb_amount: float or array-like
+        The amount of carbs eaten at t=0
+
+    isf: float or array-like
+        Insulin sensitivity factor
+
+    cir: float or array-like
+        Carb insulin ratio
+
+    tau: float or array-like
+        Cescon tau
+
+    theta: float or array-like
+        Cescon theta
+
+    Returns
+    -------
+    (np.array, np.array)
+        bg: The bg at each time starting at 0, shape broadcast(t, parameters)
+        jacobian: d bg / d parameter with a trailing axis in CESCON_PARAMETER_NAMES order
+    """
+    t = np.asarray(t, dtype=float)
+
+    absorbing = np.heaviside(t - theta, 1)
+    unabsorbed = np.exp((theta - t) / tau) * absorbing
+    absorption_shape = (1 - np.exp((theta - t) / tau)) * absorbing
+
+    K = isf / cir  # mg/dL / g = (mg/dL / U) / (g / U)
+    bg = K * carb_amount * absorption_shape
+
+    jacobian = np.stack(
+        np.broadcast_arrays(
+            carb_amount * absorption_shape / cir,
+            -K * carb_amount * absorption_shape / cir,
+            K * carb_amount * unabsorbed * (theta - t) / tau ** 2,
+            -K * carb_amount * unabsorbed / tau,
+        ),
+        axis=-1,
+    )
+
+    return bg, jacobian
 
 
 class LoopInsulinModel(TreatmentModel):
@@ -0,0 +1,488 @@
+"""
+This file houses schedules of many insulin and carb events and the convolution engine
+that computes their combined effect from the treatment models' unit responses.
+"""
+
+import numpy as np
+from scipy.signal import oaconvolve
+
+from tidepool_data_science_models.utils import MINUTES_PER_HOUR
+
+# The bg kernels cover this horizon, by which the responses have fully decayed
+KERNEL_NUM_HOURS = 24
+
+# The steady state basal iob treats insulin older than this as fully decayed, as in get_iob_from_sbr
+# and the FDA steady state iob
+IOB_KERNEL_NUM_HOURS = 8
+
+# Basal insulin is delivered as a pulse every 5 minutes
+MINUTES_PER_PUMP_PULSE = 5
+
+MINUTES_PER_DAY = 24 * MINUTES_PER_HOUR
+
+
+class TreatmentSchedule(object):
+    """
+    Boluses, basal rates and carbs given at arbitrary times after t0.
+
+    Times are in minutes since t0. Basal rates are in U/hr and each one is active from
+    its start time until the next basal start time.
+    """
+
+    def __init__(
+        self,
+        bolus_times=None,
+        bolus_amounts=None,
+        carb_times=None,
+        carb_amounts=None,
+        basal_start_times=None,
+        basal_rates=None,
+    ):
+        """
+        Parameters
+        ----------
+        bolus_times: array-like
+            Minutes since t0 of each bolus
+
+        bolus_amounts: array-like
+            Insulin of each bolus, units: U
+
+        carb_times: array-like
+            Minutes since t0 of each carb entry
+
+        carb_amounts: array-like
+            Carbs of each entry, units: g
+
+        basal_start_times: array-like
+            Minutes since t0 that each basal rate starts
+
+        basal_rates: array-like
+            The basal rates, units: U/hr
+        """
+        self.bolus_times, self.bolus_amounts = _get_event_arrays(bolus_times, bolus_amounts, "bolus")
+        self.carb_times, self.carb_amounts = _get_event_arrays(carb_times, carb_amounts, "carb")
+        self.basal_start_times, self.basal_rates = _get_event_arrays(basal_start_times, basal_rates, "basal")
+
+        if np.any(self.carb_amounts < 0):
+            raise ValueError("Carbs must be greater than zero.")
+
+    def add_bolus(self, time, amount):
+        """Add a bolus of amount U at time minutes since t0"""
+        self.bolus_times = np.append(self.bolus_times, _validate_event_time(time))
+        self.bolus_amounts = np.append(self.bolus_amounts, amount)
+
+    def add_carb(self, time, amount):
+        """Add amount g of carbs at time minutes since t0"""
+        if amount < 0:
+            raise ValueError("Carbs must be greater than zero.")
+        self.carb_times = np.append(self.carb_times, _validate_event_time(time))
+        self.carb_amounts = np.append(self.carb_amounts, amount)
+
+    def add_basal(self, start_time, rate):
+        """Start a basal rate of rate U/hr at start_time minutes since t0"""
+        self.basal_start_times = np.append(self.basal_start_times, _validate_event_time(start_time))
+        self.basal_rates = np.append(self.basal_rates, rate)
+
+    def get_event_series(self, num_hours, minutes_per_step):
+        """
+        Bin the events into a regular time series. Events are assigned to the nearest time step
+        and events at or after num_hours are dropped.
+
+        Parameters
+        ----------
+        num_hours: float
+            Length of the time series
+
+        minutes_per_step: int
+            Minutes between time steps, e.g. 5 or 1
+
+        Returns
+        -------
+        (np.array, np.array)
+            insulin: The insulin given in each time step from boluses and basal pulses, units: U
+            carbs: The carbs given in each time step, units: g
+        """
+        num_steps = get_num_time_steps(num_hours, minutes_per_step)
+
+        insulin = _bin_events(self.bolus_times, self.bolus_amounts, num_steps, minutes_per_step)
+        insulin += _bin_events(*self.get_basal_pulses(num_hours), num_steps, minutes_per_step)
+        carbs = _bin_events(self.carb_times, self.carb_amounts, num_steps, minutes_per_step)
+
+        return insulin, carbs
+
+    def get_basal_pulses(self, num_hours):
+        """
+        Get the basal insulin as a pulse every MINUTES_PER_PUMP_PULSE minutes.
+
+        NOTE: Like get_iob_from_sbr() this doesn't round pulses to the pump's delivery increment.
+
+        Parameters
+        ----------
+        num_hours: float
+            How long to deliver basal
+
+        Returns
+        -------
+        (np.array, np.array)
+            pulse_times: Minutes since t0 of each pulse
+            pulse_amounts: Insulin of each pulse, units: U
+        """
+        pulse_times = np.arange(0, num_hours * MINUTES_PER_HOUR, MINUTES_PER_PUMP_PULSE)
+
+        if len(self.basal_rates) == 0:
+            return pulse_times, np.zeros(len(pulse_times))
+
+        sort_index = np.argsort(self.basal_start_times, kind="stable")
+        start_times = self.basal_start_times[sort_index]
+        rates = self.basal_rates[sort_index]
+
+        # Index of the basal rate active at each pulse, -1 before the first one starts
+        rate_index = np.searchsorted(start_times, pulse_times, side="right") - 1
+        pulse_rates = np.where(rate_index >= 0, rates[np.maximum(rate_index, 0)], 0.0)
+
+        # U/pulse = U/hr / pulse/hr
+        pulse_amounts = pulse_rates / (MINUTES_PER_HOUR / MINUTES_PER_PUMP_PULSE)
+
+        return pulse_times, pulse_amounts
+
+
+class DailySchedule(object):
+    """
+    A piecewise constant value that repeats every 24 hours, e.g. a basal rate schedule.
+
+    Each value is active from its start time until the next start time. The last value
+    wraps around midnight until the first start time of the next day.
+    """
+
+    def __init__(self, start_times, values):
+        """
+        Parameters
+        ----------
+        start_times: array-like
+            Minutes since midnight that each segment starts, sorted and within [0, 1440)
+
+        values: array-like
+            The value of each segment, e.g. basal rates in U/hr
+        """
+        self.start_times = np.atleast_1d(np.asarray(start_times, dtype=float))
+        self.values = np.atleast_1d(np.asarray(values, dtype=float))
+
+        if len(self.start_times) == 0 or self.start_times.shape != self.values.shape:
+            raise ValueError("Expected the same number of schedule start times and values.")
+
+        if np.any(np.diff(self.start_times) <= 0):
+            raise ValueError("Schedule start times must be sorted and unique.")
+
+        if self.start_times[0] < 0 or self.start_times[-1] >= MINUTES_PER_DAY:
+            raise ValueError("Schedule start times must be within a day.")
+
+    def get_values(self, t, start_minute_of_day=0):
+        """
+        Get the scheduled value at each time.
+
+        Parameters
+        ----------
+        t: array-like
+            Minutes since t0, may be negative
+
+        start_minute_of_day: float
+            Minutes since midnight at t0
+
+        Returns
+        -------
+        np.array
+            The value active at each time
+        """
+        minute_of_day = np.mod(np.asarray(t, dtype=float) + start_minute_of_day, MINUTES_PER_DAY)
+
+        # -1 before the first start time wraps to the last segment of the previous day
+        segment_index = np.searchsorted(self.start_times, minute_of_day, side="right") - 1
+
+        return self.values[segment_index]
+
+
+class TempBasals(object):
+    """
+    Temporary basal rates that replace the scheduled basal rate for a duration.
+    """
+
+    def __init__(self, start_times, durations, rates):
+        """
+        Parameters
+        ----------
+        start_times: array-like
+            Minutes since t0 that each temp basal starts
+
+        durations: array-like
+            Minutes that each temp basal lasts
+
+        rates: array-like
+            The temp basal rates, units: U/hr
+        """
+        self.start_times = np.atleast_1d(np.asarray(start_times, dtype=float))
+        self.durations = np.atleast_1d(np.asarray(durations, dtype=float))
+        self.rates = np.atleast_1d(np.asarray(rates, dtype=float))
+
+        if not self.start_times.shape == self.durations.shape == self.rates.shape:
+            raise ValueError("Expected the same number of temp basal start times, durations and rates.")
+
+    def apply(self, t, scheduled_rates):
+        """
+        Replace the scheduled rates with any temp basal active at each time. Later temp basals
+        take precedence where they overlap, like a pump replacing the active temp basal.
+
+        Parameters
+        ----------
+        t: np.array
+            Minutes since t0
+
+        scheduled_rates: np.array
+            The scheduled basal rate at each time
+
+        Returns
+        -------
+        np.array
+            The delivered basal rate at each time
+        """
+        rates = np.array(scheduled_rates, dtype=float)
+        for start_time, duration, rate in sorted(zip(self.start_times, self.durations, self.rates)):
+            rates[(t >= start_time) & (t < start_time + duration)] = rate
+        return rates
+
+
+def get_basal_pulse_series(
+    basal_schedules, num_hours, minutes_per_step, temp_basals=None, start_minute_of_day=0, num_hours_pre_t0=0
+):
+    """
+    Get the basal insulin delivered in each time step as a pulse every MINUTES_PER_PUMP_PULSE minutes.
+
+    Parameters
+    ----------
+    basal_schedules: list of DailySchedule
+        The basal rate schedule of each patient, units: U/hr
+
+    num_hours: float
+        Hours after t0
+
+    minutes_per_step: int
+        Minutes between time steps, e.g. 5 or 1
+
+    temp_basals: list of TempBasals or None
+        Temp basals for each patient, None entries have no temp basals
+
+    start_minute_of_day: float
+        Minutes since midnight at t0
+
+    num_hours_pre_t0: float
+        Hours before t0 to also deliver basal, the series starts at -num_hours_pre_t0
+
+    Returns
+    -------
+    np.array
+        Insulin in each time step, shape (number of patients, number of time steps), units: U.
+        The steps before t0 are the first get_num_time_steps(num_hours_pre_t0, minutes_per_step).
+    """
+    if temp_basals is None:
+        temp_basals = [None] * len(basal_schedules)
+
+    if len(temp_basals) != len(basal_schedules):
+        raise ValueError("Expected temp basals for each basal schedule.")
+
+    minutes_pre_t0 = num_hours_pre_t0 * MINUTES_PER_HOUR
+    pulse_times = np.arange(-minutes_pre_t0, num_hours * MINUTES_PER_HOUR, MINUTES_PER_PUMP_PULSE)
+
+    # t0 is at step num_steps_pre_t0, so the steps from t0 line up with get_timeseries(num_hours)
+    num_steps_pre_t0 = get_num_time_steps(num_hours_pre_t0, minutes_per_step)
+    num_steps = num_steps_pre_t0 + get_num_time_steps(num_hours, minutes_per_step)
+    step_index = num_steps_pre_t0 + np.round(pulse_times / minutes_per_step).astype(int)
+
+    in_range = (step_index >= 0) & (step_index < num_steps)
+    pulse_times, step_index = pulse_times[in_range], step_index[in_range]
+
+    pulse_series = np.zeros((len(basal_schedules), num_steps))
+    for patient_index, (basal_schedule, patient_temp_basals) in enumerate(zip(basal_schedules, temp_basals)):
+        pulse_rates = basal_schedule.get_values(pulse_times, start_minute_of_day=start_minute_of_day)
+
+        if patient_temp_basals is not None:
+            pulse_rates = patient_temp_basals.apply(pulse_times, pulse_rates)
+
+        # U/pulse = U/hr / pulse/hr
+        pulse_series[patient_index, step_index] = pulse_rates / (MINUTES_PER_HOUR / MINUTES_PER_PUMP_PULSE)
+
+    return pulse_series
+
+
+def get_setting_series(settings, num_patients, num_steps, minutes_per_step, start_minute_of_day=0):
+    """
+    Get a therapy setting, e.g. the insulin sensitivity factor, for each patient and time step.
+
+    Each value is the setting while the bg changes over the time step ending at that time, so an
+    effect that straddles a schedule boundary uses the setting in effect while it acts.
+
+    Parameters
+    ----------
+    settings: float, DailySchedule or list of them
+        The setting shared by all patients, or one for each patient
+
+    num_patients: int
+        Number of patients
+
+    num_steps: int
+        Number of time steps from t0
+
+    minutes_per_step: int
+        Minutes between time steps, e.g. 5 or 1
+
+    start_minute_of_day: float
+        Minutes since midnight at t0
+
+    Returns
+    -------
+    np.array
+        The setting for each patient and time step, shape (number of patients, number of time steps)
+    """
+    if isinstance(settings, DailySchedule) or np.ndim(settings) == 0:
+        settings = [settings] * num_patients
+
+    if len(settings) != num_patients:
+        raise ValueError("Expected a setting for each of the {} patients.".format(num_patients))
+
+    # The change in bg at a time step happens over the step before it
+    interval_start_times = (np.arange(num_steps) - 1) * minutes_per_step
+
+    setting_series = np.empty((num_patients, num_steps))
+    for patient_index, setting in enumerate(settings):
+        if isinstance(setting, DailySchedule):
+            setting_series[patient_index] = setting.get_values(
+                interval_start_times, start_minute_of_day=start_minute_of_day
+            )
+        else:
+            setting_series[patient_index] = setting
+
+    return setting_series
+
+
+def get_num_time_steps(num_hours, minutes_per_step):
+    """
+    Get the number of time steps in num_hours, the same as the length of get_timeseries(num_hours).
+
+    Parameters
+    ----------
+    num_hours: float
+        Length of the time series
+
+    minutes_per_step: int
+        Minutes between time steps, e.g. 5 or 1
+
+    Returns
+    -------
+    int
+        Number of time steps, including a partial step at the end
+    """
+    num_minutes = int(num_hours * MINUTES_PER_HOUR)
+    return (num_minutes + minutes_per_step - 1) // minutes_per_step
+
+
+def get_insulin_kernels(insulin_model, five_min=True, iob_num_hours=KERNEL_NUM_HOURS):
+    """
+    Get the insulin model's bg_delta and iob response to 1 U over KERNEL_NUM_HOURS, so the whole
+    effect is applied without folding a truncated tail into one step.
+
+    Parameters
+    ----------
+    insulin_model: TreatmentModel
+        The insulin model
+
+    five_min: bool
+        Whether the kernels are at 5 minute intervals, otherwise 1 minute
+
+    iob_num_hours: float
+        Hours of the iob kernel, after which the insulin counts as fully decayed. The steady state
+        basal iob uses IOB_KERNEL_NUM_HOURS to settle at the same iob as get_iob_from_sbr.
+
+    Returns
+    -------
+    (np.array, np.array)
+        bg_delta_kernel, iob_kernel
+    """
+    _, bg_delta, _, iob = insulin_model.get_unit_response(KERNEL_NUM_HOURS, five_min=five_min)
+
+    return bg_delta, iob[: get_num_time_steps(iob_num_hours, 5 if five_min else 1)]
+
+
+def get_carb_kernel(carb_model, five_min=True):
+    """
+    Get the carb model's bg_delta response to 1 g over KERNEL_NUM_HOURS.
+
+    Parameters
+    ----------
+    carb_model: TreatmentModel
+        The carb model
+
+    five_min: bool
+        Whether the kernel is at 5 minute intervals, otherwise 1 minute
+
+    Returns
+    -------
+    np.array
+        bg_delta_kernel
+    """
+    _, bg_delta, _ = carb_model.get_unit_response(KERNEL_NUM_HOURS, five_min=five_min)
+
+    return bg_delta
+
+
+def convolve_events(event_series, kernel):
+    """
+    Compute the combined response to every event in the series by overlap-add FFT convolution.
+
+    Parameters
+    ----------
+    event_series: np.array
+        Amount given at each time step. 2D arrays are convolved row by row.
+
+    kernel: np.array
+        The response to one unit given at time step 0
+
+    Returns
+    -------
+    np.array
+        The response at each time step, same shape as event_series
+    """
+    event_series = np.asarray(event_series, dtype=float)
+    num_steps = event_series.shape[-1]
+
+    if num_steps == 0 or len(kernel) == 0:
+        return np.zeros(event_series.shape)
+
+    if event_series.ndim == 2:
+        kernel = kernel[np.newaxis, :]
+
+    return oaconvolve(event_series, kernel, axes=-1)[..., :num_steps]
+
+
+def _get_event_arrays(times, amounts, event_name):
+    """Validate a pair of event times and amounts and return them as float arrays"""
+    times = np.atleast_1d(np.asarray([] if times is None else times, dtype=float))
+    amounts = np.atleast_1d(np.asarray([] if amounts is None else amounts, dtype=float))
+
+    if times.shape != amounts.shape:
+        raise ValueError("Expected the same number of {} times and amounts.".format(event_name))
+
+    _validate_event_time(times)
+
+    return times, amounts
+
+
+def _validate_event_time(time):
+    if np.any(np.asarray(time) < 0):
+        raise ValueError("Event times must be at or after t0.")
+    return time
+
+
+def _bin_events(times, amounts, num_steps, minutes_per_step):
+    """Sum the event amounts into the nearest time step"""
+    step_index = np.round(np.asarray(times) / minutes_per_step).astype(int)
+    in_range = step_index < num_steps
+    binned = np.bincount(step_index[in_range], weights=np.asarray(amounts)[in_range], minlength=num_steps)
+    return binned.astype(float, copy=False)
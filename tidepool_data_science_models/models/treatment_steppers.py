@@ -0,0 +1,263 @@
+"""
+This file houses incremental versions of the treatment models that advance one
+time step at a time, e.g. for closed loop simulation.
+"""
+
+import numpy as np
+from scipy.linalg import expm
+from scipy.signal import lfilter
+
+
+class PalermInsulinStepper(object):
+    """
+    State-space form of the Palerm insulin model. Insulin is given into a depot compartment
+    that feeds a plasma compartment, and the activity curve in PalermInsulinModel.run is
+    the plasma insulin / (kcl * tau2).
+
+    The continuous system is discretized exactly with the matrix exponential, and the insulin
+    cleared within a step is summed at whole minutes like run(), so stepping one dose through
+    matches run() to floating point precision while each step costs O(1).
+    """
+
+    def __init__(self, isf, tau1=55, tau2=70, kcl=1, minutes_per_step=5):
+        """
+        Parameters
+        ----------
+        isf: float
+            How many mg/dL are reduced by 1 unit of insulin, units: mg/dL / U
+
+        tau1: float
+            Palerm tau1, the depot time constant in minutes
+
+        tau2: float
+            Palerm tau2, the plasma time constant in minutes
+
+        kcl: float
+            Palerm kcl
+
+        minutes_per_step: int
+            Whole minutes per step, e.g. 5 or 1
+        """
+        self._isf = isf
+        self.minutes_per_step = minutes_per_step
+
+        # d/dt [depot, plasma] = system_matrix @ [depot, plasma]
+        system_matrix = np.array([[-1 / tau1, 0], [1 / tau1, -1 / tau2]])
+
+        self._transition = expm(system_matrix * minutes_per_step)
+
+        # Insulin cleared during a step as a function of the state at the start of the step
+        self._clearance = np.sum(
+            [expm(system_matrix * minute)[1, :] for minute in range(1, minutes_per_step + 1)], axis=0
+        ) / (kcl * tau2)
+
+        # Modal form of the transition for step_many(), each mode decays independently
+        self._mode_decays, self._mode_vectors = np.linalg.eig(self._transition)
+        self._dose_modes = np.linalg.solve(self._mode_vectors, np.array([1.0, 0.0]))
+        self._clearance_modes = self._clearance @ self._mode_vectors
+
+        self.init_state()
+
+    def init_state(self, compartments=None, iob=None):
+        """
+        Reset the insulin state.
+
+        Parameters
+        ----------
+        compartments: array-like or None
+            The insulin in the depot and plasma compartments, units: U. Defaults to no insulin.
+
+        iob: float or None
+            The insulin on board, units: U. Defaults to the insulin in the compartments.
+        """
+        if compartments is None:
+            compartments = np.zeros(2)
+
+        self.compartments = np.array(compartments, dtype=float)
+        self.iob = float(np.sum(self.compartments)) if iob is None else float(iob)
+
+    def step(self, dose=0.0):
+        """
+        Give dose at the current time and advance one step.
+
+        Parameters
+        ----------
+        dose: float
+            Insulin given at the start of the step, units: U
+
+        Returns
+        -------
+        (float, float)
+            bg_delta: The change in bg over the step
+            iob: The insulin on board at the end of the step
+        """
+        self.compartments[0] += dose
+        self.iob += dose
+
+        insulin_cleared = self._clearance @ self.compartments
+        self.compartments = self._transition @ self.compartments
+        self.iob -= insulin_cleared
+
+        return -1 * self._isf * insulin_cleared, self.iob
+
+    def step_many(self, doses):
+        """
+        Give each dose at the start of consecutive steps and advance past all of them.
+        Equivalent to calling step() for each dose, evaluated with one linear filter per mode.
+
+        Parameters
+        ----------
+        doses: array-like
+            Insulin given at the start of each step, units: U
+
+        Returns
+        -------
+        (np.array, np.array)
+            bg_delta: The change in bg over each step
+            iob: The insulin on board at the end of each step
+        """
+        doses = np.asarray(doses, dtype=float)
+        if len(doses) == 0:
+            return np.zeros(0), np.zeros(0)
+
+        modes = np.linalg.solve(self._mode_vectors, self.compartments)
+
+        insulin_cleared = np.zeros(len(doses))
+        for mode_index, mode_decay in enumerate(self._mode_decays):
+            # Mode value just after each dose: a[k] = decay * a[k - 1] + dose_mode * doses[k]
+            mode_after_dose, mode_final = lfilter(
+                [self._dose_modes[mode_index]], [1, -mode_decay], doses, zi=[modes[mode_index]]
+            )
+            insulin_cleared += self._clearance_modes[mode_index] * mode_after_dose
+            modes[mode_index] = mode_final[0]
+
+        self.compartments = np.real(self._mode_vectors @ modes)
+
+        iob = self.iob + np.cumsum(doses - insulin_cleared)
+        self.iob = iob[-1]
+
+        return -1 * self._isf * insulin_cleared, iob
+
+
+class CesconCarbStepper(object):
+    """
+    Incremental form of the Cescon carb model. Carbs wait out the dead time theta in a
+    fixed-size ring buffer and are then absorbed with first order dynamics, so each step
+    costs O(1) and carbs can be added at any step.
+
+    Stepping carbs through matches CesconCarbModel.run() to floating point precision,
+    including when theta is not a whole number of steps.
+    """
+
+    def __init__(self, isf, cir, tau=42, theta=20, minutes_per_step=5):
+        """
+        Parameters
+        ----------
+        isf: float
+            How many mg/dL are reduced by 1 unit of insulin, units: mg/dL / U
+
+        cir: float
+            How many g carbs are offset by 1 unit of insulin, units: g / U
+
+        tau: float
+            Cescon tau, the absorption time constant in minutes
+
+        theta: float
+            Cescon theta, the dead time in minutes before absorption starts
+
+        minutes_per_step: int
+            Minutes per step, e.g. 5 or 1
+        """
+        self._gain = isf / cir  # mg/dL / g = (mg/dL / U) / (g / U)
+        self.minutes_per_step = minutes_per_step
+
+        # Carbs leave the dead time during the step that contains theta, having absorbed
+        # for the part of that step after theta. The ring buffer holds them until then.
+        num_delay_steps = int(np.floor(theta / minutes_per_step))
+        first_step_minutes = (num_delay_steps + 1) * minutes_per_step - theta
+        self._delay_buffer_size = num_delay_steps + 1
+
+        self._step_unabsorbed = np.exp(-minutes_per_step / tau)
+        self._first_step_unabsorbed = np.exp(-first_step_minutes / tau)
+
+        self.init_state()
+
+    def init_state(self):
+        """Reset to no carbs in the dead time or being absorbed"""
+        self.delay_buffer = np.zeros(self._delay_buffer_size)
+        self._delay_buffer_index = 0
+        self.unabsorbed_carbs = 0.0
+
+    def step(self, carbs=0.0):
+        """
+        Add carbs at the current time and advance one step.
+
+        Parameters
+        ----------
+        carbs: float
+            Carbs eaten at the start of the step, units: g
+
+        Returns
+        -------
+        float
+            bg_delta: The change in bg over the step
+        """
+        self.delay_buffer[self._delay_buffer_index] = carbs
+        self._delay_buffer_index = (self._delay_buffer_index + 1) % self._delay_buffer_size
+        released_carbs = self.delay_buffer[self._delay_buffer_index]
+        self.delay_buffer[self._delay_buffer_index] = 0.0
+
+        absorbed_carbs = self.unabsorbed_carbs * (1 - self._step_unabsorbed) + released_carbs * (
+            1 - self._first_step_unabsorbed
+        )
+        self.unabsorbed_carbs = (
+            self.unabsorbed_carbs * self._step_unabsorbed + released_carbs * self._first_step_unabsorbed
+        )
+
+        return self._gain * absorbed_carbs
+
+    def step_many(self, carbs):
+        """
+        Add carbs at the start of consecutive steps and advance past all of them.
+        Equivalent to calling step() for each carb entry, evaluated with one linear filter.
+
+        Parameters
+        ----------
+        carbs: array-like
+            Carbs eaten at the start of each step, units: g
+
+        Returns
+        -------
+        np.array
+            bg_delta: The change in bg over each step
+        """
+        carbs = np.asarray(carbs, dtype=float)
+        num_steps = len(carbs)
+        if num_steps == 0:
+            return np.zeros(0)
+
+        # Carbs still in the dead time are released first, in the order they were eaten
+        pending_index = (
+            self._delay_buffer_index + 1 + np.arange(self._delay_buffer_size - 1)
+        ) % self._delay_buffer_size
+        carbs_in_release_order = np.append(self.delay_buffer[pending_index], carbs)
+        released_carbs = carbs_in_release_order[:num_steps]
+
+        self.delay_buffer[:] = 0.0
+        self.delay_buffer[pending_index] = carbs_in_release_order[num_steps:]
+
+        # unabsorbed[k] = step_unabsorbed * unabsorbed[k - 1] + first_step_unabsorbed * released[k]
+        unabsorbed_carbs, _ = lfilter(
+            [self._first_step_unabsorbed],
+            [1, -self._step_unabsorbed],
+            released_carbs,
+            zi=[self._step_unabsorbed * self.unabsorbed_carbs],
+        )
+        unabsorbed_carbs_before = np.append(self.unabsorbed_carbs, unabsorbed_carbs[:-1])
+        self.unabsorbed_carbs = unabsorbed_carbs[-1]
+
+        absorbed_carbs = unabsorbed_carbs_before * (1 - self._step_unabsorbed) + released_carbs * (
+            1 - self._first_step_unabsorbed
+        )
+
+        return self._gain * absorbed_carbs